@@ -1,15 +1,32 @@
 # Основная логика агента
+import asyncio
 import os
-from typing import List, Dict, Optional
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from typing import List, Dict, Optional, Tuple, AsyncIterator, Awaitable, Callable
+import numpy as np
 from langchain_groq import ChatGroq
 from langchain_core.tools import tool
 
-from config import SUPPORTED_EXTENSIONS, MAX_SEARCH_RESULTS, MESSAGES
-from utils import extract_sources_from_results, should_skip_file
+from config import (
+    MESSAGES, FTS_CANDIDATES_LIMIT, RETRIEVAL_MODE,
+    RRF_K, HYBRID_CANDIDATES, LEXICAL_BUDGET_SEC, DENSE_BUDGET_SEC, RETRIEVAL_WORKERS, NOTES_WATCH,
+    LLM_ANSWER_TOKENS_ESTIMATE, CONTEXT_CANDIDATES, FUZZY_MATCH,
+)
+from utils import extract_sources_from_results
 from prompts import SEARCH_AGENT_PROMPT
-from document_reader import read_document, semantic_search
+from bm25 import BM25Index
+from query import CompiledQuery, compile_query
+from embeddings import dense_search, embeddings_available
 from schemas import ResearchReport
-from db import get_user_documents
+from corpus_cache import corpus_cache
+from bloom import bloom_cache
+from answer_cache import answer_cache
+from llm_scheduler import llm_scheduler
+from context_packer import pack_context, count_tokens, load_tokenizer
+from notes_index import notes_index
+from db import search_user_chunks, document_chunk_store
 
 
 @tool
@@ -17,40 +34,35 @@ def search_in_notes(query: str) -> str:
     """
     Умный поиск информации в заметках к книге.
     """
-    current_dir = os.path.dirname(os.path.abspath(__file__))
-    parent_dir = os.path.dirname(current_dir)
-    
-    all_results = []
-    
-    for filename in os.listdir(parent_dir):
-        file_path = os.path.join(parent_dir, filename)
-        
-        if os.path.isdir(file_path) or should_skip_file(filename):
-            continue
-            
-        ext = os.path.splitext(filename)[1].lower()
-        if ext not in SUPPORTED_EXTENSIONS:
-            continue
-            
-        content = read_document(file_path)
-        if not content:
-            continue
-        
-        file_results = semantic_search(query, content, filename)
-        all_results.extend(file_results)
+    return search_notes(query)[0]
+
+
+def search_notes(query: str) -> Tuple[str, bool]:
+    """
+    Поиск по заметкам: (текст для промпта, найдено ли что-нибудь).
+    """
+    # Разбираются только новые и измененные файлы, остальное берется из индекса.
+    # Если за папкой следит фоновый наблюдатель - индекс актуален (после первого обновления).
+    notes_index.ensure_ready()
+    all_results = notes_index.search(compile_query(query), CONTEXT_CANDIDATES)
     
     if not all_results:
+        return f"ИНФОРМАЦИЯ: {MESSAGES['no_info']}", False
+
+    passages = pack_context(all_results, notes_index)
+    return format_passages(passages), bool(passages)
+
+
+def format_passages(passages: List[Dict]) -> str:
+    """Оформляет собранные фрагменты для промпта (блоки "РЕЗУЛЬТАТ i")"""
+    if not passages:
         return f"ИНФОРМАЦИЯ: {MESSAGES['no_info']}"
-    
-    all_results.sort(key=lambda x: x["relevance_score"], reverse=True)
-    
-    top_results = all_results[:MAX_SEARCH_RESULTS]
 
     structured_results = []
-    for i, result in enumerate(top_results, 1):
+    for i, result in enumerate(passages, 1):
         structured_result = f"""
 РЕЗУЛЬТАТ {i}:
-Файл: {result['filename']}
+Файл: {format_source(result)}
 Релевантность: {result['relevance_score']}
 ---
 {result['context']}
@@ -60,41 +72,174 @@ def search_in_notes(query: str) -> str:
     return "\n".join(structured_results)
 
 
-def search_in_user_storage(query: str, user_id: int) -> str:
+def lexical_user_hits(query: CompiledQuery, user_id: int, k: int = CONTEXT_CANDIDATES) -> List[Dict]:
     """
-    Поиск информации в загруженных пользователем документах.
-    Теперь user_id - число!
+    Поиск по словам с ранжированием BM25, k лучших чанков.
+    Обычно корпус пользователя лежит в кэше и оценивается целиком, без БД.
+    Если корпус не помещается в кэш, кандидаты берутся из полнотекстового
+    индекса SQLite и ранжируются между собой.
+    Документы и блоки чанков, где по фильтрам Блума точно нет слов
+    запроса, не оцениваются вовсе. Слова с опечатками (FUZZY_MATCH)
+    исправляются по словарю корпуса.
+    """
+    corpus = corpus_cache.get(user_id)
+    if corpus is not None and FUZZY_MATCH:
+        query = corpus.bm25.correct_typos(query)
+
+    candidates = bloom_cache.candidates(user_id, query)
+    if candidates is not None and not candidates:
+        return []
+
+    if corpus is not None:
+        chunks, index = corpus.chunks, corpus.bm25
+        rows = corpus.rows_in(candidates) if candidates is not None else None
+        # Если фильтры отсеяли мало, быстрее оценить весь корпус разом (оценки те же)
+        if rows is not None and len(rows) * 4 > len(chunks):
+            rows = None
+    else:
+        chunks = search_user_chunks(  # функция из db.py
+            user_id, query.terms, limit=FTS_CANDIDATES_LIMIT,
+            document_ids=list(candidates) if candidates is not None else None,
+        )
+        index = BM25Index([chunk["text"] for chunk in chunks])
+        rows = None
+
+    scores = index.score(query, rows=rows)
+
+    # Отбираем k лучших частичной сортировкой, записи строим только для них
+    rows = np.flatnonzero(scores > 0)
+    if len(rows) > k:
+        rows = rows[np.argpartition(-scores[rows], k - 1)[:k]]
+    rows = rows[np.argsort(-scores[rows], kind="stable")]
+
+    results: List[Dict] = []
+    for row in rows:
+        chunk = chunks[row]
+        results.append({
+            "document_id": chunk["document_id"],
+            "filename": chunk["filename"],
+            "relevance_score": round(float(scores[row]), 2),
+            "found_words": index.found_words(row, query)[:5],
+            "chunk_index": chunk["chunk_index"],
+            "page": chunk["page"],
+        })
+    return results
+
+
+# Потоки для веток гибридного поиска - у каждой ветки свои: ветка, которая
+# не уложилась в бюджет и еще досчитывается, не задерживает другую
+_branch_pools = {
+    "lexical": ThreadPoolExecutor(max_workers=RETRIEVAL_WORKERS, thread_name_prefix="retrieval-lexical"),
+    "dense": ThreadPoolExecutor(max_workers=RETRIEVAL_WORKERS, thread_name_prefix="retrieval-dense"),
+}
+
+
+class _Branch:
+    """Ветка поиска в пуле: запоминает, когда поток взял ее в работу"""
+
+    def __init__(self, func, args: tuple):
+        self.func = func
+        self.args = args
+        self.started = threading.Event()
+        self.started_at = 0.0
+
+    def __call__(self):
+        self.started_at = time.monotonic()
+        self.started.set()
+        return self.func(*self.args)
+
+
+def reciprocal_rank_fusion(ranked_lists: List[List[Dict]], k: int = RRF_K) -> List[Dict]:
+    """
+    Объединяет несколько ранжированных списков чанков (reciprocal rank fusion):
+    оценка чанка = сумма 1 / (k + место) по всем спискам, где он встретился.
     """
-    all_results: List[Dict] = []
+    fused: Dict[tuple, Dict] = {}
+    for results in ranked_lists:
+        for rank, result in enumerate(results, 1):
+            key = (result["document_id"], result["chunk_index"])
+            if key not in fused:
+                fused[key] = {**result, "relevance_score": 0.0}
+            fused[key]["relevance_score"] += 1 / (k + rank)
 
-    docs = get_user_documents(user_id)  # функция из db.py
-    for doc in docs:
-        filename = doc["filename"]
-        content = doc["content"] or ""
-        if not content:
-            continue
+    merged = sorted(fused.values(), key=lambda x: x["relevance_score"], reverse=True)
+    for result in merged:
+        result["relevance_score"] = round(result["relevance_score"], 4)
+    return merged
 
-        file_results = semantic_search(query, content, filename)
-        all_results.extend(file_results)
+
+def hybrid_user_hits(query: CompiledQuery, user_id: int) -> Tuple[List[Dict], bool]:
+    """
+    Гибридный поиск: по словам и по смыслу одновременно, результаты
+    объединяются через RRF. У каждой ветки свой бюджет времени, который
+    отсчитывается с момента, когда поток взял ветку в работу (а не с
+    постановки в очередь); ждать потока ветка тоже может не дольше бюджета.
+    Если ветка не успела или упала, ответ строится по тем, что успели.
+    Возвращает (находки, неполный ли поиск) - неполный результат не стоит кэшировать.
+    """
+    branches = {"lexical": (lexical_user_hits, (query, user_id, HYBRID_CANDIDATES), LEXICAL_BUDGET_SEC)}
+    if embeddings_available():
+        branches["dense"] = (dense_search, (query, user_id, HYBRID_CANDIDATES), DENSE_BUDGET_SEC)
+
+    submitted = time.monotonic()
+    running = {}
+    for name, (func, args, budget) in branches.items():
+        branch = _Branch(func, args)
+        running[name] = (branch, _branch_pools[name].submit(branch), budget)
+
+    ranked_lists = []
+    degraded = False
+    for name, (branch, future, budget) in running.items():
+        try:
+            if not branch.started.wait(max(0.0, budget - (time.monotonic() - submitted))) and future.cancel():
+                print(f"Поиск ({name}) не дождался свободного потока за {budget} с, пропускаем")
+                degraded = True
+                continue
+            remaining = budget - (time.monotonic() - branch.started_at)
+            ranked_lists.append(future.result(timeout=max(0.0, remaining))[:HYBRID_CANDIDATES])
+        except FutureTimeoutError:
+            # Поток досчитает ветку сам (например, догрузит корпус в кэш) - но без нас
+            print(f"Поиск ({name}) не уложился в {budget} с, пропускаем")
+            degraded = True
+        except Exception as e:
+            print(f"Ошибка поиска ({name}): {e}")
+            degraded = True
+
+    return reciprocal_rank_fusion(ranked_lists), degraded
+
+
+def search_in_user_storage(query: str, user_id: int) -> Tuple[str, bool]:
+    """
+    Поиск информации в загруженных пользователем документах.
+    Теперь user_id - число!
+    Способ поиска задается RETRIEVAL_MODE в config.py.
+    Возвращает (текст для промпта, полный ли поиск): False - ничего не
+    найдено или часть гибридного поиска не успела.
+    """
+    compiled = compile_query(query)
+    degraded = False
+    if RETRIEVAL_MODE == "hybrid":
+        all_results, degraded = hybrid_user_hits(compiled, user_id)
+    elif RETRIEVAL_MODE == "dense" and embeddings_available():
+        all_results = dense_search(compiled, user_id, CONTEXT_CANDIDATES)
+    else:
+        all_results = lexical_user_hits(compiled, user_id)
 
     if not all_results:
-        return f"ИНФОРМАЦИЯ: {MESSAGES['no_info']}"
+        return f"ИНФОРМАЦИЯ: {MESSAGES['no_info']}", False
 
-    all_results.sort(key=lambda x: x["relevance_score"], reverse=True)
-    top_results = all_results[:MAX_SEARCH_RESULTS]
+    # Тексты чанков с соседями достаем только для лучших кандидатов:
+    # из кэша корпуса, если он там есть, иначе из БД
+    store = corpus_cache.peek(user_id) or document_chunk_store
+    passages = pack_context(all_results[:CONTEXT_CANDIDATES], store)
+    return format_passages(passages), bool(passages) and not degraded
 
-    structured_results = []
-    for i, result in enumerate(top_results, 1):
-        structured_result = f"""
-РЕЗУЛЬТАТ {i}:
-Файл: {result['filename']}
-Релевантность: {result['relevance_score']}
----
-{result['context']}
----"""
-        structured_results.append(structured_result)
-    
-    return "\n".join(structured_results)
+
+def format_source(result: Dict) -> str:
+    """Имя файла для строки "Файл:" (и списка источников), для PDF - со страницей"""
+    if result.get("page"):
+        return f"{result['filename']}, стр. {result['page']}"
+    return result["filename"]
 
 
 def create_agent_model():
@@ -113,6 +258,11 @@ def create_agent_model():
     return model
 
 
+# Так начинается ответ, если модель не ответила (такие ответы не кэшируются,
+# как и ответы по неполному или пустому поиску)
+GENERATION_ERROR = "Ошибка при генерации ответа"
+
+
 def analyze_and_synthesize(question: str, search_results: str, model):
     """Анализирует результаты поиска и синтезирует ответ"""
     
@@ -132,43 +282,147 @@ def analyze_and_synthesize(question: str, search_results: str, model):
         else:
             response_text = str(response)
     except Exception as e:
-        response_text = f"Ошибка при генерации ответа: {str(e)}"
+        response_text = f"{GENERATION_ERROR}: {str(e)}"
     
     return response_text
 
 
-def process_question(question: str, model, user_id: str = None) -> ResearchReport:
+def retrieve_for_question(question: str, user_id: str = None) -> Tuple[str, bool]:
     """
-    Обрабатывает вопрос для конкретного пользователя.
+    Поиск материала для ответа.
     Если user_id не указан или "default" - ищет по файлам.
+    Возвращает (текст для промпта, полный ли поиск) - как search_in_user_storage.
     """
     if user_id and user_id != "default":
         # Ищем в документах пользователя (теперь user_id может быть строкой или числом)
         # Преобразуем в число, если это строка
         try:
             user_id_int = int(user_id) if isinstance(user_id, str) else user_id
-            search_results = search_in_user_storage(question, user_id_int)
+            return search_in_user_storage(question, user_id_int)
         except (ValueError, TypeError):
             # Если не получилось преобразовать - ищем по файлам
-            search_results = search_in_notes.invoke(question)
-    else:
-        # Старое поведение - поиск по файлам
-        search_results = search_in_notes.invoke(question)
+            return search_notes(question)
+    # Старое поведение - поиск по файлам
+    return search_notes(question)
+
+
+def lookup_cached_answer(question: str, user_id: str = None) -> Tuple[str, str, Optional[ResearchReport]]:
+    """
+    Ищет готовый ответ в кэше.
+    Возвращает (ключ пользователя, версия корпуса, отчет или None) -
+    ключ и версию нужно передать в answer_cache.put после генерации ответа.
+    """
+    user_key, version = "notes", None
+    if user_id and user_id != "default":
+        try:
+            user_id_int = int(user_id) if isinstance(user_id, str) else user_id
+            user_key, version = str(user_id_int), answer_cache.version(user_id_int)
+        except (ValueError, TypeError):
+            pass
+    if version is None:
+        # Версия заметок - по содержимому папки, поэтому индекс должен быть свежим
+        notes_index.ensure_ready()
+        version = notes_index.version
+    return user_key, version, answer_cache.get(user_key, question, version)
+
+
+def process_question(question: str, model, user_id: str = None) -> ResearchReport:
+    """
+    Обрабатывает вопрос для конкретного пользователя.
+    Если user_id не указан или "default" - ищет по файлам.
+    Повторный вопрос по тем же документам отвечается из кэша.
+    Синхронный путь для консольного режима - модель вызывается напрямую,
+    мимо llm_scheduler (на сервере вопросы идут через astream_question).
+    """
+    user_key, version, cached = lookup_cached_answer(question, user_id)
+    if cached is not None:
+        return cached
+
+    search_results, complete = retrieve_for_question(question, user_id)
 
     response = analyze_and_synthesize(question, search_results, model)
     sources = extract_sources_from_results(search_results)
 
-    return ResearchReport(
+    report = ResearchReport(
         topic=question,
         answer=response,
         sources=sources
     )
+    # Кэшируем только ответ по полному поиску: "не найдено" или ответ без
+    # не успевшей ветки в следующий раз может получиться лучше
+    if complete and not response.startswith(GENERATION_ERROR):
+        answer_cache.put(user_key, question, version, report)
+    return report
+
+
+async def astream_answer(question: str, search_results: str, model) -> AsyncIterator[str]:
+    """То же, что analyze_and_synthesize, но ответ модели отдается по кускам (astream)"""
+    prompt = SEARCH_AGENT_PROMPT.format(
+        question=question,
+        search_results=search_results
+    )
+
+    try:
+        async for chunk in model.astream(prompt):
+            text = chunk.content if hasattr(chunk, 'content') else str(chunk)
+            if text:
+                yield text
+    except Exception as e:
+        yield f"{GENERATION_ERROR}: {str(e)}"
+
+
+async def astream_question(
+    question: str,
+    model,
+    on_token: Callable[[str], Awaitable[None]],
+    user_id: str = None,
+    on_queue: Optional[Callable[[int], Awaitable[None]]] = None,
+) -> ResearchReport:
+    """
+    Асинхронная версия process_question для сервера.
+    Поиск выполняется в пуле потоков, ответ модели приходит по кускам,
+    и каждый кусок сразу передается в on_token - пользователь видит
+    начало ответа, не дожидаясь конца генерации.
+    Ответ из кэша отправляется одним куском, без поиска и обращения к модели.
+    Вызов модели идет через общий планировщик (llm_scheduler): пока вопрос
+    ждет в очереди, его место передается в on_queue.
+    Возвращает полный отчет (ответ целиком и источники).
+    Если у пользователя слишком много вопросов в очереди - SchedulerBusy.
+    """
+    user_key, version, cached = await asyncio.to_thread(lookup_cached_answer, question, user_id)
+    if cached is not None:
+        await on_token(cached.answer)
+        return cached
+
+    search_results, complete = await asyncio.to_thread(retrieve_for_question, question, user_id)
+
+    # Токены считаются тем же счетчиком, что и бюджет контекста (в потоке - токенизатор не быстрый)
+    cost = await asyncio.to_thread(count_tokens, question + search_results) + LLM_ANSWER_TOKENS_ESTIMATE
+    parts = []
+    async with llm_scheduler.slot(user_key, cost, on_queue):
+        async for text in astream_answer(question, search_results, model):
+            parts.append(text)
+            await on_token(text)
+
+    report = ResearchReport(
+        topic=question,
+        answer="".join(parts),
+        sources=extract_sources_from_results(search_results)
+    )
+    if complete and not report.answer.startswith(GENERATION_ERROR):
+        await asyncio.to_thread(answer_cache.put, user_key, question, version, report)
+    return report
 
 def run_agent():
     """Запускает основной цикл агента"""
     model = create_agent_model()
     if not model:
         return
+
+    if NOTES_WATCH:
+        notes_index.start_watcher()
+    # В консоли вопросы идут по одному - токенизатор загружаем сразу
+    load_tokenizer()
     
     print(MESSAGES["welcome"])
     print("\n" + MESSAGES["features"])
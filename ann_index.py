@@ -0,0 +1,180 @@
+# Приближенный поиск ближайших соседей (IVF) для эмбеддингов чанков
+from typing import List, Optional, Tuple
+
+import numpy as np
+
+from config import ANN_NPROBE, ANN_MIN_TRAIN, ANN_TRAIN_SAMPLE, ANN_KMEANS_ITERS, ANN_RETRAIN_GROWTH
+
+
+class IVFIndex:
+    """
+    Инвертированный индекс по кластерам (IVF) для нормированных векторов.
+
+    Векторы раскладываются по спискам ближайших центроидов (k-means по
+    косинусной близости). При поиске просматриваются только nprobe самых
+    близких к вопросу списков: больше nprobe - выше полнота, но медленнее.
+
+    Пока векторов меньше ANN_MIN_TRAIN, индекс не обучен и ищет точным
+    перебором. Удаление помечает id как удаленные (tombstone), физически
+    они вычищаются при уплотнении.
+    """
+
+    def __init__(self, dim: int, nprobe: int = ANN_NPROBE):
+        self.dim = dim
+        self.nprobe = nprobe
+        self.centroids: Optional[np.ndarray] = None
+        self.trained_size = 0
+
+        # Пока индекс не обучен - одно плоское хранилище
+        self.flat_ids = np.zeros(0, dtype=np.int64)
+        self.flat_vecs = np.zeros((0, dim), dtype=np.float32)
+
+        # После обучения - списки по кластерам (векторы в float16 для экономии памяти)
+        self.list_ids: List[np.ndarray] = []
+        self.list_vecs: List[np.ndarray] = []
+
+        self.deleted = set()
+        self._deleted_array = np.zeros(0, dtype=np.int64)
+        self.stored = 0
+
+    @property
+    def size(self) -> int:
+        """Число живых (не удаленных) векторов"""
+        return self.stored - len(self.deleted)
+
+    @property
+    def nbytes(self) -> int:
+        """Память под векторы и id (центроиды, плоское хранилище, списки)"""
+        size = self.flat_ids.nbytes + self.flat_vecs.nbytes + self._deleted_array.nbytes
+        if self.centroids is not None:
+            size += self.centroids.nbytes
+        size += sum(ids.nbytes for ids in self.list_ids) + sum(vecs.nbytes for vecs in self.list_vecs)
+        return size
+
+    def add(self, ids: np.ndarray, vectors: np.ndarray) -> None:
+        """Добавляет векторы с их id (id чанков)"""
+        ids = np.asarray(ids, dtype=np.int64)
+        vectors = np.asarray(vectors, dtype=np.float32)
+        if not len(ids):
+            return
+        self.stored += len(ids)
+
+        if self.centroids is None:
+            self.flat_ids = np.concatenate([self.flat_ids, ids])
+            self.flat_vecs = np.vstack([self.flat_vecs, vectors])
+            if self.size >= ANN_MIN_TRAIN:
+                self._train(*self._live_vectors())
+            return
+
+        if self.size > self.trained_size * ANN_RETRAIN_GROWTH:
+            # Корпус сильно вырос - старые кластеры уже плохо его описывают
+            all_ids, all_vecs = self._live_vectors()
+            self._train(np.concatenate([all_ids, ids]), np.vstack([all_vecs, vectors]))
+            return
+
+        self._assign(ids, vectors)
+
+    def remove(self, ids) -> None:
+        """Помечает векторы как удаленные"""
+        self.deleted.update(int(i) for i in ids)
+        self._deleted_array = np.fromiter(self.deleted, dtype=np.int64, count=len(self.deleted))
+        if len(self.deleted) > self.stored / 4:
+            self._compact()
+
+    def search(
+        self,
+        query: np.ndarray,
+        k: int,
+        nprobe: Optional[int] = None,
+        exact: bool = False,
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Возвращает (id, близость) k ближайших к query векторов.
+        exact=True - точный перебор всех векторов (без кластеров).
+        """
+        query = np.asarray(query, dtype=np.float32)
+
+        if self.centroids is None:
+            ids, vecs = self.flat_ids, self.flat_vecs
+        elif exact:
+            ids, vecs = self._live_vectors()
+        else:
+            nprobe = min(nprobe or self.nprobe, len(self.centroids))
+            closest = np.argpartition(-(self.centroids @ query), nprobe - 1)[:nprobe]
+            ids = np.concatenate([self.list_ids[c] for c in closest])
+            vecs = np.vstack([self.list_vecs[c] for c in closest]).astype(np.float32)
+
+        if not len(ids):
+            return ids, np.zeros(0, dtype=np.float32)
+
+        scores = vecs @ query
+        if len(self._deleted_array):
+            scores[np.isin(ids, self._deleted_array)] = -np.inf
+
+        k = min(k, len(scores))
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        top = top[np.isfinite(scores[top])]
+        return ids[top], scores[top]
+
+    def _live_vectors(self) -> Tuple[np.ndarray, np.ndarray]:
+        """Все неудаленные векторы (float32)"""
+        if self.centroids is None:
+            ids, vecs = self.flat_ids, self.flat_vecs
+        else:
+            ids = np.concatenate(self.list_ids)
+            vecs = np.vstack(self.list_vecs).astype(np.float32)
+        if len(self._deleted_array):
+            keep = ~np.isin(ids, self._deleted_array)
+            ids, vecs = ids[keep], vecs[keep]
+        return ids, vecs
+
+    def _train(self, ids: np.ndarray, vectors: np.ndarray) -> None:
+        """Строит кластеры k-means (сферический) и раскладывает по ним все векторы"""
+        n_lists = max(1, int(np.sqrt(len(ids))))
+        rng = np.random.default_rng(0)
+        sample = vectors
+        if len(vectors) > ANN_TRAIN_SAMPLE:
+            sample = vectors[rng.choice(len(vectors), ANN_TRAIN_SAMPLE, replace=False)]
+
+        centroids = sample[rng.choice(len(sample), n_lists, replace=False)].copy()
+        for _ in range(ANN_KMEANS_ITERS):
+            labels = np.argmax(sample @ centroids.T, axis=1)
+            for c in range(n_lists):
+                members = sample[labels == c]
+                if len(members):
+                    centroid = members.sum(axis=0)
+                    centroids[c] = centroid / max(np.linalg.norm(centroid), 1e-12)
+
+        self.centroids = centroids
+        self.list_ids = [np.zeros(0, dtype=np.int64) for _ in range(n_lists)]
+        self.list_vecs = [np.zeros((0, self.dim), dtype=np.float16) for _ in range(n_lists)]
+        self.flat_ids = np.zeros(0, dtype=np.int64)
+        self.flat_vecs = np.zeros((0, self.dim), dtype=np.float32)
+        self.deleted = set()
+        self._deleted_array = np.zeros(0, dtype=np.int64)
+        self.stored = len(ids)
+        self.trained_size = len(ids)
+        self._assign(ids, vectors)
+
+    def _assign(self, ids: np.ndarray, vectors: np.ndarray) -> None:
+        """Раскладывает векторы по ближайшим центроидам"""
+        labels = np.argmax(vectors @ self.centroids.T, axis=1)
+        for c in np.unique(labels):
+            members = labels == c
+            self.list_ids[c] = np.concatenate([self.list_ids[c], ids[members]])
+            self.list_vecs[c] = np.vstack([self.list_vecs[c], vectors[members].astype(np.float16)])
+
+    def _compact(self) -> None:
+        """Физически удаляет помеченные векторы"""
+        if self.centroids is None:
+            self.flat_ids, self.flat_vecs = self._live_vectors()
+        else:
+            dead = self._deleted_array
+            for c in range(len(self.list_ids)):
+                keep = ~np.isin(self.list_ids[c], dead)
+                self.list_ids[c] = self.list_ids[c][keep]
+                self.list_vecs[c] = self.list_vecs[c][keep]
+        self.stored -= len(self.deleted)
+        self.deleted = set()
+        self._deleted_array = np.zeros(0, dtype=np.int64)
@@ -0,0 +1,226 @@
+# Кэш готовых ответов (ResearchReport) на повторяющиеся вопросы
+import re
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, Optional
+
+import numpy as np
+
+from config import (
+    ANSWER_CACHE_MAX_ENTRIES, ANSWER_CACHE_TTL_SEC, ANSWER_CACHE_PATH,
+    ANSWER_CACHE_SEMANTIC, ANSWER_CACHE_MIN_SIMILARITY,
+)
+from schemas import ResearchReport
+from embeddings import encode
+import db
+
+
+def normalize_question(question: str) -> str:
+    """Приводит вопрос к виду для сравнения: регистр, ё, пунктуация и пробелы не важны"""
+    normalized = question.lower().replace("ё", "е")
+    normalized = re.sub(r"[^\w\s]", " ", normalized)
+    return " ".join(normalized.split())
+
+
+class AnswerCache:
+    """
+    Кэш ответов с ключом (пользователь, нормализованный вопрос, версия корпуса).
+
+    Версия корпуса пользователя растет при каждом изменении его документов
+    (через db.add_corpus_listener), поэтому ответ, построенный по старым
+    документам, больше не находится; такие записи сразу удаляются.
+    Записи живут ANSWER_CACHE_TTL_SEC, при переполнении вытесняются давно
+    не использованные. Если задан ANSWER_CACHE_PATH - кэш и версии хранятся
+    еще и в SQLite и переживают перезапуск.
+
+    В режиме semantic похожий вопрос (косинусная близость эмбеддингов не ниже
+    min_similarity) тоже считается попаданием.
+    """
+
+    def __init__(
+        self,
+        max_entries: int,
+        ttl_sec: float,
+        path: Optional[str] = None,
+        semantic: bool = False,
+        min_similarity: float = 0.95,
+    ):
+        self.max_entries = max_entries
+        self.ttl_sec = ttl_sec
+        self.path = path
+        self.semantic = semantic
+        self.min_similarity = min_similarity
+        # (user_key, вопрос, версия) -> (отчет, время создания, эмбеддинг вопроса или None)
+        self._entries: "OrderedDict[tuple, tuple]" = OrderedDict()
+        self._versions: Dict[int, int] = {}
+        self._loaded = False
+        self._lock = threading.Lock()
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.path)
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS answers (
+                user_key TEXT NOT NULL,
+                question TEXT NOT NULL,
+                version TEXT NOT NULL,
+                report TEXT NOT NULL,
+                created_at REAL NOT NULL,
+                embedding BLOB,
+                PRIMARY KEY (user_key, question, version)
+            )
+        """)
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS corpus_versions (
+                user_id INTEGER PRIMARY KEY,
+                version INTEGER NOT NULL
+            )
+        """)
+        return conn
+
+    def _load(self) -> None:
+        """Поднимает версии и неустаревшие ответы с диска (вызывается под self._lock)"""
+        self._loaded = True
+        if not self.path:
+            return
+        conn = self._connect()
+        try:
+            conn.execute("DELETE FROM answers WHERE created_at < ?", (time.time() - self.ttl_sec,))
+            conn.commit()
+            for user_id, version in conn.execute("SELECT user_id, version FROM corpus_versions"):
+                self._versions[user_id] = version
+            rows = conn.execute(
+                """
+                SELECT user_key, question, version, report, created_at, embedding
+                FROM answers ORDER BY created_at DESC LIMIT ?
+                """,
+                (self.max_entries,),
+            ).fetchall()
+        finally:
+            conn.close()
+
+        for user_key, question, version, report, created_at, blob in reversed(rows):
+            vector = np.frombuffer(blob, dtype=np.float32) if blob else None
+            self._entries[(user_key, question, version)] = (
+                ResearchReport.model_validate_json(report), created_at, vector
+            )
+
+    def version(self, user_id: int) -> str:
+        """Текущая версия корпуса пользователя"""
+        with self._lock:
+            if not self._loaded:
+                self._load()
+            return str(self._versions.get(user_id, 0))
+
+    def bump_version(self, user_id: int) -> None:
+        """Документы пользователя изменились: старые ответы больше не годятся"""
+        with self._lock:
+            if not self._loaded:
+                self._load()
+            version = self._versions.get(user_id, 0) + 1
+            self._versions[user_id] = version
+            user_key = str(user_id)
+            for key in [key for key in self._entries if key[0] == user_key]:
+                del self._entries[key]
+
+        if self.path:
+            conn = self._connect()
+            try:
+                conn.execute(
+                    "INSERT OR REPLACE INTO corpus_versions (user_id, version) VALUES (?, ?)",
+                    (user_id, version),
+                )
+                conn.execute("DELETE FROM answers WHERE user_key = ?", (user_key,))
+                conn.commit()
+            finally:
+                conn.close()
+
+    def get(self, user_key: str, question: str, version: str) -> Optional[ResearchReport]:
+        """Готовый ответ на этот (или, в режиме semantic, очень похожий) вопрос"""
+        normalized = normalize_question(question)
+        now = time.time()
+        with self._lock:
+            if not self._loaded:
+                self._load()
+            key = (user_key, normalized, version)
+            entry = self._entries.get(key)
+            if entry is not None and now - entry[1] <= self.ttl_sec:
+                self._entries.move_to_end(key)
+                return entry[0]
+            candidates = [
+                (key, entry) for key, entry in self._entries.items()
+                if key[0] == user_key and key[2] == version and entry[2] is not None
+                and now - entry[1] <= self.ttl_sec
+            ] if self.semantic else []
+
+        if not candidates:
+            return None
+        query = encode([normalized])
+        if query is None:
+            return None
+
+        similarities = np.vstack([entry[2] for _, entry in candidates]) @ query[0]
+        best = int(np.argmax(similarities))
+        if similarities[best] < self.min_similarity:
+            return None
+        key, entry = candidates[best]
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+        return entry[0]
+
+    def put(self, user_key: str, question: str, version: str, report: ResearchReport) -> None:
+        """Запоминает ответ"""
+        normalized = normalize_question(question)
+        vector = None
+        if self.semantic:
+            encoded = encode([normalized])
+            vector = encoded[0] if encoded is not None else None
+        created_at = time.time()
+
+        with self._lock:
+            if not self._loaded:
+                self._load()
+            # Документы изменились, пока готовился ответ - он уже устарел
+            if user_key.isdigit() and version != str(self._versions.get(int(user_key), 0)):
+                return
+            key = (user_key, normalized, version)
+            self._entries[key] = (report, created_at, vector)
+            self._entries.move_to_end(key)
+            evicted = []
+            while len(self._entries) > self.max_entries:
+                evicted.append(self._entries.popitem(last=False)[0])
+
+        if self.path:
+            conn = self._connect()
+            try:
+                conn.execute(
+                    """
+                    INSERT OR REPLACE INTO answers
+                        (user_key, question, version, report, created_at, embedding)
+                    VALUES (?, ?, ?, ?, ?, ?)
+                    """,
+                    (
+                        user_key, normalized, version, report.model_dump_json(), created_at,
+                        vector.astype(np.float32).tobytes() if vector is not None else None,
+                    ),
+                )
+                conn.executemany(
+                    "DELETE FROM answers WHERE user_key = ? AND question = ? AND version = ?",
+                    evicted,
+                )
+                conn.commit()
+            finally:
+                conn.close()
+
+
+answer_cache = AnswerCache(
+    ANSWER_CACHE_MAX_ENTRIES,
+    ANSWER_CACHE_TTL_SEC,
+    path=ANSWER_CACHE_PATH,
+    semantic=ANSWER_CACHE_SEMANTIC,
+    min_similarity=ANSWER_CACHE_MIN_SIMILARITY,
+)
+
+db.add_corpus_listener(lambda event, user_id, document_id: answer_cache.bump_version(user_id))
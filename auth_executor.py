@@ -0,0 +1,54 @@
+# Хэширование паролей в отдельных потоках: вход и регистрация не стопорят цикл событий (чат)
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable
+
+from config import AUTH_HASH_WORKERS, AUTH_HASH_MAX_PENDING
+
+
+class AuthBusy(Exception):
+    """Слишком много входов/регистраций ждут хэширования пароля"""
+
+
+class AuthExecutor:
+    """
+    Ограниченный пул потоков для PBKDF2 (db.authenticate_user, db.create_user).
+
+    PBKDF2 со 100 000 итераций - десятки миллисекунд чистого CPU; вызванный
+    прямо в async-обработчике, он на это время останавливает весь сервер,
+    включая потоковые ответы чата. hashlib.pbkdf2_hmac отпускает GIL, поэтому
+    в потоках хэширование идет параллельно с циклом событий.
+
+    Потоков немного (workers), чтобы волна входов не заняла все ядра.
+    Ждущих задач не больше max_pending: сверх этого - сразу AuthBusy, а не
+    очередь, которая растет быстрее, чем разбирается.
+    """
+
+    def __init__(self, workers: int = AUTH_HASH_WORKERS, max_pending: int = AUTH_HASH_MAX_PENDING):
+        self.max_pending = max_pending
+        self.pending = 0
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="auth-hash")
+
+    def _release(self, _future=None) -> None:
+        with self._lock:
+            self.pending -= 1
+
+    async def run(self, func: Callable[..., Any], *args) -> Any:
+        """Выполняет func(*args) в пуле; если пул перегружен - AuthBusy"""
+        with self._lock:
+            if self.pending >= self.max_pending:
+                raise AuthBusy("Сервер перегружен входами, попробуйте через несколько секунд")
+            self.pending += 1
+        try:
+            future = self._executor.submit(func, *args)
+        except BaseException:
+            self._release()
+            raise
+        # Счетчик уменьшается, когда задача закончилась, даже если запрос уже отменен
+        future.add_done_callback(self._release)
+        return await asyncio.wrap_future(future)
+
+
+auth_executor = AuthExecutor()
@@ -0,0 +1,76 @@
+# Микробенчмарк входа: пропускная способность /auth/login и задержка "чата" во время волны входов
+#
+# Запуск: python bench_auth.py [число одновременных входов]
+# Работает на копии data.db во временной папке - рабочая база не меняется.
+import asyncio
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import db
+
+
+async def chat_ticker(stop: asyncio.Event, lags: list) -> None:
+    """Изображает чат: каждые 5 мс хочет отправить токен ответа; копит опоздания (мс)"""
+    while not stop.is_set():
+        started = time.perf_counter()
+        await asyncio.sleep(0.005)
+        lags.append((time.perf_counter() - started - 0.005) * 1000)
+
+
+async def run(mode: str, logins: int) -> None:
+    import main
+    from schemas import UserLogin
+
+    async def login_once():
+        if mode == "inline":
+            # Как было до auth_executor: PBKDF2 прямо в обработчике
+            user = db.authenticate_user("bench", "secret")
+            db.create_session(user["id"])
+            await asyncio.sleep(0)
+        else:
+            await main.login(UserLogin(username="bench", password="secret"))
+
+    stop = asyncio.Event()
+    lags: list = []
+    ticker = asyncio.create_task(chat_ticker(stop, lags))
+    await asyncio.sleep(0.05)
+
+    started = time.perf_counter()
+    results = await asyncio.gather(*(login_once() for _ in range(logins)), return_exceptions=True)
+    elapsed = time.perf_counter() - started
+    stop.set()
+    await ticker
+
+    busy = sum(getattr(result, "status_code", None) == 503 for result in results)
+    done = logins - busy
+    lags.sort()
+    print(
+        f"{mode:8s} входов/с: {done / elapsed:6.1f}  отказов 503: {busy:3d}  "
+        f"задержка чата p99: {lags[int(len(lags) * 0.99)]:7.1f} мс  max: {lags[-1]:7.1f} мс"
+    )
+
+
+def main() -> None:
+    logins = int(sys.argv[1]) if len(sys.argv) > 1 else 32
+    workdir = tempfile.mkdtemp()
+    try:
+        db.DB_PATH = os.path.join(workdir, "data.db")
+        shutil.copy("data.db", db.DB_PATH)
+        db.init_db()
+        try:
+            db.create_user("bench", "bench@example.com", "secret")
+        except ValueError:
+            pass
+
+        print(f"{logins} одновременных входов, PBKDF2 {db.PASSWORD_HASH_ITERATIONS} итераций")
+        asyncio.run(run("inline", logins))
+        asyncio.run(run("executor", logins))
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,319 @@
+# Фильтры Блума по словам документов: какие документы и блоки чанков заведомо не содержат слов запроса
+import hashlib
+import math
+import struct
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional, Set, Tuple
+
+import numpy as np
+
+from config import (
+    BLOOM_BLOCK_CHUNKS, BLOOM_FALSE_POSITIVE, BLOOM_MIN_PREFIX, BLOOM_MAX_PREFIX, BLOOM_CACHE_MAX_BYTES,
+)
+from query import CompiledQuery, TOKEN_RE
+import db
+
+
+def _hash(key: str) -> int:
+    """Стабильный 64-битный хэш (встроенный hash() меняется от запуска к запуску)"""
+    return int.from_bytes(hashlib.blake2b(key.encode("utf-8"), digest_size=8).digest(), "little")
+
+
+def _split(hashes: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """Два независимых хэша из одного 64-битного (для двойного хэширования)"""
+    return hashes & np.uint64(0xFFFFFFFF), (hashes >> np.uint64(32)) | np.uint64(1)
+
+
+_BIT_MASKS = np.array([1 << bit for bit in range(8)], dtype=np.uint8)
+
+
+class BloomFilter:
+    """
+    Фильтр Блума: отвечает "слова точно нет" или "слово, возможно, есть"
+    (ложноположительные ответы - с вероятностью около BLOOM_FALSE_POSITIVE).
+    Позиции битов - двойное хэширование: h1 + i * h2.
+    """
+
+    def __init__(self, num_bits: int, num_hashes: int, bits: Optional[np.ndarray] = None):
+        self.num_bits = num_bits
+        self.num_hashes = num_hashes
+        self.bits = bits if bits is not None else np.zeros(num_bits // 8, dtype=np.uint8)
+
+    @classmethod
+    def from_hashes(cls, hashes: np.ndarray, fp_rate: float = BLOOM_FALSE_POSITIVE) -> "BloomFilter":
+        """Фильтр под заданное число ключей (по их хэшам _hash)"""
+        count = max(len(hashes), 1)
+        num_bits = max(64, math.ceil(-count * math.log(fp_rate) / math.log(2) ** 2))
+        num_bits = -(-num_bits // 8) * 8
+        num_hashes = min(16, max(1, round(num_bits / count * math.log(2))))
+        bloom = cls(num_bits, num_hashes)
+        if len(hashes):
+            positions = bloom._positions(hashes)
+            np.bitwise_or.at(bloom.bits, positions >> np.uint64(3), _BIT_MASKS[positions & np.uint64(7)])
+        return bloom
+
+    def _positions(self, hashes: np.ndarray) -> np.ndarray:
+        h1, h2 = _split(hashes)
+        steps = np.arange(self.num_hashes, dtype=np.uint64)
+        return ((h1[:, None] + steps[None, :] * h2[:, None]) % np.uint64(self.num_bits)).ravel()
+
+    def to_bytes(self) -> bytes:
+        return struct.pack("<II", self.num_bits, self.num_hashes) + self.bits.tobytes()
+
+    @classmethod
+    def from_bytes(cls, data: bytes, offset: int = 0) -> Tuple["BloomFilter", int]:
+        """Читает фильтр из data начиная с offset; возвращает (фильтр, offset после него)"""
+        num_bits, num_hashes = struct.unpack_from("<II", data, offset)
+        offset += 8
+        bits = np.frombuffer(data, dtype=np.uint8, count=num_bits // 8, offset=offset)
+        return cls(num_bits, num_hashes, bits), offset + num_bits // 8
+
+
+def text_keys(text: str) -> Set[str]:
+    """
+    Ключи фильтра для текста: префиксы слов длиной от BLOOM_MIN_PREFIX
+    до BLOOM_MAX_PREFIX. Слова запроса ищутся как префиксы ("мартин" находит
+    "мартина"), поэтому в фильтр кладутся префиксы, а не сами слова.
+    """
+    keys = set()
+    for token in set(TOKEN_RE.findall(text.lower())):
+        for length in range(BLOOM_MIN_PREFIX, min(len(token), BLOOM_MAX_PREFIX) + 1):
+            keys.add(token[:length])
+    return keys
+
+
+def query_keys(query: CompiledQuery) -> Optional[List[str]]:
+    """
+    Ключи фильтра для слов запроса, влияющих на оценку (ключевые слова и имена).
+    None - среди них есть слово короче BLOOM_MIN_PREFIX, его фильтр не отсеет.
+    """
+    keys = []
+    for term in dict.fromkeys(query.terms + query.proper_nouns):
+        if len(term) < BLOOM_MIN_PREFIX:
+            return None
+        keys.append(term[:BLOOM_MAX_PREFIX])
+    return keys
+
+
+class DocumentBloom:
+    """Фильтр всего документа и фильтры блоков по BLOOM_BLOCK_CHUNKS чанков подряд"""
+
+    def __init__(self, chunk_count: int, block_chunks: int, document: BloomFilter, blocks: List[BloomFilter]):
+        self.chunk_count = chunk_count
+        self.block_chunks = block_chunks
+        self.document = document
+        self.blocks = blocks
+
+    @classmethod
+    def build(cls, chunks: List[str], block_chunks: int = BLOOM_BLOCK_CHUNKS) -> "DocumentBloom":
+        """Строит фильтры по чанкам документа (при загрузке, в потоке)"""
+        hashes: Dict[str, int] = {}
+        blocks = []
+        for start in range(0, len(chunks), block_chunks):
+            keys = set()
+            for chunk in chunks[start:start + block_chunks]:
+                keys |= text_keys(chunk)
+            for key in keys:
+                if key not in hashes:
+                    hashes[key] = _hash(key)
+            blocks.append(BloomFilter.from_hashes(np.fromiter((hashes[key] for key in keys), dtype=np.uint64)))
+        document = BloomFilter.from_hashes(np.fromiter(hashes.values(), dtype=np.uint64))
+        return cls(len(chunks), block_chunks, document, blocks)
+
+    def to_bytes(self) -> bytes:
+        parts = [struct.pack("<III", self.chunk_count, self.block_chunks, len(self.blocks)), self.document.to_bytes()]
+        parts.extend(block.to_bytes() for block in self.blocks)
+        return b"".join(parts)
+
+    @classmethod
+    def from_bytes(cls, data: bytes) -> "DocumentBloom":
+        chunk_count, block_chunks, block_count = struct.unpack_from("<III", data, 0)
+        document, offset = BloomFilter.from_bytes(data, 12)
+        blocks = []
+        for _ in range(block_count):
+            block, offset = BloomFilter.from_bytes(data, offset)
+            blocks.append(block)
+        return cls(chunk_count, block_chunks, document, blocks)
+
+
+class UserBlooms:
+    """
+    Все фильтры одного пользователя, упакованные в общий массив битов:
+    проверка слов запроса по всем документам (а затем по всем блокам
+    подходящих документов) - одна векторная операция, а не цикл по фильтрам.
+    Документы без фильтров (unfiltered: document_id -> число чанков)
+    отсеять нельзя - они всегда в кандидатах целиком.
+    """
+
+    def __init__(self, blooms: Dict[int, DocumentBloom], unfiltered: Optional[Dict[int, int]] = None):
+        self.unfiltered = unfiltered or {}
+        self.document_ids = list(blooms)
+        doc_filters = [bloom.document for bloom in blooms.values()]
+        block_filters = []
+        # Для каждого блока: номер документа в document_ids и диапазон чанков
+        self.block_owner, self.block_start, self.block_end = [], [], []
+        for number, bloom in enumerate(blooms.values()):
+            for block_number, block in enumerate(bloom.blocks):
+                start = block_number * bloom.block_chunks
+                block_filters.append(block)
+                self.block_owner.append(number)
+                self.block_start.append(start)
+                self.block_end.append(min(start + bloom.block_chunks, bloom.chunk_count))
+        self.block_owner = np.asarray(self.block_owner, dtype=np.int64)
+
+        filters = doc_filters + block_filters
+        self.doc_count = len(doc_filters)
+        self.bits = np.concatenate([f.bits for f in filters]) if filters else np.zeros(0, dtype=np.uint8)
+        self.sizes = np.asarray([f.num_bits for f in filters], dtype=np.uint64)
+        self.hash_counts = np.asarray([f.num_hashes for f in filters], dtype=np.uint64)
+        self.offsets = np.zeros(len(filters), dtype=np.uint64)
+        if filters:
+            np.cumsum(self.sizes[:-1], out=self.offsets[1:])
+        self.max_hashes = int(self.hash_counts.max()) if filters else 0
+
+    @property
+    def size_bytes(self) -> int:
+        """Примерный объем памяти: биты фильтров и описания блоков"""
+        arrays = (self.bits, self.sizes, self.hash_counts, self.offsets, self.block_owner)
+        return sum(array.nbytes for array in arrays) + 64 * (len(self.block_start) + len(self.document_ids))
+
+    def _match(self, filters: np.ndarray, key_hashes: np.ndarray) -> np.ndarray:
+        """Для каждого фильтра из filters: может ли в нем быть хоть один из ключей"""
+        h1, h2 = _split(key_hashes)
+        steps = np.arange(self.max_hashes, dtype=np.uint64)
+        # Оси: фильтр x ключ x номер хэш-функции
+        positions = (h1[None, :, None] + steps[None, None, :] * h2[None, :, None]) % self.sizes[filters, None, None]
+        positions += self.offsets[filters, None, None]
+        is_set = (self.bits[positions >> np.uint64(3)] & _BIT_MASKS[positions & np.uint64(7)]) != 0
+        # У фильтров с меньшим числом хэш-функций лишние проверки не считаются
+        is_set |= steps[None, None, :] >= self.hash_counts[filters, None, None]
+        return is_set.all(axis=2).any(axis=1)
+
+    def candidates(self, key_hashes: np.ndarray) -> Dict[int, List[Tuple[int, int]]]:
+        """document_id -> диапазоны чанков [start, end), где могут быть слова запроса"""
+        result: Dict[int, List[Tuple[int, int]]] = {
+            document_id: [(0, chunk_count)] for document_id, chunk_count in self.unfiltered.items()
+        }
+        documents = np.flatnonzero(self._match(np.arange(self.doc_count), key_hashes))
+        if not len(documents):
+            return result
+        blocks = np.flatnonzero(np.isin(self.block_owner, documents))
+        blocks = blocks[self._match(blocks + self.doc_count, key_hashes)]
+
+        for block in blocks:
+            ranges = result.setdefault(self.document_ids[self.block_owner[block]], [])
+            start, end = self.block_start[block], self.block_end[block]
+            # Соседние подходящие блоки склеиваем в один диапазон
+            if ranges and ranges[-1][1] == start:
+                ranges[-1] = (ranges[-1][0], end)
+            else:
+                ranges.append((start, end))
+        return result
+
+
+# Фоновое построение фильтров для документов, загруженных до их появления
+_backfill_pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix="bloom-backfill")
+
+
+class BloomCache:
+    """
+    LRU-кэш фильтров документов пользователей с ограничением по объему
+    памяти. Загружаются из БД при первом поиске пользователя. У старых
+    документов, загруженных до появления фильтров, фильтры строятся в фоне
+    (а пока такие документы просто не отсеиваются). Изменение документов
+    сбрасывает фильтры пользователя (через db.add_corpus_listener).
+    """
+
+    def __init__(self, max_bytes: int = BLOOM_CACHE_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.total_bytes = 0
+        self._entries: "OrderedDict[int, UserBlooms]" = OrderedDict()
+        # Счетчик изменений: не кладем в кэш фильтры, прочитанные до изменения.
+        # Хранится, только пока фильтры пользователя читаются (_loading - сколько чтений идет)
+        self._generations: Dict[int, int] = {}
+        self._loading: Dict[int, int] = {}
+        # Пользователи, для чьих документов сейчас строятся фильтры
+        self._backfilling: Set[int] = set()
+        self._lock = threading.Lock()
+
+    def get(self, user_id: int) -> UserBlooms:
+        """Фильтры документов пользователя"""
+        with self._lock:
+            blooms = self._entries.get(user_id)
+            if blooms is not None:
+                self._entries.move_to_end(user_id)
+                return blooms
+            generation = self._generations.setdefault(user_id, 0)
+            self._loading[user_id] = self._loading.get(user_id, 0) + 1
+
+        try:
+            blooms, unfiltered = {}, {}
+            for document_id, data, chunk_count in db.get_document_blooms(user_id):
+                if data is None:
+                    unfiltered[document_id] = chunk_count
+                else:
+                    blooms[document_id] = DocumentBloom.from_bytes(data)
+            blooms = UserBlooms(blooms, unfiltered)
+        finally:
+            with self._lock:
+                current = self._generations.get(user_id)
+                self._loading[user_id] -= 1
+                if not self._loading[user_id]:
+                    del self._loading[user_id]
+                    del self._generations[user_id]
+
+        with self._lock:
+            if current == generation and user_id not in self._entries:
+                self._entries[user_id] = blooms
+                self.total_bytes += blooms.size_bytes
+                self._evict()
+            if unfiltered and user_id not in self._backfilling:
+                self._backfilling.add(user_id)
+                _backfill_pool.submit(self._backfill, user_id, list(unfiltered))
+        return blooms
+
+    def _backfill(self, user_id: int, document_ids: List[int]) -> None:
+        """Строит и сохраняет фильтры старых документов, потом сбрасывает кэш пользователя"""
+        try:
+            for document_id in document_ids:
+                bloom = DocumentBloom.build(db.get_document_texts(document_id))
+                db.set_document_bloom(document_id, bloom.to_bytes())
+        except Exception as e:
+            print(f"Не удалось построить фильтры Блума для пользователя {user_id}: {e}")
+        finally:
+            with self._lock:
+                self._backfilling.discard(user_id)
+            self.invalidate(user_id)
+
+    def candidates(self, user_id: int, query: CompiledQuery) -> Optional[Dict[int, List[Tuple[int, int]]]]:
+        """
+        Где у пользователя могут найтись слова запроса: document_id -> диапазоны
+        чанков [start, end). Документов, где слов точно нет, в ответе нет.
+        None - отсеять ничего нельзя (в запросе слишком короткие слова).
+        """
+        keys = query_keys(query)
+        if keys is None:
+            return None
+        key_hashes = np.asarray([_hash(key) for key in keys], dtype=np.uint64)
+        return self.get(user_id).candidates(key_hashes)
+
+    def invalidate(self, user_id: int) -> None:
+        with self._lock:
+            if user_id in self._generations:
+                self._generations[user_id] += 1
+            blooms = self._entries.pop(user_id, None)
+            if blooms is not None:
+                self.total_bytes -= blooms.size_bytes
+
+    def _evict(self) -> None:
+        """Выбрасывает давно не использованные фильтры, пока не уложимся в бюджет"""
+        while self.total_bytes > self.max_bytes and len(self._entries) > 1:
+            _, blooms = self._entries.popitem(last=False)
+            self.total_bytes -= blooms.size_bytes
+
+
+bloom_cache = BloomCache()
+
+db.add_corpus_listener(lambda event, user_id, document_id: bloom_cache.invalidate(user_id))
@@ -0,0 +1,254 @@
+# Ранжирование чанков по BM25 (векторизовано через NumPy)
+import threading
+from bisect import bisect_left
+from collections import Counter
+from typing import List, Optional
+
+import numpy as np
+
+from config import BM25_K1, BM25_B, BIGRAM_BOOST, PROPER_NOUN_BOOST, FUZZY_MAX_EXPANSIONS
+from matcher import compile_matcher
+from query import CompiledQuery, TOKEN_RE
+from fuzzy import TrigramIndex, max_edits
+
+
+class BM25Index:
+    """
+    Индекс по набору чанков для ранжирования BM25.
+
+    Статистика корпуса хранится компактно, в виде "столбцов" матрицы
+    частот (CSC): для каждого слова словаря - номера чанков и сколько раз
+    слово в них встречается. Оценка всех чанков считается за один
+    векторный проход по постинг-листам слов запроса.
+    """
+
+    def __init__(self, chunks: List[str], k1: float = BM25_K1, b: float = BM25_B):
+        self.k1 = k1
+        self.b = b
+        self.size = len(chunks)
+        # Текст в нижнем регистре нужен для проверки биграмм
+        self.lowered = [chunk.lower() for chunk in chunks]
+
+        vocab = {}
+        rows, term_ids, tfs = [], [], []
+        lengths = np.zeros(self.size, dtype=np.float32)
+
+        for row, text in enumerate(self.lowered):
+            tokens = TOKEN_RE.findall(text)
+            lengths[row] = len(tokens)
+            for term, tf in Counter(tokens).items():
+                rows.append(row)
+                term_ids.append(vocab.setdefault(term, len(vocab)))
+                tfs.append(tf)
+
+        # Словарь сортируем, чтобы искать слова по префиксу через bisect
+        self.terms = sorted(vocab)
+        remap = np.empty(len(vocab), dtype=np.int32)
+        for new_id, term in enumerate(self.terms):
+            remap[vocab[term]] = new_id
+
+        term_ids = remap[np.asarray(term_ids, dtype=np.int32)] if term_ids else np.zeros(0, dtype=np.int32)
+        order = np.argsort(term_ids, kind="stable")
+
+        self.post_rows = np.asarray(rows, dtype=np.int32)[order]
+        self.post_tf = np.asarray(tfs, dtype=np.float32)[order]
+        self.term_ptr = np.zeros(len(self.terms) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(term_ids, minlength=len(self.terms)), out=self.term_ptr[1:])
+
+        self.chunk_len = lengths
+        self.avg_len = float(lengths.mean()) if self.size else 0.0
+        # Индекс триграмм словаря (build_trigrams) - обычно строится заранее, при загрузке
+        self._trigrams: Optional[TrigramIndex] = None
+        self._trigrams_lock = threading.Lock()
+
+    def _term_range(self, prefix: str) -> range:
+        """Номера слов словаря, начинающихся с prefix ("мартин" -> "мартина", ...)"""
+        start = bisect_left(self.terms, prefix)
+        end = bisect_left(self.terms, prefix + "\uffff")
+        return range(start, end)
+
+    def has_term(self, keyword: str) -> bool:
+        """Есть ли в словаре слово с таким началом"""
+        return bool(self._term_range(keyword))
+
+    def build_trigrams(self) -> TrigramIndex:
+        """
+        Индекс триграмм словаря (для 100 тысяч слов строится около секунды).
+        Строится один раз; если его уже строит другой поток - ждет его.
+        """
+        if self._trigrams is None:
+            with self._trigrams_lock:
+                if self._trigrams is None:
+                    self._trigrams = TrigramIndex(self.terms)
+        return self._trigrams
+
+    def similar_terms(self, keyword: str) -> List[tuple]:
+        """
+        Исправления слова с опечаткой по словарю: пары (число правок,
+        начало слова словаря), ближайшие первыми.
+        """
+        if not max_edits(keyword):
+            return []
+        return self.build_trigrams().similar(keyword)
+
+    def correct_typos(self, query: CompiledQuery) -> CompiledQuery:
+        """Запрос, где слова, которых нет в словаре, заменены ближайшими словами словаря"""
+        corrections = {}
+        for term in dict.fromkeys(query.terms + query.proper_nouns):
+            if not self.has_term(term):
+                similar = self.similar_terms(term)[:FUZZY_MAX_EXPANSIONS]
+                if similar:
+                    corrections[term] = [prefix for _, prefix in similar]
+        return query.with_corrections(corrections)
+
+    def term_frequencies(
+        self,
+        keyword: str,
+        position: Optional[np.ndarray] = None,
+        count: int = 0,
+    ) -> np.ndarray:
+        """
+        Частота ключевого слова в каждом чанке.
+        Все словоформы с этим префиксом считаются одним словом.
+        Только для части чанков: position[row] - место чанка в результате
+        (или -1, если чанк не нужен), count - длина результата.
+        """
+        tf = np.zeros(self.size if position is None else count, dtype=np.float32)
+        term_range = self._term_range(keyword)
+        if not term_range:
+            return tf
+        lo = self.term_ptr[term_range.start]
+        hi = self.term_ptr[term_range.stop]
+        if position is None:
+            np.add.at(tf, self.post_rows[lo:hi], self.post_tf[lo:hi])
+        else:
+            places = position[self.post_rows[lo:hi]]
+            selected = places >= 0
+            np.add.at(tf, places[selected], self.post_tf[lo:hi][selected])
+        return tf
+
+    def document_frequency(self, keyword: str) -> int:
+        """В скольких чанках встречается ключевое слово (любая словоформа)"""
+        term_range = self._term_range(keyword)
+        if not term_range:
+            return 0
+        lo = self.term_ptr[term_range.start]
+        hi = self.term_ptr[term_range.stop]
+        if len(term_range) == 1:
+            return int(hi - lo)
+        # Несколько словоформ могут встречаться в одном чанке - считаем чанки
+        seen = np.zeros(self.size, dtype=bool)
+        seen[self.post_rows[lo:hi]] = True
+        return int(np.count_nonzero(seen))
+
+    def score(
+        self,
+        query: CompiledQuery,
+        use_bigrams: bool = True,
+        use_proper_nouns: bool = True,
+        rows: Optional[np.ndarray] = None,
+    ) -> np.ndarray:
+        """
+        Возвращает массив оценок BM25 для всех чанков по разобранному запросу
+        (вклад слова умножается на его вес). Бонусы за биграммы и имена
+        собственные включаются флагами.
+        rows - номера чанков, которые вообще стоит оценивать (например,
+        отобранные фильтрами Блума); остальные получают 0. Статистика слов
+        (idf) при этом считается по всему индексу, так что оценки те же.
+        """
+        scores = np.zeros(self.size, dtype=np.float32)
+        if not self.size or (rows is not None and not len(rows)):
+            return scores
+
+        if rows is None:
+            position = None
+            chunk_len = self.chunk_len
+        else:
+            position = np.full(self.size, -1, dtype=np.int64)
+            position[rows] = np.arange(len(rows))
+            chunk_len = self.chunk_len[rows]
+
+        norm = self.k1 * (1 - self.b + self.b * chunk_len / max(self.avg_len, 1.0))
+        partial = np.zeros(len(chunk_len), dtype=np.float32)
+        present = {}
+
+        for keyword, weight in zip(query.terms, query.weights):
+            tf = self.term_frequencies(keyword, position, len(partial))
+            mask = tf > 0
+            present[keyword] = mask
+            df = int(mask.sum()) if position is None else self.document_frequency(keyword)
+            if not mask.any():
+                continue
+            idf = np.log(1 + (self.size - df + 0.5) / (df + 0.5))
+            partial += weight * idf * tf * (self.k1 + 1) / (tf + norm)
+
+        if use_bigrams and query.bigrams:
+            bigrams = {
+                f"{first} {second}": present[first] & present[second]
+                for first, second in query.bigrams
+                if present[first].any() and present[second].any()
+            }
+            if bigrams:
+                # Все биграммы ищутся за один проход по чанку,
+                # и только там, где есть оба слова хотя бы одной из них
+                matcher = compile_matcher(tuple(bigrams))
+                for place in np.flatnonzero(np.logical_or.reduce(list(bigrams.values()))):
+                    row = place if rows is None else rows[place]
+                    for bigram in matcher.first_positions(self.lowered[row]):
+                        if bigrams[bigram][place]:
+                            partial[place] += BIGRAM_BOOST
+
+        if use_proper_nouns:
+            for term in query.proper_nouns:
+                mask = present.get(term)
+                if mask is None:
+                    mask = self.term_frequencies(term, position, len(partial)) > 0
+                partial[mask] += PROPER_NOUN_BOOST
+
+        if rows is None:
+            return partial
+        scores[rows] = partial
+        return scores
+
+    def max_score(
+        self,
+        query: CompiledQuery,
+        use_bigrams: bool = True,
+        use_proper_nouns: bool = True,
+    ) -> float:
+        """
+        Верхняя граница оценки score() для любого чанка этого индекса.
+        Считается только по словарю, без прохода по чанкам: вклад слова
+        не больше idf * (k1 + 1), а df словоформ не меньше df самой частой
+        из них (поэтому idf берется по ней - он не меньше настоящего).
+        """
+        if not self.size:
+            return 0.0
+
+        bound = 0.0
+        present = set()
+        for keyword, weight in zip(query.terms, query.weights):
+            term_range = self._term_range(keyword)
+            if not term_range:
+                continue
+            present.add(keyword)
+            df = int(np.diff(self.term_ptr[term_range.start:term_range.stop + 1]).max())
+            idf = np.log(1 + (self.size - df + 0.5) / (df + 0.5))
+            bound += weight * idf * (self.k1 + 1)
+
+        if use_bigrams:
+            for first, second in query.bigrams:
+                if first in present and second in present:
+                    bound += BIGRAM_BOOST
+
+        if use_proper_nouns:
+            for term in query.proper_nouns:
+                if self._term_range(term):
+                    bound += PROPER_NOUN_BOOST
+
+        return float(bound)
+
+    def found_words(self, row: int, query: CompiledQuery) -> List[str]:
+        """Какие ключевые слова запроса встречаются в чанке (один проход по тексту)"""
+        found = compile_matcher(query.terms).first_positions(self.lowered[row])
+        return [kw for kw in query.terms if kw in found]
@@ -1,4 +1,5 @@
 # Конфигурация и константы
+import os
 
 SUPPORTED_EXTENSIONS = ['.pdf', '.docx', '.txt', '.md', '.json']
 
@@ -34,6 +35,15 @@ RESPONSE_FORMATS = {
     "кто родители": "семейные связи"
 }
 
+# Папка с заметками для режима по умолчанию (папка над проектом)
+NOTES_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# Где хранится индекс заметок (манифест файлов и их чанки)
+NOTES_INDEX_PATH = "notes_index.db"
+# Следить за папкой заметок в фоне (тогда вопросы не ждут разбора файлов)
+NOTES_WATCH = False
+NOTES_WATCH_DEBOUNCE_SEC = 1.0   # сколько ждать тишины после пачки изменений
+NOTES_POLL_INTERVAL_SEC = 5.0    # период опроса, если inotify недоступен
+
 # Параметры чанкинга
 CHUNK_SIZE = 500
 CONTEXT_CHUNKS = 2
@@ -42,6 +52,123 @@ CONTEXT_CHUNKS = 2
 RELEVANCE_THRESHOLD = 2
 MAX_SEARCH_RESULTS = 5
 
+# Сколько чанков-кандидатов брать из полнотекстового индекса (FTS5) на один вопрос
+FTS_CANDIDATES_LIMIT = 200
+
+# Параметры ранжирования BM25
+BM25_K1 = 1.5
+BM25_B = 0.75
+BIGRAM_BOOST = 3        # бонус, если два ключевых слова идут подряд
+PROPER_NOUN_BOOST = 2   # бонус за слово запроса с заглавной буквы (имя, название)
+SYNONYM_WEIGHT = 1.0    # вес слов, добавленных из RELATED_CONCEPTS (слова запроса - 1.0)
+
+# Сколько разобранных запросов держать в кэше (query.compile_query)
+QUERY_CACHE_SIZE = 1024
+
+# Фильтры Блума по словам документов (bloom.py): документы и блоки чанков,
+# где заведомо нет слов запроса, не оцениваются
+BLOOM_BLOCK_CHUNKS = 64       # чанков в одном блоке
+BLOOM_FALSE_POSITIVE = 0.02   # доля ложных "слово, возможно, есть"
+BLOOM_MIN_PREFIX = 3          # в фильтр кладутся префиксы слов такой длины...
+BLOOM_MAX_PREFIX = 6          # ...до такой (слова запроса длиннее сравниваются по префиксу)
+BLOOM_CACHE_MAX_BYTES = 64 * 1024 * 1024  # память под фильтры всех пользователей (LRU)
+
+# Поиск с опечатками (fuzzy.py): слово запроса, которого нет в словаре корпуса,
+# заменяется близкими словами словаря (поиск через индекс триграмм)
+FUZZY_MATCH = True
+FUZZY_MIN_LENGTH = 5        # более короткие слова не исправляются
+FUZZY_MAX_EDITS = 2         # больше правок в слове не допускается
+FUZZY_MAX_EXPANSIONS = 3    # сколько вариантов исправления брать на слово
+FUZZY_WEIGHT = 0.8          # вес исправленного слова относительно исходного
+
+# Режим поиска по документам пользователя:
+# "lexical" - по словам (FTS5 + BM25), "dense" - по смыслу (эмбеддинги),
+# "hybrid" - оба сразу, результаты объединяются через RRF
+RETRIEVAL_MODE = "lexical"
+
+# Фоновая обработка загрузок
+INGEST_WORKERS = os.cpu_count() or 2   # процессов для разбора документов (страницы PDF - параллельно)
+PDF_MIN_PAGES_PER_TASK = 20     # меньше страниц на процесс - передача файла в процесс не окупается
+
+# Изолированный разбор документов (sandbox.py): лимиты на один вызов разборщика
+EXTRACT_LIMITS = {
+    '.pdf': {"timeout_sec": 120, "max_rss_mb": 1024},
+    '.docx': {"timeout_sec": 60, "max_rss_mb": 512},
+    '.txt': {"timeout_sec": 30, "max_rss_mb": 512},
+    '.md': {"timeout_sec": 30, "max_rss_mb": 512},
+    '.json': {"timeout_sec": 30, "max_rss_mb": 512},
+}
+EXTRACT_WORKER_MAX_TASKS = 50   # после стольких задач процесс разбора перезапускается
+EXTRACT_RSS_CHECK_SEC = 0.05    # как часто проверять память процесса разбора
+INGEST_JOB_TTL_SEC = 3600       # сколько помнить завершенные задачи
+# Незавершенные загрузки держат файл в памяти, поэтому их число ограничено
+INGEST_MAX_ACTIVE_JOBS = 16             # на весь сервер (сверх - 503)
+INGEST_MAX_ACTIVE_JOBS_PER_USER = 3     # на одного пользователя (сверх - 429)
+UPLOAD_MAX_FILE_BYTES = 50 * 1024 * 1024        # максимальный размер одного файла
+UPLOAD_MAX_REQUEST_BYTES = 55 * 1024 * 1024     # максимальный размер запроса на загрузку целиком
+
+# Планировщик запросов к модели (llm_scheduler.py) - подставьте лимиты своего тарифа Groq
+LLM_MAX_IN_FLIGHT = 4               # сколько вызовов модели может идти одновременно
+LLM_REQUESTS_PER_MIN = 30           # лимит запросов в минуту (None - без лимита)
+LLM_TOKENS_PER_MIN = None           # лимит токенов в минуту (None - без лимита)
+LLM_ANSWER_TOKENS_ESTIMATE = 500    # сколько токенов закладывать на ответ модели
+LLM_MAX_QUEUE_PER_USER = 3          # больше вопросов одного пользователя в очереди - отказ
+
+# Кэш готовых ответов (answer_cache.py)
+ANSWER_CACHE_MAX_ENTRIES = 1000
+ANSWER_CACHE_TTL_SEC = 24 * 3600
+ANSWER_CACHE_PATH = "answer_cache.db"   # None - только в памяти (без сохранения между запусками)
+ANSWER_CACHE_SEMANTIC = False           # True - похожий по смыслу вопрос тоже берется из кэша
+ANSWER_CACHE_MIN_SIMILARITY = 0.95      # порог близости эмбеддингов вопросов для режима SEMANTIC
+
+# Сколько строк чанков читать из БД за один fetchmany
+CHUNK_FETCH_BATCH = 500
+
+# Хэширование паролей (PBKDF2-SHA256). Если число итераций поменять,
+# старые хэши пересчитываются с новым числом при следующем входе пользователя
+PASSWORD_HASH_ITERATIONS = 100_000
+# Хэширование идет в отдельных потоках (auth_executor.py), чтобы не стопорить чат
+AUTH_HASH_WORKERS = 2
+# Сколько входов/регистраций может ждать хэширования; остальным сразу 503
+AUTH_HASH_MAX_PENDING = 32
+
+# Кэш проверенных токенов сессий (db.get_user_by_token), общий на процесс.
+# Выход, смена роли и удаление пользователя сбрасывают его сразу; TTL
+# ограничивает, сколько другой процесс сервера может видеть старые данные
+SESSION_CACHE_TTL_SEC = 60
+SESSION_CACHE_MAX_ENTRIES = 10000
+
+# Кэш корпусов пользователей в памяти (чанки + BM25), общий на процесс
+CORPUS_CACHE_MAX_BYTES = 512 * 1024 * 1024
+
+# Гибридный поиск
+RRF_K = 60                  # сглаживание в reciprocal rank fusion
+HYBRID_CANDIDATES = 50      # сколько кандидатов берется из каждой ветки
+LEXICAL_BUDGET_SEC = 0.5    # бюджет времени ветки поиска по словам
+DENSE_BUDGET_SEC = 1.0      # бюджет времени ветки поиска по смыслу
+RETRIEVAL_WORKERS = 4       # потоков у каждой ветки (у каждой - свой пул)
+
+# Эмбеддинги (sentence-transformers, только CPU)
+EMBEDDING_MODEL = "sentence-transformers/paraphrase-multilingual-MiniLM-L12-v2"
+EMBEDDING_DTYPE = "float16"     # как хранить в БД: "float16" или "int8"
+EMBEDDING_BATCH_SIZE = 32
+DENSE_MIN_SIMILARITY = 0.3      # ниже этой косинусной близости чанк не считается найденным
+
+# Сборка контекста для модели (context_packer.py)
+CONTEXT_TOKEN_BUDGET = 2500         # сколько токенов найденного текста отдавать модели
+CONTEXT_CANDIDATES = 15             # из скольких лучших находок выбирать
+CONTEXT_MMR_LAMBDA = 0.7            # вес релевантности против разнообразия (1 - только релевантность)
+CONTEXT_TOKENIZER = EMBEDDING_MODEL # чем считать токены (локально, через transformers)
+
+# Приближенный поиск по эмбеддингам (IVF-индекс, ann_index.py)
+ANN_NPROBE = 8              # сколько кластеров просматривать: больше - точнее, но медленнее
+ANN_EXACT_SEARCH = False    # True - всегда точный перебор всех чанков
+ANN_MIN_TRAIN = 5000        # до стольких чанков кластеры не строятся (перебор и так быстрый)
+ANN_TRAIN_SAMPLE = 20000    # на скольких векторах обучать k-means
+ANN_KMEANS_ITERS = 10
+ANN_RETRAIN_GROWTH = 4      # перестроить кластеры, когда корпус вырос во столько раз
+ANN_CACHE_MAX_BYTES = 256 * 1024 * 1024  # сколько памяти на индексы всех пользователей (LRU)
+
 # Важные сущности для точного поиска (имена, даты, места)
 IMPORTANT_ENTITIES = ["имен", "даты", "места", "события", "родители", "семья"]
 
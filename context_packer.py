@@ -0,0 +1,217 @@
+# Сборка контекста для модели: окна найденных чанков в пределах бюджета токенов
+import re
+import threading
+from typing import Dict, List
+
+from config import CONTEXT_TOKEN_BUDGET, CONTEXT_MMR_LAMBDA, CONTEXT_TOKENIZER, MAX_SEARCH_RESULTS
+from query import tokenize
+
+try:
+    from transformers import AutoTokenizer
+except ImportError:  # без transformers токены оцениваются приблизительно
+    AutoTokenizer = None
+
+# Токенизатор загружается один раз, при старте (load_tokenizer), а не при вопросе
+_tokenizer = None
+_tokenizer_lock = threading.Lock()
+
+_APPROX_TOKEN_RE = re.compile(r"\w+|[^\w\s]")
+
+# Разделитель между чанками в контексте
+SEPARATOR = "\n[...]\n"
+
+
+def load_tokenizer() -> None:
+    """
+    Загружает токенизатор CONTEXT_TOKENIZER: сначала из локального кэша,
+    если его там нет - скачивает. Может идти долго (сеть), поэтому
+    вызывается при старте, в фоновом потоке (см. start_tokenizer_loading).
+    """
+    global _tokenizer
+    if AutoTokenizer is None:
+        return
+    with _tokenizer_lock:
+        if _tokenizer is not None:
+            return
+        try:
+            _tokenizer = AutoTokenizer.from_pretrained(CONTEXT_TOKENIZER, local_files_only=True)
+        except Exception:
+            try:
+                _tokenizer = AutoTokenizer.from_pretrained(CONTEXT_TOKENIZER)
+            except Exception as e:
+                print(f"Токенизатор {CONTEXT_TOKENIZER} недоступен, токены считаются приблизительно: {e}")
+
+
+def start_tokenizer_loading() -> None:
+    """Запускает load_tokenizer в фоне - старт сервера его не ждет"""
+    threading.Thread(target=load_tokenizer, name="tokenizer-load", daemon=True).start()
+
+
+def get_tokenizer():
+    """
+    Загруженный токенизатор или None (еще не загружен или недоступен).
+    Сам не загружает: вопрос не должен ждать скачивания.
+    """
+    return _tokenizer
+
+
+def count_tokens(text: str) -> int:
+    """Число токенов в тексте"""
+    tokenizer = get_tokenizer()
+    if tokenizer is not None:
+        return len(tokenizer.encode(text, add_special_tokens=False))
+    # Оценка: слово русского текста дает в среднем около полутора токенов
+    return len(_APPROX_TOKEN_RE.findall(text)) * 3 // 2
+
+
+def _similarity(a: set, b: set) -> float:
+    """Доля общих слов (коэффициент Жаккара)"""
+    if not a or not b:
+        return 0.0
+    return len(a & b) / len(a | b)
+
+
+class Passage:
+    """Фрагмент документа для контекста: подряд идущие чанки, среди них - найденные"""
+
+    def __init__(self, hit: Dict, window: List[tuple]):
+        self.document_id = hit["document_id"]
+        self.filename = hit["filename"]
+        self.page = hit.get("page")
+        self.relevance_score = hit["relevance_score"]
+        self.chunks: Dict[int, str] = {}
+        self.found = set()
+        self.words = set()
+        self.merge(hit, window)
+
+    def touches(self, window: List[tuple]) -> bool:
+        """Пересекается ли окно с фрагментом или примыкает к нему"""
+        return window[0][0] <= max(self.chunks) + 1 and window[-1][0] >= min(self.chunks) - 1
+
+    def merge(self, hit: Dict, window: List[tuple]) -> None:
+        for idx, text in window:
+            if idx not in self.chunks:
+                self.chunks[idx] = text
+                self.words.update(tokenize(text))
+        self.found.add(hit["chunk_index"])
+        if hit["relevance_score"] > self.relevance_score:
+            self.relevance_score = hit["relevance_score"]
+            self.page = hit.get("page")
+
+    def absorb(self, other: "Passage") -> None:
+        """Забирает чанки и находки соседнего фрагмента того же документа"""
+        self.chunks.update(other.chunks)
+        self.found |= other.found
+        self.words |= other.words
+        if other.relevance_score > self.relevance_score:
+            self.relevance_score = other.relevance_score
+            self.page = other.page
+
+    def to_result(self) -> Dict:
+        parts = [
+            f"[НАЙДЕННОЕ] {self.chunks[idx]}" if idx in self.found else self.chunks[idx]
+            for idx in sorted(self.chunks)
+        ]
+        return {
+            "filename": self.filename,
+            "page": self.page,
+            "relevance_score": self.relevance_score,
+            "context": SEPARATOR.join(parts),
+        }
+
+
+def pack_context(
+    hits: List[Dict],
+    store,
+    budget: int = CONTEXT_TOKEN_BUDGET,
+    max_hits: int = MAX_SEARCH_RESULTS,
+    mmr_lambda: float = CONTEXT_MMR_LAMBDA,
+) -> List[Dict]:
+    """
+    Собирает контекст из ранжированных находок.
+
+    hits - находки без текста (document_id, chunk_index, filename,
+    relevance_score, page), лучшие первыми. Текст берется из store - хранилища
+    чанков с методом window(document_id, chunk_index), который возвращает чанк
+    с соседями парами (chunk_index, text) по порядку. Так текст читается только
+    для кандидатов, а не для всех совпадений.
+
+    Находки выбираются по MMR: релевантность минус похожесть на уже
+    выбранное (mmr_lambda - вес релевантности), чтобы не тратить бюджет на
+    пересказ одного и того же. Окна из одного документа, которые
+    пересекаются или соседствуют, склеиваются в один фрагмент, и каждый чанк
+    попадает в контекст один раз. Суммарный объем не превышает budget токенов.
+
+    Возвращает фрагменты в виде результатов поиска (filename, page,
+    relevance_score, context), самые релевантные - первыми.
+    """
+    if not hits:
+        return []
+    top_score = max(hit["relevance_score"] for hit in hits) or 1.0
+    separator_tokens = count_tokens(SEPARATOR)
+
+    candidates = []
+    for hit in hits:
+        window = store.window(hit["document_id"], hit["chunk_index"])
+        if window:
+            words = set(tokenize(" ".join(text for _, text in window)))
+            candidates.append((hit, window, words))
+
+    token_counts: Dict[tuple, int] = {}
+
+    def chunk_tokens(document_id, idx: int, text: str) -> int:
+        key = (document_id, idx)
+        if key not in token_counts:
+            token_counts[key] = count_tokens(text) + separator_tokens
+        return token_counts[key]
+
+    passages: List[Passage] = []
+    used = taken = 0
+    while candidates and taken < max_hits:
+        best = None
+        best_score = float("-inf")
+        fitting = []
+        for candidate in candidates:
+            hit, window, words = candidate
+            # Фрагменты, с которыми окно склеится (окно может соединить два фрагмента)
+            targets = [p for p in passages if p.document_id == hit["document_id"] and p.touches(window)]
+            cost = sum(
+                chunk_tokens(hit["document_id"], idx, text)
+                for idx, text in window
+                if not any(idx in p.chunks for p in targets)
+            )
+            if used + cost > budget:
+                # Окно не влезает в остаток бюджета - больше его не рассматриваем
+                continue
+            fitting.append(candidate)
+
+            redundancy = max(
+                (_similarity(words, p.words) for p in passages if p not in targets),
+                default=0.0,
+            )
+            score = mmr_lambda * hit["relevance_score"] / top_score - (1 - mmr_lambda) * redundancy
+            if score > best_score:
+                best, best_score = (candidate, targets, cost), score
+
+        if best is None:
+            break
+        candidates = [candidate for candidate in fitting if candidate is not best[0]]
+
+        (hit, window, _), targets, cost = best
+        used += cost
+        if not targets:
+            passages.append(Passage(hit, window))
+            taken += 1
+            continue
+
+        # Найденный чанк уже был в контексте соседом - новой находкой не считаем
+        if not any(hit["chunk_index"] in p.chunks for p in targets):
+            taken += 1
+        target = targets[0]
+        target.merge(hit, window)
+        for other in targets[1:]:
+            target.absorb(other)
+            passages.remove(other)
+
+    passages.sort(key=lambda p: p.relevance_score, reverse=True)
+    return [passage.to_result() for passage in passages]
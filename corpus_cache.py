@@ -0,0 +1,152 @@
+# Кэш корпусов пользователей в памяти (чанки + BM25-индекс)
+import sys
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Dict, Iterable, Optional, Tuple
+
+from config import CORPUS_CACHE_MAX_BYTES, FUZZY_MATCH
+import numpy as np
+
+from bm25 import BM25Index
+import db
+
+
+class UserCorpus:
+    """Разобранный корпус одного пользователя: чанки и производные структуры"""
+
+    def __init__(self, chunks: Iterable[Dict]):
+        self.chunks: List[Dict] = []
+        self.row_by_id: Dict[int, int] = {}
+        self.row_by_position: Dict[tuple, int] = {}
+        for row, chunk in enumerate(chunks):
+            self.chunks.append(chunk)
+            self.row_by_id[chunk["id"]] = row
+            self.row_by_position[(chunk["document_id"], chunk["chunk_index"])] = row
+
+        self.bm25 = BM25Index([chunk["text"] for chunk in self.chunks])
+        self.size_bytes = self._estimate_size()
+
+    def window(self, document_id: int, chunk_index: int, radius: int = 1) -> List[tuple]:
+        """То же, что db.get_chunk_window, но из памяти: пары (chunk_index, text)"""
+        window = []
+        for idx in range(chunk_index - radius, chunk_index + radius + 1):
+            row = self.row_by_position.get((document_id, idx))
+            if row is not None:
+                window.append((idx, self.chunks[row]["text"]))
+        return window
+
+    def rows_in(self, ranges: Dict[int, List[Tuple[int, int]]]) -> np.ndarray:
+        """
+        Номера строк корпуса для диапазонов чанков: document_id -> [(start, end), ...].
+        Чанки документа лежат в корпусе подряд и по порядку, поэтому
+        диапазон чанков - это диапазон строк.
+        """
+        parts = []
+        for document_id, document_ranges in ranges.items():
+            for start, end in document_ranges:
+                first = self.row_by_position.get((document_id, start))
+                last = self.row_by_position.get((document_id, end - 1))
+                if first is not None and last is not None:
+                    parts.append(np.arange(first, last + 1))
+        return np.sort(np.concatenate(parts)) if parts else np.zeros(0, dtype=np.int64)
+
+    def _estimate_size(self) -> int:
+        """Примерный объем памяти: тексты (исходные и в нижнем регистре) + массивы BM25"""
+        size = sum(sys.getsizeof(chunk["text"]) + 200 for chunk in self.chunks)
+        size += sum(sys.getsizeof(text) for text in self.bm25.lowered)
+        size += sum(sys.getsizeof(term) for term in self.bm25.terms)
+        for array in (self.bm25.post_rows, self.bm25.post_tf, self.bm25.term_ptr, self.bm25.chunk_len):
+            size += array.nbytes
+        return size
+
+
+# Фоновые достройки корпусов (индекс триграмм), по одной за раз
+_background = ThreadPoolExecutor(max_workers=1, thread_name_prefix="corpus-background")
+
+
+class CorpusCache:
+    """
+    LRU-кэш корпусов пользователей с ограничением по объему памяти.
+    Пока корпус в кэше, поиск по нему не обращается к SQLite.
+    Запись в БД сбрасывает кэш пользователя (через db.add_corpus_listener).
+    """
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.total_bytes = 0
+        self._entries: "OrderedDict[int, UserCorpus]" = OrderedDict()
+        # Пользователи, чей корпус заведомо не помещается в кэш
+        self._oversized = set()
+        # Счетчик изменений: не кладем в кэш корпус, прочитанный до изменения
+        self._generations: Dict[int, int] = {}
+        self._lock = threading.Lock()
+
+    def get(self, user_id: int) -> Optional[UserCorpus]:
+        """
+        Возвращает корпус пользователя (загружает при промахе).
+        None - корпус слишком большой для кэша, искать нужно через БД.
+        """
+        with self._lock:
+            corpus = self._entries.get(user_id)
+            if corpus is not None:
+                self._entries.move_to_end(user_id)
+                return corpus
+            if user_id in self._oversized:
+                return None
+            generation = self._generations.get(user_id, 0)
+
+        chunk_count, total_chars = db.get_corpus_stats(user_id)
+        # Текст в памяти Python занимает до 2 байт на символ, и хранится дважды
+        if total_chars * 4 + chunk_count * 200 > self.max_bytes:
+            with self._lock:
+                if self._generations.get(user_id, 0) == generation:
+                    self._oversized.add(user_id)
+            return None
+
+        corpus = UserCorpus(db.iter_user_chunks(user_id))
+
+        with self._lock:
+            if self._generations.get(user_id, 0) == generation and user_id not in self._entries:
+                self._entries[user_id] = corpus
+                self.total_bytes += corpus.size_bytes
+                self._evict()
+                if FUZZY_MATCH:
+                    # Индекс триграмм для исправления опечаток - в фоне; вопрос, пришедший
+                    # раньше, дождется этой сборки (BM25Index.build_trigrams)
+                    _background.submit(corpus.bm25.build_trigrams)
+        return corpus
+
+    def warm(self, user_id: int) -> None:
+        """
+        Загружает корпус пользователя в кэш вместе с индексом триграмм
+        (после загрузки документа - чтобы первый вопрос не строил их сам).
+        """
+        corpus = self.get(user_id)
+        if corpus is not None and FUZZY_MATCH:
+            corpus.bm25.build_trigrams()
+
+    def peek(self, user_id: int) -> Optional[UserCorpus]:
+        """Корпус из кэша без загрузки (и без обновления порядка LRU)"""
+        with self._lock:
+            return self._entries.get(user_id)
+
+    def invalidate(self, user_id: int) -> None:
+        """Сбрасывает все, что закэшировано для пользователя"""
+        with self._lock:
+            self._generations[user_id] = self._generations.get(user_id, 0) + 1
+            self._oversized.discard(user_id)
+            corpus = self._entries.pop(user_id, None)
+            if corpus is not None:
+                self.total_bytes -= corpus.size_bytes
+
+    def _evict(self) -> None:
+        """Выбрасывает давно не использованные корпуса, пока не уложимся в бюджет"""
+        while self.total_bytes > self.max_bytes and len(self._entries) > 1:
+            _, corpus = self._entries.popitem(last=False)
+            self.total_bytes -= corpus.size_bytes
+
+
+corpus_cache = CorpusCache(CORPUS_CACHE_MAX_BYTES)
+
+db.add_corpus_listener(lambda event, user_id, document_id: corpus_cache.invalidate(user_id))
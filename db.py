@@ -1,12 +1,18 @@
 import os
 import sqlite3
+import threading
+import time
+from collections import OrderedDict
 from contextlib import contextmanager
-from typing import List, Dict
+from typing import List, Dict, Iterator
 import hashlib          
+import hmac
 import secrets         
 from datetime import datetime, timedelta   
 from typing import Optional  
 
+from config import CHUNK_FETCH_BATCH, SESSION_CACHE_TTL_SEC, SESSION_CACHE_MAX_ENTRIES, PASSWORD_HASH_ITERATIONS
+
 DB_PATH = "data.db"
 
 
@@ -73,6 +79,10 @@ def init_db() -> None:
             # Добавляем поле role со значением по умолчанию 'user'
             cur.execute("ALTER TABLE users ADD COLUMN role TEXT NOT NULL DEFAULT 'user'")
             print("Поле role добавлено!")
+
+        # Число итераций PBKDF2, с которым посчитан хэш пароля (старые хэши - 100 000)
+        if 'password_iterations' not in user_column_names:
+            cur.execute("ALTER TABLE users ADD COLUMN password_iterations INTEGER NOT NULL DEFAULT 100000")
         # Убираем else, чтобы не писать "Поле role уже существует" при каждом запуске       
 
 # ===== НОВЫЙ КОД: МИГРАЦИЯ БАЗЫ ДАННЫХ =====
@@ -149,12 +159,112 @@ def init_db() -> None:
                     print("Миграция завершена!")
                     break
 
-        
+        # ===== ПОРЯДКОВЫЙ НОМЕР ЧАНКА В ДОКУМЕНТЕ =====
+        # Нужен, чтобы по найденному чанку быстро достать соседей (контекст)
+        cur.execute("PRAGMA table_info(chunks)")
+        chunk_column_names = [col[1] for col in cur.fetchall()]
+
+        if 'chunk_index' not in chunk_column_names:
+            print("Добавляем поле chunk_index в таблицу chunks...")
+            cur.execute("ALTER TABLE chunks ADD COLUMN chunk_index INTEGER NOT NULL DEFAULT 0")
+            # Чанки документа вставлялись подряд, поэтому порядок id = порядок в тексте
+            cur.execute("""
+                UPDATE chunks SET chunk_index = (
+                    SELECT COUNT(*) FROM chunks c2
+                    WHERE c2.document_id = chunks.document_id AND c2.id < chunks.id
+                )
+            """)
+            print("Поле chunk_index добавлено!")
+
+        # Эмбеддинг чанка (float16/int8 в виде BLOB), считается при загрузке
+        if 'embedding' not in chunk_column_names:
+            print("Добавляем поле embedding в таблицу chunks...")
+            cur.execute("ALTER TABLE chunks ADD COLUMN embedding BLOB")
+            print("Поле embedding добавлено!")
+
+        # Номер страницы PDF, с которой взят чанк (NULL - у документа нет страниц)
+        if 'page' not in chunk_column_names:
+            print("Добавляем поле page в таблицу chunks...")
+            cur.execute("ALTER TABLE chunks ADD COLUMN page INTEGER")
+            print("Поле page добавлено!")
+
+        # Фильтры Блума по словам документа (bloom.DocumentBloom), считаются при загрузке
+        cur.execute("PRAGMA table_info(documents)")
+        if 'bloom' not in [col[1] for col in cur.fetchall()]:
+            print("Добавляем поле bloom в таблицу documents...")
+            cur.execute("ALTER TABLE documents ADD COLUMN bloom BLOB")
+            print("Поле bloom добавлено!")
+
+        cur.execute(
+            "CREATE INDEX IF NOT EXISTS idx_chunks_document ON chunks(document_id, chunk_index)"
+        )
+
+        # ===== ПОЛНОТЕКСТОВЫЙ ИНДЕКС (FTS5) ПО ЧАНКАМ =====
+        # Индекс хранит только словарь, сам текст берется из таблицы chunks.
+        # Триггеры держат его в актуальном состоянии, в том числе при
+        # каскадном удалении чанков вместе с документом или пользователем.
+        cur.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name = 'chunks_fts'")
+        fts_exists = cur.fetchone() is not None
+
+        cur.execute("""
+            CREATE VIRTUAL TABLE IF NOT EXISTS chunks_fts USING fts5(
+                text,
+                content='chunks',
+                content_rowid='id',
+                tokenize='unicode61 remove_diacritics 0'
+            )
+        """)
+        cur.execute("""
+            CREATE TRIGGER IF NOT EXISTS chunks_fts_insert AFTER INSERT ON chunks BEGIN
+                INSERT INTO chunks_fts(rowid, text) VALUES (new.id, new.text);
+            END
+        """)
+        cur.execute("""
+            CREATE TRIGGER IF NOT EXISTS chunks_fts_delete AFTER DELETE ON chunks BEGIN
+                INSERT INTO chunks_fts(chunks_fts, rowid, text) VALUES ('delete', old.id, old.text);
+            END
+        """)
+        cur.execute("""
+            CREATE TRIGGER IF NOT EXISTS chunks_fts_update AFTER UPDATE OF text ON chunks BEGIN
+                INSERT INTO chunks_fts(chunks_fts, rowid, text) VALUES ('delete', old.id, old.text);
+                INSERT INTO chunks_fts(rowid, text) VALUES (new.id, new.text);
+            END
+        """)
+
+        if not fts_exists:
+            # Индекс только что создан - заполняем его уже загруженными чанками
+            print("Строим полнотекстовый индекс по чанкам...")
+            cur.execute("INSERT INTO chunks_fts(chunks_fts) VALUES ('rebuild')")
+            print("Индекс построен!")
+
         conn.commit()
     finally:
         conn.close()
 
 
+# ===== ПОДПИСЧИКИ НА ИЗМЕНЕНИЯ ДОКУМЕНТОВ =====
+# Индексы и кэши в памяти узнают отсюда, что корпус пользователя изменился
+_corpus_listeners = []
+
+
+def add_corpus_listener(callback) -> None:
+    """
+    Подписывает callback(event, user_id, document_id) на изменения документов.
+    event: "save" - документ добавлен, "delete" - документ удален,
+    "delete_all" - удалены все документы пользователя (document_id = None).
+    """
+    _corpus_listeners.append(callback)
+
+
+def _notify_corpus_change(event: str, user_id: int, document_id: Optional[int] = None) -> None:
+    """Сообщает подписчикам об изменении. Ошибка подписчика не ломает запись в БД."""
+    for callback in _corpus_listeners:
+        try:
+            callback(event, user_id, document_id)
+        except Exception as e:
+            print(f"Ошибка обновления индекса пользователя {user_id}: {e}")
+
+
 @contextmanager
 def get_conn():
     conn = sqlite3.connect(DB_PATH)
@@ -166,55 +276,281 @@ def get_conn():
 
 
 # ИЗМЕНЯЕМ функцию save_document - теперь user_id это int
-def save_document(user_id: int, name: str, chunks: List[str], created_at: str) -> int:
+def save_document(
+    user_id: int,
+    name: str,
+    chunks: List[str],
+    created_at: str,
+    embeddings: Optional[List[bytes]] = None,
+    pages: Optional[List[Optional[int]]] = None,
+    bloom: Optional[bytes] = None,
+) -> int:
     """
     Сохраняет документ и его чанки, возвращает id документа.
     user_id теперь INTEGER (ID пользователя из таблицы users)
+    embeddings - упакованные эмбеддинги чанков (по одному на чанк) или None.
+    pages - номера страниц чанков (для PDF) или None.
+    bloom - упакованные фильтры Блума документа (bloom.DocumentBloom) или None.
     """
+    if embeddings is None:
+        embeddings = [None] * len(chunks)
+    if pages is None:
+        pages = [None] * len(chunks)
+
     with get_conn() as conn:
         cur = conn.cursor()
         cur.execute(
-            "INSERT INTO documents (user_id, name, created_at) VALUES (?, ?, ?)",
-            (user_id, name, created_at),
+            "INSERT INTO documents (user_id, name, created_at, bloom) VALUES (?, ?, ?, ?)",
+            (user_id, name, created_at, bloom),
         )
         doc_id = cur.lastrowid
 
+        # В полнотекстовый индекс чанки попадают через триггер chunks_fts_insert
         cur.executemany(
-            "INSERT INTO chunks (document_id, text) VALUES (?, ?)",
-            [(doc_id, ch) for ch in chunks],
+            "INSERT INTO chunks (document_id, chunk_index, text, embedding, page) VALUES (?, ?, ?, ?, ?)",
+            [
+                (doc_id, idx, ch, emb, page)
+                for idx, (ch, emb, page) in enumerate(zip(chunks, embeddings, pages))
+            ],
         )
         conn.commit()
 
+    _notify_corpus_change("save", user_id, doc_id)
     return doc_id
 
-# ИЗМЕНЯЕМ функцию get_user_documents - теперь user_id это int
-def get_user_documents(user_id: int) -> List[Dict]:
+def iter_user_chunks(user_id: int, batch_size: int = CHUNK_FETCH_BATCH) -> Iterator[Dict]:
     """
-    Возвращает список документов пользователя с объединённым текстом чанков.
+    Отдает чанки пользователя по одному, в порядке id (документ за документом).
+    Строки читаются из курсора пачками по batch_size (fetchmany), поэтому
+    весь корпус не собирается в памяти ни строкой, ни списком.
     """
     with get_conn() as conn:
         cur = conn.cursor()
         cur.execute(
             """
-            SELECT d.id, d.name, GROUP_CONCAT(c.text, '\n') as content
-            FROM documents d
-            JOIN chunks c ON c.document_id = d.id
+            SELECT c.id, c.document_id, d.name, c.chunk_index, c.text, c.page
+            FROM chunks c
+            JOIN documents d ON d.id = c.document_id
             WHERE d.user_id = ?
-            GROUP BY d.id, d.name
+            ORDER BY c.id
             """,
             (user_id,),
         )
+        while True:
+            rows = cur.fetchmany(batch_size)
+            if not rows:
+                break
+            for row in rows:
+                yield {
+                    "id": row[0],
+                    "document_id": row[1],
+                    "filename": row[2],
+                    "chunk_index": row[3],
+                    "text": row[4],
+                    "page": row[5],
+                }
+
+def build_fts_query(keywords: List[str]) -> str:
+    """
+    Собирает запрос FTS5 из ключевых слов.
+    Каждое слово ищется как префикс ("мартин" найдет и "мартина"),
+    слова объединяются через OR - итоговую релевантность считает BM25.
+    """
+    terms = []
+    for kw in keywords:
+        for word in kw.split():
+            # Кавычки внутри слова ломают синтаксис FTS5
+            word = word.replace('"', '')
+            if word:
+                terms.append(f'"{word}"*')
+    return " OR ".join(terms)
+
+
+def search_user_chunks(
+    user_id: int,
+    keywords: List[str],
+    limit: int = 200,
+    document_ids: Optional[List[int]] = None,
+) -> List[Dict]:
+    """
+    Ищет чанки пользователя по полнотекстовому индексу.
+    Возвращает не больше limit кандидатов, лучшие по BM25 - первыми.
+    document_ids - искать только в этих документах (None - во всех).
+    """
+    fts_query = build_fts_query(keywords)
+    if not fts_query or document_ids == []:
+        return []
+    document_filter = ""
+    params = [fts_query, user_id]
+    if document_ids is not None:
+        document_filter = f" AND c.document_id IN ({', '.join('?' * len(document_ids))})"
+        params.extend(document_ids)
+    params.append(limit)
+
+    with get_conn() as conn:
+        cur = conn.cursor()
+        cur.execute(
+            f"""
+            SELECT c.id, c.document_id, d.name, c.chunk_index, c.text, c.page
+            FROM chunks_fts
+            JOIN chunks c ON c.id = chunks_fts.rowid
+            JOIN documents d ON d.id = c.document_id
+            WHERE chunks_fts MATCH ? AND d.user_id = ?{document_filter}
+            ORDER BY chunks_fts.rank
+            LIMIT ?
+            """,
+            params,
+        )
         rows = cur.fetchall()
-        
-        # Преобразуем в список словарей
-        result = []
-        for row in rows:
-            result.append({
-                "id": row[0],
-                "filename": row[1],
-                "content": row[2] or ""
-            })
-        return result
+
+    return [
+        {
+            "id": row[0],
+            "document_id": row[1],
+            "filename": row[2],
+            "chunk_index": row[3],
+            "text": row[4],
+            "page": row[5],
+        }
+        for row in rows
+    ]
+
+
+def get_corpus_stats(user_id: int) -> tuple:
+    """Возвращает (число чанков, суммарную длину текста) по документам пользователя."""
+    with get_conn() as conn:
+        cur = conn.cursor()
+        cur.execute(
+            """
+            SELECT COUNT(c.id), COALESCE(SUM(LENGTH(c.text)), 0)
+            FROM chunks c
+            JOIN documents d ON d.id = c.document_id
+            WHERE d.user_id = ?
+            """,
+            (user_id,),
+        )
+        return tuple(cur.fetchone())
+
+
+def iter_user_chunk_embeddings(
+    user_id: int,
+    document_id: Optional[int] = None,
+    batch_size: int = CHUNK_FETCH_BATCH,
+) -> Iterator[Dict]:
+    """
+    Отдает чанки пользователя вместе с эмбеддингами (в порядке id), читая
+    курсор пачками по batch_size.
+    Текст отдается только для чанков, у которых эмбеддинга еще нет.
+    Если указан document_id - только чанки этого документа.
+    """
+    with get_conn() as conn:
+        cur = conn.cursor()
+        cur.execute(
+            """
+            SELECT c.id, c.document_id, d.name, c.chunk_index, c.page, c.embedding,
+                   CASE WHEN c.embedding IS NULL THEN c.text END
+            FROM chunks c
+            JOIN documents d ON d.id = c.document_id
+            WHERE d.user_id = ? AND (? IS NULL OR c.document_id = ?)
+            ORDER BY c.id
+            """,
+            (user_id, document_id, document_id),
+        )
+        while True:
+            rows = cur.fetchmany(batch_size)
+            if not rows:
+                break
+            for row in rows:
+                yield {
+                    "id": row[0],
+                    "document_id": row[1],
+                    "filename": row[2],
+                    "chunk_index": row[3],
+                    "page": row[4],
+                    "embedding": row[5],
+                    # Текст нужен только чанкам без эмбеддинга (чтобы досчитать его)
+                    "text": row[6],
+                }
+
+
+def set_chunk_embeddings(pairs: List[tuple]) -> None:
+    """Сохраняет эмбеддинги для уже существующих чанков: пары (chunk_id, blob)."""
+    with get_conn() as conn:
+        cur = conn.cursor()
+        cur.executemany(
+            "UPDATE chunks SET embedding = ? WHERE id = ?",
+            [(blob, chunk_id) for chunk_id, blob in pairs],
+        )
+        conn.commit()
+
+
+def get_document_blooms(user_id: int) -> List[tuple]:
+    """
+    Фильтры Блума документов пользователя: тройки (document_id, blob или None,
+    число чанков). Число чанков считается только для документов без фильтра.
+    """
+    with get_conn() as conn:
+        cur = conn.cursor()
+        cur.execute(
+            """
+            SELECT d.id, d.bloom,
+                   CASE WHEN d.bloom IS NULL
+                        THEN (SELECT COUNT(*) FROM chunks c WHERE c.document_id = d.id)
+                        ELSE 0 END
+            FROM documents d WHERE d.user_id = ? ORDER BY d.id
+            """,
+            (user_id,),
+        )
+        return cur.fetchall()
+
+
+def set_document_bloom(document_id: int, bloom: bytes) -> None:
+    """Сохраняет фильтры Блума документа (для документов, загруженных до их появления)"""
+    with get_conn() as conn:
+        conn.execute("UPDATE documents SET bloom = ? WHERE id = ?", (bloom, document_id))
+        conn.commit()
+
+
+def get_document_texts(document_id: int) -> List[str]:
+    """Тексты чанков документа по порядку"""
+    with get_conn() as conn:
+        cur = conn.cursor()
+        cur.execute(
+            "SELECT text FROM chunks WHERE document_id = ? ORDER BY chunk_index",
+            (document_id,),
+        )
+        return [row[0] for row in cur.fetchall()]
+
+
+def get_chunk_window(document_id: int, chunk_index: int, radius: int = 1) -> List[tuple]:
+    """
+    Возвращает чанк документа вместе с соседями (по radius с каждой стороны)
+    в виде списка пар (chunk_index, text).
+    """
+    with get_conn() as conn:
+        cur = conn.cursor()
+        cur.execute(
+            """
+            SELECT chunk_index, text FROM chunks
+            WHERE document_id = ? AND chunk_index BETWEEN ? AND ?
+            ORDER BY chunk_index
+            """,
+            (document_id, chunk_index - radius, chunk_index + radius),
+        )
+        return [(row[0], row[1]) for row in cur.fetchall()]
+
+
+class DocumentChunkStore:
+    """
+    Чанки документов в БД с доступом по номеру (тот же window(), что у
+    кэша корпуса): текст читается только для отобранных находок.
+    """
+
+    def window(self, document_id: int, chunk_index: int, radius: int = 1) -> List[tuple]:
+        return get_chunk_window(document_id, chunk_index, radius)
+
+
+document_chunk_store = DocumentChunkStore()
 
 # ИЗМЕНЯЕМ функцию list_documents - теперь user_id это int
 def list_documents(user_id: int) -> List[Dict]:
@@ -243,6 +579,9 @@ def delete_document(user_id: int, document_id: int) -> bool:
         )
         deleted = cur.rowcount > 0
         conn.commit()
+
+    if deleted:
+        _notify_corpus_change("delete", user_id, document_id)
     return deleted
 
 # ИЗМЕНЯЕМ функцию delete_all_documents - теперь user_id это int
@@ -256,16 +595,23 @@ def delete_all_documents(user_id: int) -> int:
         )
         deleted_count = cur.rowcount
         conn.commit()
+
+    if deleted_count:
+        _notify_corpus_change("delete_all", user_id)
     return deleted_count
 
 # ============================================
 # ФУНКЦИИ ДЛЯ ШИФРОВАНИЯ ПАРОЛЕЙ
 # ============================================
 
-def hash_password(password: str, salt: Optional[str] = None) -> tuple[str, str]:
+def hash_password(
+    password: str,
+    salt: Optional[str] = None,
+    iterations: int = PASSWORD_HASH_ITERATIONS,
+) -> tuple[str, str]:
     """
     Превращает пароль "12345" в непонятный набор букв и цифр.
-    
+    Это долго (десятки миллисекунд) - из async-кода вызывать через auth_executor.
     """
     # Если соль не дали - создаем случайную
     if salt is None:
@@ -276,18 +622,24 @@ def hash_password(password: str, salt: Optional[str] = None) -> tuple[str, str]:
         'sha256',                    # алгоритм хеширования
         password.encode('utf-8'),    # пароль в байты
         salt.encode('utf-8'),         # соль в байты
-        100000                        # 100 тысяч итераций (чем больше, тем надежнее)
+        iterations                    # число итераций (чем больше, тем надежнее)
     )
     
     return salt, key.hex()  # возвращаем соль и хеш
 
-def verify_password(password: str, salt: str, password_hash: str) -> bool:
+def verify_password(
+    password: str,
+    salt: str,
+    password_hash: str,
+    iterations: int = PASSWORD_HASH_ITERATIONS,
+) -> bool:
     """
     Проверяет, правильный ли пароль ввел пользователь.
-    
+    iterations - с каким числом итераций посчитан сохраненный хэш.
     """
-    _, new_hash = hash_password(password, salt)
-    return new_hash == password_hash
+    _, new_hash = hash_password(password, salt, iterations)
+    # Сравнение за постоянное время, чтобы по времени ответа нельзя было подбирать хэш
+    return hmac.compare_digest(new_hash, password_hash)
 
 # ============================================
 # ФУНКЦИИ ДЛЯ СОЗДАНИЯ ПОЛЬЗОВАТЕЛЕЙ
@@ -309,18 +661,21 @@ def create_user(username: str, email: str, password: str) -> int:
         cur = conn.cursor()
         try:
             cur.execute("""
-                INSERT INTO users (username, email, password_hash, salt, created_at, role)
-                VALUES (?, ?, ?, ?, ?, ?)
-            """, (username, email, password_hash, salt, created_at, 'user'))
+                INSERT INTO users (username, email, password_hash, salt, created_at, role, password_iterations)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+            """, (username, email, password_hash, salt, created_at, 'user', PASSWORD_HASH_ITERATIONS))
             conn.commit()
             return cur.lastrowid  # возвращаем ID нового пользователя
             
         except sqlite3.IntegrityError as e:
+            # Откатываем сразу: иначе незавершенная запись держит блокировку БД,
+            # пока жив курсор (а его держит traceback исключения в потоке пула)
+            conn.rollback()
             # Обрабатываем ошибки (пользователь уже существует)
             if "username" in str(e):
-                raise ValueError("Имя пользователя уже занято")
+                raise ValueError("Имя пользователя уже занято") from None
             elif "email" in str(e):
-                raise ValueError("Email уже зарегистрирован")
+                raise ValueError("Email уже зарегистрирован") from None
             raise
 
 def get_user_by_username(username: str) -> Optional[Dict]:
@@ -369,7 +724,10 @@ def authenticate_user(username: str, password: str) -> Optional[Dict]:
         return None
     
     # Проверяем пароль
-    if verify_password(password, user['salt'], user['password_hash']):
+    if verify_password(password, user['salt'], user['password_hash'], user['password_iterations']):
+        # Хэш посчитан со старым числом итераций - пересчитываем, пока пароль известен
+        if user['password_iterations'] != PASSWORD_HASH_ITERATIONS:
+            _rehash_password(user['id'], password)
         # Возвращаем данные без пароля и соли, НО С РОЛЬЮ
         return {
             'id': user['id'],
@@ -380,6 +738,16 @@ def authenticate_user(username: str, password: str) -> Optional[Dict]:
         }
     return None
 
+def _rehash_password(user_id: int, password: str) -> None:
+    """Сохраняет хэш пароля, посчитанный с текущим PASSWORD_HASH_ITERATIONS"""
+    salt, password_hash = hash_password(password)
+    with get_conn() as conn:
+        conn.execute(
+            "UPDATE users SET password_hash = ?, salt = ?, password_iterations = ? WHERE id = ?",
+            (password_hash, salt, PASSWORD_HASH_ITERATIONS, user_id),
+        )
+        conn.commit()
+
 # ============================================
 # ФУНКЦИИ ДЛЯ СЕССИЙ (КТО ЗАЛОГИНЕН)
 # ============================================
@@ -405,14 +773,80 @@ def create_session(user_id: int) -> str:
     
     return token
 
+class SessionCache:
+    """
+    Кэш проверенных токенов: token -> пользователь.
+    Запись живет не дольше ttl_sec и не дольше самой сессии (expires_at);
+    при переполнении вытесняются давно не использованные.
+    delete_session, change_user_role и delete_user_by_id сбрасывают
+    затронутые записи сразу.
+    """
+
+    def __init__(self, max_entries: int, ttl_sec: float):
+        self.max_entries = max_entries
+        self.ttl_sec = ttl_sec
+        # token -> (пользователь, момент устаревания по time.monotonic())
+        self._entries: "OrderedDict[str, tuple]" = OrderedDict()
+        # Счетчик сбросов: не кладем в кэш то, что прочитано до сброса
+        self.generation = 0
+        self._lock = threading.Lock()
+
+    def get(self, token: str) -> Optional[Dict]:
+        with self._lock:
+            entry = self._entries.get(token)
+            if entry is None:
+                return None
+            if time.monotonic() >= entry[1]:
+                del self._entries[token]
+                return None
+            self._entries.move_to_end(token)
+            return dict(entry[0])
+
+    def put(self, token: str, user: Dict, expires_at: str, generation: int) -> None:
+        try:
+            session_left = (datetime.fromisoformat(expires_at) - datetime.now()).total_seconds()
+        except (TypeError, ValueError):
+            return
+        lifetime = min(self.ttl_sec, session_left)
+        if lifetime <= 0:
+            return
+        with self._lock:
+            if generation != self.generation:
+                return
+            self._entries[token] = (dict(user), time.monotonic() + lifetime)
+            self._entries.move_to_end(token)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def invalidate_token(self, token: str) -> None:
+        with self._lock:
+            self.generation += 1
+            self._entries.pop(token, None)
+
+    def invalidate_user(self, user_id: int) -> None:
+        with self._lock:
+            self.generation += 1
+            for token in [t for t, (user, _) in self._entries.items() if user["id"] == user_id]:
+                del self._entries[token]
+
+
+session_cache = SessionCache(SESSION_CACHE_MAX_ENTRIES, SESSION_CACHE_TTL_SEC)
+
+
 def get_user_by_token(token: str) -> Optional[Dict]:
     """
     По токену находит пользователя.
+    Повторные проверки того же токена берутся из session_cache, без БД.
     """
+    user = session_cache.get(token)
+    if user is not None:
+        return user
+
+    generation = session_cache.generation
     with get_conn() as conn:
         cur = conn.cursor()
         cur.execute("""
-            SELECT u.id, u.username, u.email, u.created_at, u.role
+            SELECT u.id, u.username, u.email, u.created_at, u.role, s.expires_at
             FROM users u
             JOIN sessions s ON s.user_id = u.id
             WHERE s.token = ? AND s.expires_at > datetime('now')
@@ -421,7 +855,10 @@ def get_user_by_token(token: str) -> Optional[Dict]:
         row = cur.fetchone()
         if row:
             columns = [description[0] for description in cur.description]
-            return dict(zip(columns, row))
+            user = dict(zip(columns, row))
+            expires_at = user.pop("expires_at")
+            session_cache.put(token, user, expires_at, generation)
+            return user
         return None
 
 def delete_session(token: str) -> bool:
@@ -434,6 +871,7 @@ def delete_session(token: str) -> bool:
         cur.execute("DELETE FROM sessions WHERE token = ?", (token,))
         deleted = cur.rowcount > 0  # сколько строк удалено
         conn.commit()
+    session_cache.invalidate_token(token)
     return deleted
 
 
@@ -500,8 +938,12 @@ def delete_user_by_id(user_id: int) -> bool:
         # Удаляем пользователя (всё остальное удалится каскадно)
         cur.execute("DELETE FROM users WHERE id = ?", (user_id,))
         conn.commit()
-        
-        return cur.rowcount > 0
+        deleted = cur.rowcount > 0
+
+    session_cache.invalidate_user(user_id)
+    if deleted:
+        _notify_corpus_change("delete_all", user_id)
+    return deleted
 
 def get_all_documents_admin() -> List[Dict]:
     """
@@ -551,16 +993,20 @@ def delete_any_document(document_id: int) -> bool:
     with get_conn() as conn:
         cur = conn.cursor()
         
-        # Проверяем, есть ли такой документ
-        cur.execute("SELECT id FROM documents WHERE id = ?", (document_id,))
-        if not cur.fetchone():
+        # Проверяем, есть ли такой документ (и заодно узнаем владельца)
+        cur.execute("SELECT user_id FROM documents WHERE id = ?", (document_id,))
+        row = cur.fetchone()
+        if not row:
             return False
         
         # Удаляем документ (чанки удалятся каскадно)
         cur.execute("DELETE FROM documents WHERE id = ?", (document_id,))
         conn.commit()
-        
-        return cur.rowcount > 0
+        deleted = cur.rowcount > 0
+
+    if deleted:
+        _notify_corpus_change("delete", row[0], document_id)
+    return deleted
 
 def change_user_role(user_id: int, new_role: str) -> bool:
     """
@@ -587,7 +1033,11 @@ def change_user_role(user_id: int, new_role: str) -> bool:
         """, (new_role, user_id))
         
         conn.commit()
-        return cur.rowcount > 0
+        changed = cur.rowcount > 0
+
+    # Роль в кэше сессий устарела - пусть перечитается из БД
+    session_cache.invalidate_user(user_id)
+    return changed
 
 def get_user_stats(user_id: int) -> Dict:
     """
@@ -1,12 +1,67 @@
 # Чтение документов и функции поиска
+import heapq
+import io
 import os
 import json
-from typing import List, Dict
+from typing import List, Dict, Optional, Tuple, Union, BinaryIO, Iterable, Iterator, Callable
+import numpy as np
 import PyPDF2
 from docx import Document
 
-from config import SUPPORTED_EXTENSIONS, CHUNK_SIZE
-from utils import extract_semantic_chunks, should_skip_file, extract_keywords
+from config import SUPPORTED_EXTENSIONS
+from utils import should_skip_file
+from bm25 import BM25Index
+from query import CompiledQuery
+
+
+def extract_text(source: Union[str, BinaryIO], ext: str) -> str:
+    """
+    Извлекает текст документа. source - путь к файлу или бинарный поток
+    (например, BytesIO с загруженным файлом). Ошибки не перехватываются.
+    """
+    if ext == '.pdf':
+        return "\n".join(text for _, text in extract_pdf_pages(source))
+
+    elif ext == '.docx':
+        doc = Document(source)
+        return "\n".join([para.text for para in doc.paragraphs])
+
+    elif ext in ['.txt', '.md', '.json']:
+        if isinstance(source, str):
+            with open(source, 'r', encoding='utf-8') as f:
+                text = f.read()
+        else:
+            text = io.TextIOWrapper(source, encoding='utf-8').read()
+        if ext == '.json':
+            return json.dumps(json.loads(text), ensure_ascii=False, indent=2)
+        return text
+
+    else:
+        return ""
+
+
+def pdf_page_count(source: Union[str, BinaryIO]) -> int:
+    """Число страниц в PDF"""
+    return len(PyPDF2.PdfReader(source).pages)
+
+
+def extract_pdf_pages(
+    source: Union[str, BinaryIO],
+    start: int = 0,
+    end: Optional[int] = None,
+) -> List[Tuple[int, str]]:
+    """
+    Текст страниц PDF с start по end (не включая, нумерация с 0).
+    Возвращает пары (номер страницы с 1, текст), пустые страницы пропускаются.
+    """
+    pages = PyPDF2.PdfReader(source).pages
+    end = len(pages) if end is None else min(end, len(pages))
+    result = []
+    for number in range(start, end):
+        text = pages[number].extract_text()
+        if text:
+            result.append((number + 1, text))
+    return result
 
 
 def read_document(file_path: str) -> str:
@@ -19,92 +74,67 @@ def read_document(file_path: str) -> str:
     ext = os.path.splitext(file_path)[1].lower()
     
     try:
-        if ext == '.pdf':
-            with open(file_path, 'rb') as f:
-                pdf_reader = PyPDF2.PdfReader(f)
-                content = []
-                for page in pdf_reader.pages:
-                    text = page.extract_text()
-                    if text:
-                        content.append(text)
-                return "\n".join(content)
-        
-        elif ext == '.docx':
-            doc = Document(file_path)
-            return "\n".join([para.text for para in doc.paragraphs])
-        
-        elif ext in ['.txt', '.md']:
-            with open(file_path, 'r', encoding='utf-8') as f:
-                return f.read()
-        
-        elif ext == '.json':
-            with open(file_path, 'r', encoding='utf-8') as f:
-                data = json.load(f)
-                return json.dumps(data, ensure_ascii=False, indent=2)
-        
-        else:
-            return ""
-            
+        return extract_text(file_path, ext)
     except Exception as e:
         if not should_skip_file(filename):
             print(f"Ошибка чтения {file_path}: {e}")
         return ""
 
 
-def semantic_search(query: str, content: str, filename: str) -> List[Dict]:
-    """Умный семантический поиск по контенту"""
-    query_lower = query.lower()
-    
-    keywords = extract_keywords(query)
-    
-    chunks = extract_semantic_chunks(content, CHUNK_SIZE)
-    results = []
-    
-    for chunk_idx, chunk in enumerate(chunks):
-        chunk_lower = chunk.lower()
-        
-        relevance_score = 0
-        
-        for keyword in keywords:
-            if keyword in chunk_lower:
-                position = chunk_lower.find(keyword)
-                if position != -1:
-                    position_bonus = max(0, 100 - position)
-                    relevance_score += 1 + (position_bonus / 100)
-        
-        if len(keywords) >= 2:
-            for i in range(len(keywords) - 1):
-                bigram = f"{keywords[i]} {keywords[i+1]}"
-                if bigram in chunk_lower:
-                    relevance_score += 3
-        
-        query_words = query.split()
-        for word in query_words:
-            if word and word[0].isupper() and len(word) > 1:
-                if word.lower() in chunk_lower:
-                    relevance_score += 2
-
-        if relevance_score > 0:
-            chunk_start = max(0, chunk_idx - 1)
-            chunk_end = min(len(chunks), chunk_idx + 2)
-            
-            context_parts = []
-            for i in range(chunk_start, chunk_end):
-                if i == chunk_idx:
-                    context_parts.append(f"[НАЙДЕННОЕ] {chunks[i]}")
-                else:
-                    context_parts.append(chunks[i])
-            
-            context_text = "\n[...]\n".join(context_parts)
-            
-            found_keywords = [kw for kw in keywords if kw in chunk_lower]
-            
-            results.append({
-                "filename": filename,
-                "relevance_score": round(relevance_score, 2),
-                "found_words": found_keywords[:5], 
-                "context": context_text,
-                "chunk_index": chunk_idx
-            })
+def search_chunks(
+    query: CompiledQuery,
+    chunks: List[str],
+    filename: str,
+    index: Optional[BM25Index] = None,
+    document_id=None,
+) -> Iterator[Dict]:
+    """
+    Ранжирует уже разбитый на чанки документ (BM25) по разобранному запросу.
+    index - готовый BM25-индекс по этим чанкам, если он уже построен.
+    Генератор: находки отдаются по одной, в порядке чанков. Находка - только
+    ссылка на чанк (document_id, chunk_index) с оценкой и найденными словами,
+    текст контекста для нее собирает context_packer.pack_context.
+    """
+    if index is None:
+        index = BM25Index(chunks)
+    scores = index.score(query)
     
-    return results
\ No newline at end of file
+    for chunk_idx in np.flatnonzero(scores > 0):
+        chunk_idx = int(chunk_idx)
+        yield {
+            "document_id": document_id,
+            "filename": filename,
+            "relevance_score": round(float(scores[chunk_idx]), 2),
+            "found_words": index.found_words(chunk_idx, query)[:5], 
+            "chunk_index": chunk_idx
+        }
+
+
+def top_k_hits(
+    groups: Iterable[Tuple[float, Callable[[], Iterable[Dict]]]],
+    k: int,
+) -> List[Dict]:
+    """
+    k лучших находок по relevance_score из нескольких групп (документов).
+
+    groups - пары (верхняя граница оценки в группе, функция, отдающая
+    находки группы). Группы перебираются по убыванию границы; находки
+    проходят через кучу размера k, поэтому в памяти не больше k находок.
+    Как только граница очередной группы ниже k-й лучшей оценки, остальные
+    группы не просматриваются вовсе - обогнать уже найденное они не могут.
+    """
+    heap: List[tuple] = []
+    seq = 0
+    for bound, hits in sorted(groups, key=lambda group: group[0], reverse=True):
+        if len(heap) >= k and bound < heap[0][0]:
+            break
+        for hit in hits():
+            seq += 1
+            # seq - чтобы при равных оценках не сравнивать сами словари
+            item = (hit["relevance_score"], -seq, hit)
+            if len(heap) < k:
+                heapq.heappush(heap, item)
+            elif item[:2] > heap[0][:2]:
+                heapq.heapreplace(heap, item)
+
+    return [hit for _, _, hit in sorted(heap, key=lambda item: item[:2], reverse=True)]
@@ -0,0 +1,288 @@
+# Векторные представления чанков (sentence-transformers) и плотный поиск
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Dict, Optional
+
+import numpy as np
+
+from config import (
+    EMBEDDING_MODEL, EMBEDDING_DTYPE, EMBEDDING_BATCH_SIZE, DENSE_MIN_SIMILARITY,
+    ANN_EXACT_SEARCH, ANN_CACHE_MAX_BYTES,
+)
+from ann_index import IVFIndex
+from query import CompiledQuery
+import db
+
+try:
+    from sentence_transformers import SentenceTransformer
+except ImportError:  # библиотека не установлена - работает только поиск по словам
+    SentenceTransformer = None
+
+# Модель загружается один раз, при первом обращении
+_model = None
+
+# Первый байт блоба - формат хранения
+_FLOAT16 = b"h"
+_INT8 = b"b"
+
+
+def embeddings_available() -> bool:
+    """Можно ли считать эмбеддинги (установлена ли sentence-transformers)"""
+    return SentenceTransformer is not None
+
+
+def get_model():
+    """Возвращает модель эмбеддингов (только CPU)"""
+    global _model
+    if _model is None and embeddings_available():
+        _model = SentenceTransformer(EMBEDDING_MODEL, device="cpu")
+    return _model
+
+
+def encode(texts: List[str]) -> Optional[np.ndarray]:
+    """
+    Считает нормированные эмбеддинги для списка текстов.
+    Возвращает матрицу float32 (по строке на текст) или None, если модели нет.
+    """
+    model = get_model()
+    if model is None or not texts:
+        return None
+    vectors = model.encode(
+        texts,
+        batch_size=EMBEDDING_BATCH_SIZE,
+        normalize_embeddings=True,
+        convert_to_numpy=True,
+        show_progress_bar=False,
+    )
+    return vectors.astype(np.float32)
+
+
+def to_blob(vector: np.ndarray) -> bytes:
+    """
+    Упаковывает нормированный вектор в компактный блоб.
+    int8: компоненты нормированного вектора лежат в [-1, 1], масштаб 127.
+    """
+    if EMBEDDING_DTYPE == "int8":
+        quantized = np.clip(np.round(vector * 127), -127, 127).astype(np.int8)
+        return _INT8 + quantized.tobytes()
+    return _FLOAT16 + vector.astype(np.float16).tobytes()
+
+
+def from_blob(blob: bytes) -> np.ndarray:
+    """Распаковывает блоб обратно в вектор float32"""
+    kind, data = blob[:1], blob[1:]
+    if kind == _INT8:
+        return np.frombuffer(data, dtype=np.int8).astype(np.float32) / 127
+    return np.frombuffer(data, dtype=np.float16).astype(np.float32)
+
+
+def encode_chunks(chunks: List[str]) -> Optional[List[bytes]]:
+    """Эмбеддинги чанков в виде блобов для сохранения в БД (при загрузке)"""
+    vectors = encode(chunks)
+    if vectors is None:
+        return None
+    return [to_blob(vector) for vector in vectors]
+
+
+def _load_chunk_vectors(user_id: int, document_id: Optional[int] = None):
+    """
+    Загружает чанки (без текста) и их векторы из БД.
+    Блобы распаковываются сразу по мере чтения курсора и в памяти не копятся.
+    Чанки, загруженные до появления эмбеддингов, досчитываются один раз.
+    Возвращает (чанки, матрица float32) или ([], None).
+    """
+    chunks, vectors, missing = [], [], []
+    for chunk in db.iter_user_chunk_embeddings(user_id, document_id):
+        blob = chunk.pop("embedding")
+        text = chunk.pop("text")
+        if blob is None:
+            missing.append((len(chunks), chunk["id"], text))
+            vectors.append(None)
+        else:
+            vectors.append(from_blob(blob))
+        chunks.append(chunk)
+
+    if missing:
+        blobs = encode_chunks([text for _, _, text in missing])
+        if blobs is None:
+            return [], None
+        for (row, _, _), blob in zip(missing, blobs):
+            vectors[row] = from_blob(blob)
+        db.set_chunk_embeddings([(chunk_id, blob) for (_, chunk_id, _), blob in zip(missing, blobs)])
+
+    if not chunks:
+        return [], None
+
+    return chunks, np.vstack(vectors)
+
+
+class UserAnn:
+    """
+    ANN-индекс одного пользователя вместе с данными о чанках
+    (chunks: chunk_id -> чанк, doc_chunks: document_id -> [chunk_id]).
+    Поиск и изменения идут из разных потоков, поэтому все под self.lock.
+    """
+
+    def __init__(self, chunks: List[Dict], matrix: np.ndarray):
+        self.index = IVFIndex(matrix.shape[1])
+        self.chunks: Dict[int, Dict] = {}
+        self.doc_chunks: Dict[int, List[int]] = {}
+        self.lock = threading.Lock()
+        # Сколько байт учтено в AnnCache.total_bytes
+        self.accounted_bytes = 0
+        self.add(chunks, matrix)
+
+    @property
+    def size_bytes(self) -> int:
+        return self.index.nbytes + len(self.chunks) * 200
+
+    def add(self, chunks: List[Dict], matrix: np.ndarray) -> None:
+        """Добавляет чанки в индекс (сначала данные о чанках, потом векторы)"""
+        with self.lock:
+            for chunk in chunks:
+                self.chunks[chunk["id"]] = chunk
+                self.doc_chunks.setdefault(chunk["document_id"], []).append(chunk["id"])
+            self.index.add([chunk["id"] for chunk in chunks], matrix)
+
+    def remove_document(self, document_id: int) -> None:
+        with self.lock:
+            chunk_ids = self.doc_chunks.pop(document_id, [])
+            self.index.remove(chunk_ids)
+            for chunk_id in chunk_ids:
+                self.chunks.pop(chunk_id, None)
+
+    def search(self, query_vector: np.ndarray, top_k: int) -> List[Dict]:
+        """top_k ближайших чанков с близостью не ниже DENSE_MIN_SIMILARITY"""
+        with self.lock:
+            ids, scores = self.index.search(query_vector, top_k, exact=ANN_EXACT_SEARCH)
+            return [
+                {**self.chunks[int(chunk_id)], "relevance_score": round(float(score), 2)}
+                for chunk_id, score in zip(ids, scores)
+                if score >= DENSE_MIN_SIMILARITY
+            ]
+
+
+class AnnCache:
+    """
+    LRU-кэш ANN-индексов пользователей с ограничением по объему памяти.
+    Индекс строится целиком при первом плотном поиске пользователя, дальше
+    изменения документов применяются к нему на месте (через db.add_corpus_listener).
+    Слушатель вызывается прямо из удаления/сохранения документа (в том числе
+    из обработчиков запросов), поэтому сами изменения применяются в фоновом
+    потоке - по одному, в порядке поступления.
+    """
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.total_bytes = 0
+        self._entries: "OrderedDict[int, UserAnn]" = OrderedDict()
+        # Счетчик изменений: не кладем в кэш индекс, построенный до изменения
+        self._generations: Dict[int, int] = {}
+        self._lock = threading.Lock()
+        # Один поток - изменения применяются строго по порядку
+        self._updates = ThreadPoolExecutor(max_workers=1, thread_name_prefix="ann-update")
+
+    def get(self, user_id: int) -> Optional[UserAnn]:
+        """Индекс пользователя (строится при промахе); None - эмбеддингов нет"""
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is not None:
+                self._entries.move_to_end(user_id)
+                return entry
+            generation = self._generations.get(user_id, 0)
+
+        chunks, matrix = _load_chunk_vectors(user_id)
+        if matrix is None:
+            return None
+        entry = UserAnn(chunks, matrix)
+
+        with self._lock:
+            if self._generations.get(user_id, 0) == generation and user_id not in self._entries:
+                self._entries[user_id] = entry
+                self._account(entry)
+        return entry
+
+    def on_corpus_change(self, event: str, user_id: int, document_id: Optional[int]) -> None:
+        """
+        Слушатель изменений документов: только отмечает изменение и ставит
+        его в очередь фонового потока (_apply), сам индекс не трогает.
+        """
+        with self._lock:
+            self._generations[user_id] = self._generations.get(user_id, 0) + 1
+            entry = self._entries.get(user_id)
+            if entry is None:
+                # Индекс еще не строился - построится при первом поиске
+                return
+            if event not in ("save", "delete"):
+                del self._entries[user_id]
+                self.total_bytes -= entry.accounted_bytes
+                return
+        self._updates.submit(self._apply, user_id, entry, event, document_id)
+
+    def _apply(self, user_id: int, entry: UserAnn, event: str, document_id: Optional[int]) -> None:
+        """
+        Применяет изменение к индексу (в фоновом потоке): новые чанки
+        добавляются в индекс, удаленные помечаются как удаленные.
+        """
+        with self._lock:
+            if self._entries.get(user_id) is not entry:
+                # Индекс уже выброшен или перестроен - с изменением или без него
+                return
+        try:
+            if event == "save":
+                chunks, matrix = _load_chunk_vectors(user_id, document_id)
+                if matrix is None:
+                    self.invalidate(user_id)
+                    return
+                entry.add(chunks, matrix)
+            else:
+                entry.remove_document(document_id)
+        except Exception as e:
+            print(f"Не удалось обновить индекс эмбеддингов пользователя {user_id}: {e}")
+            self.invalidate(user_id)
+            return
+
+        with self._lock:
+            if self._entries.get(user_id) is entry:
+                self._account(entry)
+
+    def invalidate(self, user_id: int) -> None:
+        with self._lock:
+            self._generations[user_id] = self._generations.get(user_id, 0) + 1
+            entry = self._entries.pop(user_id, None)
+            if entry is not None:
+                self.total_bytes -= entry.accounted_bytes
+
+    def _account(self, entry: UserAnn) -> None:
+        """Пересчитывает объем индекса и выбрасывает лишнее (под self._lock)"""
+        size = entry.size_bytes
+        self.total_bytes += size - entry.accounted_bytes
+        entry.accounted_bytes = size
+        while self.total_bytes > self.max_bytes and len(self._entries) > 1:
+            _, evicted = self._entries.popitem(last=False)
+            self.total_bytes -= evicted.accounted_bytes
+
+
+ann_cache = AnnCache(ANN_CACHE_MAX_BYTES)
+
+db.add_corpus_listener(ann_cache.on_corpus_change)
+
+
+def dense_search(query: CompiledQuery, user_id: int, top_k: int) -> List[Dict]:
+    """
+    Плотный поиск: косинусная близость вопроса к чанкам пользователя.
+    Используется ANN-индекс (ANN_NPROBE задает баланс полноты и скорости),
+    при ANN_EXACT_SEARCH = True - точный перебор всех чанков.
+    Возвращает top_k лучших чанков с близостью не ниже DENSE_MIN_SIMILARITY.
+    """
+    entry = ann_cache.get(user_id)
+    if entry is None:
+        return []
+
+    # Эмбеддинг считается по исходному тексту вопроса
+    query_vector = encode([query.text])
+    if query_vector is None:
+        return []
+
+    return entry.search(query_vector[0], top_k)
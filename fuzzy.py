@@ -0,0 +1,99 @@
+# Поиск слов с опечатками по словарю корпуса через индекс триграмм
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+from config import FUZZY_MIN_LENGTH, FUZZY_MAX_EDITS
+
+
+def _trigrams(word: str) -> set:
+    """Триграммы слова; "$" отмечает начало, чтобы первые буквы тоже давали триграммы"""
+    padded = f"$${word}"
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+def max_edits(word: str) -> int:
+    """
+    Сколько опечаток допускается в слове. Не больше (длина - 2) // 3 - иначе
+    у слова с опечатками может не остаться общих триграмм с правильным.
+    """
+    if len(word) < FUZZY_MIN_LENGTH:
+        return 0
+    return min(FUZZY_MAX_EDITS, (len(word) - 2) // 3)
+
+
+def prefix_distance(word: str, term: str, limit: int) -> Tuple[int, int]:
+    """
+    Наименьшее расстояние Левенштейна от word до начала term (слова запроса
+    ищутся как префиксы) и длина этого начала. Если больше limit - (limit + 1, 0).
+    """
+    previous = list(range(len(term) + 1))
+    for i, char in enumerate(word, 1):
+        current = [i]
+        for j, term_char in enumerate(term, 1):
+            current.append(min(
+                previous[j] + 1,
+                current[j - 1] + 1,
+                previous[j - 1] + (char != term_char),
+            ))
+        if min(current) > limit:
+            return limit + 1, 0
+        previous = current
+    best = min(previous)
+    if best > limit:
+        return limit + 1, 0
+    # Из равных по расстоянию - начало, по длине ближе к слову запроса
+    length = min(
+        (j for j, distance in enumerate(previous) if distance == best),
+        key=lambda j: abs(j - len(word)),
+    )
+    return best, length
+
+
+class TrigramIndex:
+    """
+    Индекс триграмм по словарю (terms - слова словаря BM25-индекса).
+
+    Кандидаты для слова с опечаткой находятся через индекс: у слова,
+    отличающегося на d правок, общих триграмм не меньше, чем
+    (триграмм в слове - 3 * d), - их число считается по спискам триграмм
+    одним bincount. Расстояние Левенштейна считается только для этих
+    кандидатов, а не для всего словаря.
+    """
+
+    def __init__(self, terms: List[str]):
+        self.terms = terms
+        postings: Dict[str, List[int]] = {}
+        for term_id, term in enumerate(terms):
+            for trigram in _trigrams(term):
+                postings.setdefault(trigram, []).append(term_id)
+        self.postings = {trigram: np.asarray(ids, dtype=np.int32) for trigram, ids in postings.items()}
+        self.lengths = np.fromiter((len(term) for term in terms), dtype=np.int32, count=len(terms))
+
+    def similar(self, word: str, limit: Optional[int] = None) -> List[Tuple[int, str]]:
+        """
+        Начала слов словаря, отличающиеся от word не больше чем на limit правок:
+        пары (расстояние, начало слова), ближайшие первыми.
+        """
+        if limit is None:
+            limit = max_edits(word)
+        if not limit or not self.terms:
+            return []
+
+        trigrams = _trigrams(word)
+        lists = [self.postings[trigram] for trigram in trigrams if trigram in self.postings]
+        if not lists:
+            return []
+        shared = np.bincount(np.concatenate(lists), minlength=len(self.terms))
+        candidates = np.flatnonzero(
+            (shared >= len(trigrams) - 3 * limit) & (self.lengths >= len(word) - limit)
+        )
+
+        found: Dict[str, int] = {}
+        for term_id in candidates:
+            term = self.terms[term_id]
+            distance, length = prefix_distance(word, term[:len(word) + limit], limit)
+            if 0 < distance <= limit:
+                prefix = term[:length]
+                found[prefix] = min(distance, found.get(prefix, distance))
+        return sorted((distance, prefix) for prefix, distance in found.items())
@@ -0,0 +1,362 @@
+# Фоновая обработка загруженных документов (задачи с id и прогрессом)
+import asyncio
+import codecs
+import io
+import os
+import tempfile
+import threading
+import time
+import uuid
+from datetime import datetime
+from typing import List, Dict, Optional, Tuple, Union
+
+from python_multipart.multipart import MultipartParser, parse_options_header
+
+from config import (
+    SUPPORTED_EXTENSIONS, INGEST_WORKERS, INGEST_JOB_TTL_SEC,
+    INGEST_MAX_ACTIVE_JOBS, INGEST_MAX_ACTIVE_JOBS_PER_USER,
+    UPLOAD_MAX_FILE_BYTES, UPLOAD_MAX_REQUEST_BYTES, PDF_MIN_PAGES_PER_TASK,
+)
+from sandbox import extractor_pool, ExtractionError, parse_upload, count_pdf_pages, parse_pdf_pages
+from embeddings import encode_chunks
+from bloom import DocumentBloom
+from corpus_cache import corpus_cache
+import db
+
+# Этапы обработки документа, в порядке выполнения
+STAGES = ["parsing", "embedding", "saving"]
+
+# Задачи: job_id -> состояние
+_jobs: Dict[str, Dict] = {}
+_jobs_lock = threading.Lock()
+
+# Задачи в этих состояниях держат файл в памяти и считаются в лимитах
+_ACTIVE_STATUSES = ("receiving", "queued", "running")
+
+# Ссылки на запущенные asyncio-задачи, чтобы их не собрал сборщик мусора
+_running_tasks = set()
+
+
+def split_pages(page_count: int) -> List[Tuple[int, int]]:
+    """
+    Делит страницы на диапазоны для процессов: не больше двух на процесс
+    (чтобы выровнять нагрузку) и не меньше PDF_MIN_PAGES_PER_TASK страниц в каждом.
+    """
+    if not page_count:
+        return []
+    tasks = max(1, min(INGEST_WORKERS * 2, page_count // PDF_MIN_PAGES_PER_TASK))
+    step = -(-page_count // tasks)
+    return [(start, min(start + step, page_count)) for start in range(0, page_count, step)]
+
+
+def _write_temp_pdf(payload: bytes) -> str:
+    """Сохраняет загруженный PDF во временный файл, возвращает путь"""
+    with tempfile.NamedTemporaryFile(suffix='.pdf', delete=False) as tmp:
+        tmp.write(payload)
+        return tmp.name
+
+
+async def parse_payload(
+    payload: Union[str, bytes],
+    filename: str,
+) -> Tuple[List[str], Optional[List[int]]]:
+    """
+    Разбирает загрузку в изолированных процессах (sandbox.extractor_pool).
+    Возвращает (чанки, номера страниц).
+    PDF разбирается постранично: диапазоны страниц обрабатываются параллельно,
+    порядок страниц сохраняется. У остальных форматов номеров страниц нет (None).
+    Если разобрать не удалось - ExtractionError с причиной.
+    """
+    ext = os.path.splitext(filename)[1].lower()
+
+    if isinstance(payload, bytes) and ext == '.pdf':
+        # Файл пишется на диск один раз: обработчикам уходят путь и диапазон страниц,
+        # а не копия всех байт на каждый диапазон (и в лимит памяти каждого процесса)
+        path = await asyncio.to_thread(_write_temp_pdf, payload)
+        try:
+            page_count = await extractor_pool.arun(ext, count_pdf_pages, path)
+            parts = await asyncio.gather(*(
+                extractor_pool.arun(ext, parse_pdf_pages, path, start, end)
+                for start, end in split_pages(page_count)
+            ))
+        finally:
+            os.remove(path)
+        pairs = [pair for part in parts for pair in part]
+        chunks, pages = [chunk for _, chunk in pairs], [number for number, _ in pairs]
+    else:
+        chunks = await extractor_pool.arun(ext, parse_upload, payload, filename)
+        pages = None
+
+    if not chunks:
+        raise ExtractionError("empty", "Не удалось прочитать содержимое файла")
+    return chunks, pages
+
+
+class UploadTooLarge(Exception):
+    """Загрузка превысила UPLOAD_MAX_FILE_BYTES или UPLOAD_MAX_REQUEST_BYTES"""
+
+
+class _UploadSink:
+    """
+    Принимает содержимое файла по частям, по мере чтения запроса.
+    txt/md декодируются инкрементально (в памяти только текст),
+    остальные форматы собираются в BytesIO для PyPDF2/python-docx.
+    """
+
+    def __init__(self, filename: str):
+        self.filename = filename
+        self.size = 0
+        ext = os.path.splitext(filename)[1].lower()
+        if ext in ['.txt', '.md']:
+            self.decoder = codecs.getincrementaldecoder('utf-8')()
+            self.parts: List[str] = []
+        else:
+            self.decoder = None
+            self.buffer = io.BytesIO()
+
+    def write(self, data: bytes) -> None:
+        self.size += len(data)
+        if self.size > UPLOAD_MAX_FILE_BYTES:
+            raise UploadTooLarge(f"Файл больше {UPLOAD_MAX_FILE_BYTES // (1024 * 1024)} МБ")
+        if self.decoder is not None:
+            try:
+                self.parts.append(self.decoder.decode(data))
+            except UnicodeDecodeError:
+                raise ValueError("Текстовый файл должен быть в кодировке UTF-8")
+        else:
+            self.buffer.write(data)
+
+    def result(self) -> Union[str, bytes]:
+        if self.decoder is not None:
+            try:
+                self.parts.append(self.decoder.decode(b"", final=True))
+            except UnicodeDecodeError:
+                raise ValueError("Текстовый файл должен быть в кодировке UTF-8")
+            return "".join(self.parts)
+        return self.buffer.getvalue()
+
+
+async def receive_upload(request, field_name: str = "file") -> Tuple[str, Union[str, bytes]]:
+    """
+    Читает multipart-запрос потоком и возвращает (имя файла, содержимое).
+    Файл не пишется на диск; лимиты на размер файла и всего запроса
+    проверяются по мере чтения, и при превышении чтение сразу прерывается
+    (UploadTooLarge). Неверный запрос - ValueError.
+    """
+    content_length = request.headers.get("content-length")
+    if content_length and content_length.isdigit() and int(content_length) > UPLOAD_MAX_REQUEST_BYTES:
+        raise UploadTooLarge(f"Запрос больше {UPLOAD_MAX_REQUEST_BYTES // (1024 * 1024)} МБ")
+
+    content_type, params = parse_options_header(request.headers.get("content-type", ""))
+    boundary = params.get(b"boundary")
+    if content_type != b"multipart/form-data" or not boundary:
+        raise ValueError("Ожидается multipart/form-data")
+
+    state = {"header_field": b"", "header_value": b"", "headers": {}, "sink": None, "file": None}
+
+    def on_part_begin() -> None:
+        state["headers"] = {}
+        state["sink"] = None
+
+    def on_header_field(data: bytes, start: int, end: int) -> None:
+        state["header_field"] += data[start:end]
+
+    def on_header_value(data: bytes, start: int, end: int) -> None:
+        state["header_value"] += data[start:end]
+
+    def on_header_end() -> None:
+        state["headers"][state["header_field"].lower()] = state["header_value"]
+        state["header_field"] = b""
+        state["header_value"] = b""
+
+    def on_headers_finished() -> None:
+        _, options = parse_options_header(state["headers"].get(b"content-disposition", b""))
+        name = options.get(b"name", b"").decode("utf-8", "replace")
+        if name == field_name and b"filename" in options and state["file"] is None:
+            filename = os.path.basename(options[b"filename"].decode("utf-8", "replace"))
+            ext = os.path.splitext(filename)[1].lower()
+            if ext not in SUPPORTED_EXTENSIONS:
+                raise ValueError(f"Формат {ext or '(без расширения)'} не поддерживается")
+            state["sink"] = _UploadSink(filename)
+
+    def on_part_data(data: bytes, start: int, end: int) -> None:
+        # Остальные поля формы не нужны - их данные просто пропускаются
+        if state["sink"] is not None:
+            state["sink"].write(data[start:end])
+
+    def on_part_end() -> None:
+        if state["sink"] is not None:
+            state["file"] = state["sink"]
+            state["sink"] = None
+
+    parser = MultipartParser(boundary, {
+        "on_part_begin": on_part_begin,
+        "on_part_data": on_part_data,
+        "on_part_end": on_part_end,
+        "on_header_field": on_header_field,
+        "on_header_value": on_header_value,
+        "on_header_end": on_header_end,
+        "on_headers_finished": on_headers_finished,
+    })
+
+    received = 0
+    async for block in request.stream():
+        received += len(block)
+        if received > UPLOAD_MAX_REQUEST_BYTES:
+            raise UploadTooLarge(f"Запрос больше {UPLOAD_MAX_REQUEST_BYTES // (1024 * 1024)} МБ")
+        parser.write(block)
+    parser.finalize()
+
+    upload = state["file"]
+    if upload is None or not upload.filename:
+        raise ValueError("В запросе нет файла")
+    return upload.filename, upload.result()
+
+
+class IngestBusy(Exception):
+    """
+    Слишком много незавершенных загрузок. scope - чей лимит исчерпан:
+    "user" (INGEST_MAX_ACTIVE_JOBS_PER_USER) или "server" (INGEST_MAX_ACTIVE_JOBS).
+    """
+
+    def __init__(self, scope: str, message: str):
+        super().__init__(message)
+        self.scope = scope
+
+
+def create_job(user_id: int) -> Dict:
+    """
+    Регистрирует новую задачу загрузки - до чтения файла, чтобы сверх
+    лимитов файлы не принимались в память вовсе. Если лимит исчерпан - IngestBusy.
+    Имя файла задается в start_job; задачу без файла убирает discard_job.
+    """
+    _cleanup_jobs()
+    job = {
+        "job_id": uuid.uuid4().hex,
+        "user_id": user_id,
+        "filename": None,
+        "status": "receiving",   # receiving -> queued -> running -> done / error
+        "stage": None,
+        "stages": {stage: "pending" for stage in STAGES},
+        "document_id": None,
+        "chunks": None,
+        "message": None,
+        "reason": None,          # причина ошибки разбора (см. sandbox.ExtractionError)
+        "created_at": datetime.utcnow().isoformat(),
+        "finished_at": None,
+    }
+    with _jobs_lock:
+        active = [other for other in _jobs.values() if other["status"] in _ACTIVE_STATUSES]
+        if sum(other["user_id"] == user_id for other in active) >= INGEST_MAX_ACTIVE_JOBS_PER_USER:
+            raise IngestBusy(
+                "user", f"Уже обрабатываются {INGEST_MAX_ACTIVE_JOBS_PER_USER} ваших файла, дождитесь их"
+            )
+        if len(active) >= INGEST_MAX_ACTIVE_JOBS:
+            raise IngestBusy("server", "Сервер перегружен загрузками, попробуйте позже")
+        _jobs[job["job_id"]] = job
+    return job
+
+
+def discard_job(job: Dict) -> None:
+    """Убирает задачу, файл для которой так и не был принят"""
+    with _jobs_lock:
+        _jobs.pop(job["job_id"], None)
+
+
+def get_job(job_id: str, user_id: int) -> Optional[Dict]:
+    """Состояние задачи (только для ее владельца)"""
+    with _jobs_lock:
+        job = _jobs.get(job_id)
+        if job is None or job["user_id"] != user_id:
+            return None
+        return {**job, "stages": dict(job["stages"])}
+
+
+def _set_stage(job: Dict, stage: str, state: str) -> None:
+    with _jobs_lock:
+        job["stage"] = stage
+        job["stages"][stage] = state
+
+
+def _finish(job: Dict, status: str, message: Optional[str] = None) -> None:
+    with _jobs_lock:
+        job["status"] = status
+        job["message"] = message
+        job["finished_at"] = time.time()
+        if status == "error" and job["stage"]:
+            job["stages"][job["stage"]] = "error"
+
+
+def _cleanup_jobs() -> None:
+    """Забывает завершенные задачи старше INGEST_JOB_TTL_SEC"""
+    now = time.time()
+    with _jobs_lock:
+        expired = [
+            job_id for job_id, job in _jobs.items()
+            if job["finished_at"] and now - job["finished_at"] > INGEST_JOB_TTL_SEC
+        ]
+        for job_id in expired:
+            del _jobs[job_id]
+
+
+async def run_job(job: Dict, payload: Union[str, bytes]) -> None:
+    """
+    Обрабатывает загрузку по этапам:
+    разбор и чанкинг (изолированные процессы, PDF - по страницам) -> эмбеддинги (поток) -> запись в БД (поток).
+    Цикл событий при этом свободен и продолжает обслуживать чат.
+    """
+    with _jobs_lock:
+        job["status"] = "running"
+
+    try:
+        _set_stage(job, "parsing", "running")
+        chunks, pages = await parse_payload(payload, job["filename"])
+        # Файл больше не нужен - не держим его в памяти до конца задачи
+        payload = None
+        _set_stage(job, "parsing", "done")
+
+        # Модель эмбеддингов одна на процесс сервера, поэтому этот этап - в потоке
+        _set_stage(job, "embedding", "running")
+        embeddings = await asyncio.to_thread(encode_chunks, chunks)
+        _set_stage(job, "embedding", "done" if embeddings is not None else "skipped")
+
+        _set_stage(job, "saving", "running")
+        # Фильтры Блума по словам документа - чтобы поиск пропускал его, если слов запроса в нем нет
+        bloom = await asyncio.to_thread(DocumentBloom.build, chunks)
+        doc_id = await asyncio.to_thread(
+            db.save_document,
+            user_id=job["user_id"],
+            name=job["filename"],
+            chunks=chunks,
+            created_at=datetime.utcnow().isoformat(),
+            embeddings=embeddings,
+            pages=pages,
+            bloom=bloom.to_bytes(),
+        )
+        # Запись сбросила кэш корпуса - загружаем его заново вместе с индексом
+        # триграмм, чтобы первый вопрос по новому документу их не ждал
+        await asyncio.to_thread(corpus_cache.warm, job["user_id"])
+        _set_stage(job, "saving", "done")
+
+        with _jobs_lock:
+            job["document_id"] = doc_id
+            job["chunks"] = len(chunks)
+        _finish(job, "done")
+    except ExtractionError as e:
+        print(f"Не удалось разобрать {job['filename']}: {e.reason}: {e.message}")
+        with _jobs_lock:
+            job["reason"] = e.reason
+        _finish(job, "error", e.message)
+    except Exception as e:
+        print(f"Ошибка обработки {job['filename']}: {e}")
+        _finish(job, "error", str(e))
+
+
+def start_job(job: Dict, filename: str, payload: Union[str, bytes]) -> None:
+    """Запускает обработку принятого файла в фоне и сразу возвращает управление"""
+    with _jobs_lock:
+        job["filename"] = filename
+        job["status"] = "queued"
+    task = asyncio.create_task(run_job(job, payload))
+    _running_tasks.add(task)
+    task.add_done_callback(_running_tasks.discard)
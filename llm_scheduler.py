@@ -0,0 +1,204 @@
+# Общий планировщик запросов к модели: лимит параллельных вызовов, честная очередь, лимит скорости
+import asyncio
+import time
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager
+from typing import Awaitable, Callable, Deque, Optional
+
+from config import LLM_MAX_IN_FLIGHT, LLM_REQUESTS_PER_MIN, LLM_TOKENS_PER_MIN, LLM_MAX_QUEUE_PER_USER
+
+
+class SchedulerBusy(Exception):
+    """У пользователя уже слишком много вопросов в очереди"""
+
+
+class TokenBucket:
+    """
+    Ведро токенов: пополняется на rate_per_min в минуту, вмещает не больше
+    rate_per_min (то есть допускает всплеск до минутной квоты).
+    """
+
+    def __init__(self, rate_per_min: float):
+        self.capacity = rate_per_min
+        self.rate = rate_per_min / 60.0
+        self.tokens = rate_per_min
+        self.updated = time.monotonic()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, cost: float) -> float:
+        """Сколько секунд ждать, пока в ведре наберется cost (0 - можно сейчас)"""
+        self._refill()
+        cost = min(cost, self.capacity)
+        return 0.0 if self.tokens >= cost else (cost - self.tokens) / self.rate
+
+    def take(self, cost: float) -> None:
+        self._refill()
+        self.tokens -= min(cost, self.capacity)
+
+
+class _Waiter:
+    def __init__(self, user_key: str, cost: float):
+        self.user_key = user_key
+        self.cost = cost
+        self.granted = asyncio.get_running_loop().create_future()
+        self.position = 0
+        self.changed = asyncio.Event()
+
+
+class LLMScheduler:
+    """
+    Единая точка входа для всех вызовов модели на сервере (работает в цикле
+    событий сервера, через него идет astream_question). Консольный режим
+    (agent.run_agent -> process_question) задает вопросы по одному, в своем
+    процессе, и вызывает модель напрямую.
+
+    Одновременно выполняется не больше max_in_flight вызовов. Ждущие вызовы
+    стоят в очередях по пользователям, и очередь обходится по кругу: каждый
+    пользователь получает по одному вызову за круг, поэтому тот, кто задал
+    много вопросов подряд, не задерживает остальных. Вызов стартует, только
+    если в ведрах хватает квоты провайдера (запросы и токены в минуту).
+    Каждый ждущий знает свое место в общей очереди.
+    """
+
+    def __init__(
+        self,
+        max_in_flight: int,
+        requests_per_min: Optional[float] = None,
+        tokens_per_min: Optional[float] = None,
+        max_queue_per_user: int = LLM_MAX_QUEUE_PER_USER,
+    ):
+        self.max_in_flight = max_in_flight
+        self.max_queue_per_user = max_queue_per_user
+        self.request_bucket = TokenBucket(requests_per_min) if requests_per_min else None
+        self.token_bucket = TokenBucket(tokens_per_min) if tokens_per_min else None
+        self.in_flight = 0
+        # Очереди по пользователям; порядок ключей - порядок обхода по кругу
+        self._queues: "OrderedDict[str, Deque[_Waiter]]" = OrderedDict()
+        self._timer: Optional[asyncio.TimerHandle] = None
+
+    @property
+    def queued(self) -> int:
+        return sum(len(queue) for queue in self._queues.values())
+
+    @asynccontextmanager
+    async def slot(
+        self,
+        user_key: str,
+        cost: float = 0,
+        on_position: Optional[Callable[[int], Awaitable[None]]] = None,
+    ):
+        """
+        Ждет своей очереди и держит место на время вызова модели:
+            async with llm_scheduler.slot(user_key, cost, on_position):
+                ... model.astream(...) ...
+        cost - примерная стоимость вызова в токенах (для лимита токенов в минуту).
+        on_position(место) вызывается, пока вызов ждет, при каждом сдвиге очереди.
+        Если у пользователя уже max_queue_per_user вопросов в очереди - SchedulerBusy.
+        """
+        queue = self._queues.get(user_key)
+        if queue is not None and len(queue) >= self.max_queue_per_user:
+            raise SchedulerBusy(f"Слишком много вопросов в очереди (не больше {self.max_queue_per_user})")
+
+        waiter = _Waiter(user_key, cost)
+        self._queues.setdefault(user_key, deque()).append(waiter)
+        self._dispatch()
+
+        try:
+            reported = None
+            while not waiter.granted.done():
+                if on_position is not None and waiter.position != reported:
+                    reported = waiter.position
+                    await on_position(reported)
+                    continue
+                waiter.changed.clear()
+                changed = asyncio.ensure_future(waiter.changed.wait())
+                try:
+                    await asyncio.wait([waiter.granted, changed], return_when=asyncio.FIRST_COMPLETED)
+                finally:
+                    changed.cancel()
+        except BaseException:
+            if waiter.granted.done():
+                self._release()
+            else:
+                self._remove(waiter)
+            raise
+
+        try:
+            yield
+        finally:
+            self._release()
+
+    def _remove(self, waiter: _Waiter) -> None:
+        """Убирает из очереди вызов, который перестали ждать (клиент ушел)"""
+        queue = self._queues.get(waiter.user_key)
+        if queue is not None and waiter in queue:
+            queue.remove(waiter)
+            if not queue:
+                del self._queues[waiter.user_key]
+        self._dispatch()
+
+    def _release(self) -> None:
+        self.in_flight -= 1
+        self._dispatch()
+
+    def _dispatch(self) -> None:
+        """Запускает ждущие вызовы, пока есть свободные места и квота"""
+        while self._queues and self.in_flight < self.max_in_flight:
+            user_key, queue = next(iter(self._queues.items()))
+            waiter = queue[0]
+
+            wait = 0.0
+            if self.request_bucket:
+                wait = max(wait, self.request_bucket.wait_time(1))
+            if self.token_bucket:
+                wait = max(wait, self.token_bucket.wait_time(waiter.cost))
+            if wait > 0:
+                # Квоты не хватает - проверим снова, когда ведро наполнится
+                if self._timer is None:
+                    self._timer = asyncio.get_running_loop().call_later(wait, self._on_timer)
+                break
+
+            queue.popleft()
+            # Пользователь уходит в конец круга (если у него есть еще вопросы)
+            del self._queues[user_key]
+            if queue:
+                self._queues[user_key] = queue
+            if self.request_bucket:
+                self.request_bucket.take(1)
+            if self.token_bucket:
+                self.token_bucket.take(waiter.cost)
+            self.in_flight += 1
+            waiter.granted.set_result(True)
+
+        self._update_positions()
+
+    def _on_timer(self) -> None:
+        self._timer = None
+        self._dispatch()
+
+    def _update_positions(self) -> None:
+        """
+        Место каждого ждущего = сколько вызовов стартует раньше него
+        при обходе очередей по кругу (1 - следующий).
+        """
+        position = 0
+        queues = [list(queue) for queue in self._queues.values()]
+        for depth in range(max((len(queue) for queue in queues), default=0)):
+            for queue in queues:
+                if depth < len(queue):
+                    position += 1
+                    waiter = queue[depth]
+                    if waiter.position != position:
+                        waiter.position = position
+                        waiter.changed.set()
+
+
+llm_scheduler = LLMScheduler(
+    LLM_MAX_IN_FLIGHT,
+    requests_per_min=LLM_REQUESTS_PER_MIN,
+    tokens_per_min=LLM_TOKENS_PER_MIN,
+)
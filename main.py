@@ -1,19 +1,24 @@
 # Основной файл запуска системы
+import asyncio
 import json
 import uvicorn
 import db
-from datetime import datetime
-import os
+from typing import Optional
 
-from fastapi import FastAPI, WebSocket, UploadFile, File, Form, HTTPException
+from fastapi import FastAPI, WebSocket, Form, HTTPException
 from fastapi.responses import HTMLResponse, JSONResponse
 from fastapi.staticfiles import StaticFiles
 
 from dotenv import load_dotenv
-from agent import create_agent_model, process_question
+from agent import create_agent_model, astream_question
+from llm_scheduler import SchedulerBusy
+from auth_executor import auth_executor, AuthBusy
 from schemas import ResearchReport
 from db import init_db, save_document, list_documents, delete_document, delete_all_documents, get_all_users, delete_user_by_id, get_all_documents_admin, delete_any_document
-from utils import extract_semantic_chunks
+import ingest
+from notes_index import notes_index
+from config import NOTES_WATCH
+from context_packer import start_tokenizer_loading
 
 # Добавьте эти строки к существующим импортам
 from fastapi import Depends, HTTPException, status, Request
@@ -76,6 +81,16 @@ async def get_current_admin(
 
 agent_model = create_agent_model()
 
+
+@app.on_event("startup")
+async def start_background_tasks():
+    """Фоновые задачи, которые запускаются вместе с сервером"""
+    if NOTES_WATCH:
+        # Индекс заметок обновляется в фоне, вопросы не ждут разбора файлов
+        notes_index.start_watcher()
+    # Токенизатор для бюджета контекста - тоже в фоне, до первого вопроса
+    start_tokenizer_loading()
+
 app.mount("/static", StaticFiles(directory="static"), name="static")
 
 
@@ -87,50 +102,58 @@ async def index():
 
 @app.post("/upload")
 async def upload_document(
-    file: UploadFile = File(...),
+    request: Request,
     current_user: dict = Depends(get_current_user)
 ):
     """
-    Загрузка документа для ТЕКУЩЕГО пользователя.
+    Загрузка документа для ТЕКУЩЕГО пользователя (multipart, поле "file").
+    Тело запроса читается потоком прямо в память, без временных файлов;
+    размер ограничен UPLOAD_MAX_FILE_BYTES и UPLOAD_MAX_REQUEST_BYTES.
+    Файл обрабатывается в фоне: сразу возвращаем job_id,
+    а прогресс можно узнать через GET /upload/jobs/{job_id}.
     """
-    print(f"Загрузка файла: {file.filename} от пользователя {current_user['id']}")  # для отладки
-    
-    uploads_dir = "uploads"
-    os.makedirs(uploads_dir, exist_ok=True)
-    temp_path = os.path.join(uploads_dir, file.filename)
-
-    content_bytes = await file.read()
-    with open(temp_path, "wb") as f:
-        f.write(content_bytes)
+    # Место под задачу занимается до чтения файла: сверх лимитов файл не принимается
+    try:
+        job = ingest.create_job(current_user['id'])
+    except ingest.IngestBusy as e:
+        status_code = 429 if e.scope == "user" else 503
+        raise HTTPException(status_code=status_code, detail=str(e), headers={"Retry-After": "5"})
 
-    from document_reader import read_document  
-    text = read_document(temp_path)
     try:
-        os.remove(temp_path)
-    except OSError:
-        pass
-    
-    if not text:
-        return {"status": "error", "message": "Не удалось прочитать содержимое файла"}
+        filename, payload = await ingest.receive_upload(request)
+    except ingest.UploadTooLarge as e:
+        ingest.discard_job(job)
+        raise HTTPException(status_code=413, detail=str(e))
+    except ValueError as e:
+        ingest.discard_job(job)
+        raise HTTPException(status_code=400, detail=str(e))
+    except BaseException:
+        # Клиент оборвал загрузку и т.п. - место под задачу освобождаем
+        ingest.discard_job(job)
+        raise
 
-    chunks = extract_semantic_chunks(text)
-    created_at = datetime.utcnow().isoformat()
-    
-    # Используем ID текущего пользователя
-    doc_id = db.save_document(
-        user_id=current_user['id'],
-        name=file.filename,
-        chunks=chunks,
-        created_at=created_at
-    )
+    print(f"Загрузка файла: {filename} от пользователя {current_user['id']}")  # для отладки
+
+    ingest.start_job(job, filename, payload)
 
     return {
-        "status": "ok",
-        "document_id": doc_id,
-        "chunks": len(chunks),
-        "filename": file.filename,
+        "status": "accepted",
+        "job_id": job["job_id"],
+        "filename": filename,
     }
 
+
+@app.get("/upload/jobs/{job_id}")
+async def upload_job_status(
+    job_id: str,
+    current_user: dict = Depends(get_current_user)
+):
+    """Состояние фоновой обработки загруженного файла (по этапам)"""
+    job = ingest.get_job(job_id, current_user['id'])
+    if not job:
+        raise HTTPException(status_code=404, detail="Задача не найдена")
+    return job
+
 # ===== ИЗМЕНЯЕМ получение документов =====
 @app.get("/documents")
 async def get_documents(current_user: dict = Depends(get_current_user)):
@@ -160,18 +183,45 @@ async def remove_all_documents(current_user: dict = Depends(get_current_user)):
         "deleted_documents": deleted_count
     }
     
-def report_to_markdown(report: ResearchReport) -> str:
-    md = "### Ответ\n\n"
-    md += report.answer.strip() + "\n\n"
-
-    if report.sources:
+def sources_to_markdown(sources: list) -> str:
+    md = ""
+    if sources:
         md += "### Источники\n"
-        for src in report.sources:
+        for src in sources:
             md += f'- <a href="{src}" target="_blank" rel="noopener noreferrer">{src}</a>\n'
-
     return md
 
 
+async def stream_report(ws: WebSocket, question: str, user_id: str) -> Optional[ResearchReport]:
+    """
+    Отвечает на вопрос по WebSocket потоком JSON-кадров:
+    {"type": "queue", "position": место} - пока вопрос ждет модель,
+    {"type": "token", "content": кусок ответа} - по мере генерации,
+    затем {"type": "sources", "sources": [...], "content": markdown источников}.
+    Если вопрос не принят (переполнена очередь) - кадр {"error": ...} и None.
+    """
+    async def send_token(text: str) -> None:
+        await ws.send_text(json.dumps({"type": "token", "content": text}))
+
+    async def send_position(position: int) -> None:
+        await ws.send_text(json.dumps({"type": "queue", "position": position}))
+
+    try:
+        report = await astream_question(
+            question, agent_model, send_token, user_id=user_id, on_queue=send_position
+        )
+    except SchedulerBusy as e:
+        await ws.send_text(json.dumps({"error": str(e)}))
+        return None
+
+    await ws.send_text(json.dumps({
+        "type": "sources",
+        "sources": report.sources,
+        "content": sources_to_markdown(report.sources),
+    }))
+    return report
+
+
 @app.websocket("/ws")
 async def websocket_endpoint(ws: WebSocket):
     await ws.accept()
@@ -228,33 +278,27 @@ async def websocket_endpoint(ws: WebSocket):
         # Если в первом сообщении был не токен, а вопрос - обрабатываем его сразу
         if 'first_message_text' in locals():
             # Обрабатываем вопрос
-            report = process_question(first_message_text, agent_model, user_id=user_id)
-            
-            chat_history.append({
-                "question": first_message_text,
-                "answer": report.answer
-            })
+            report = await stream_report(ws, first_message_text, user_id)
             
-            await ws.send_text(json.dumps({
-                "content": report_to_markdown(report)
-            }))
+            if report:
+                chat_history.append({
+                    "question": first_message_text,
+                    "answer": report.answer
+                })
         
         # Продолжаем слушать следующие сообщения
         while True:
             try:
                 question = await ws.receive_text()
                 
-                # Обрабатываем вопрос с учетом user_id
-                report = process_question(question, agent_model, user_id=user_id)
-                
-                chat_history.append({
-                    "question": question,
-                    "answer": report.answer
-                })
+                # Обрабатываем вопрос с учетом user_id (ответ уходит клиенту по частям)
+                report = await stream_report(ws, question, user_id)
                 
-                await ws.send_text(json.dumps({
-                    "content": report_to_markdown(report)
-                }))
+                if report:
+                    chat_history.append({
+                        "question": question,
+                        "answer": report.answer
+                    })
             except Exception as e:
                 # Если клиент отключился (при выходе), просто выходим из цикла
                 print(f"Клиент отключился: {e}")
@@ -295,11 +339,9 @@ async def register(user_data: UserCreate):
         4. Если нет - возвращаем ошибку
     """
     try:
-        # Создаем пользователя
-        user_id = db.create_user(
-            username=user_data.username,
-            email=user_data.email,
-            password=user_data.password
+        # Создаем пользователя (хэширование пароля - в пуле потоков)
+        user_id = await auth_executor.run(
+            db.create_user, user_data.username, user_data.email, user_data.password
         )
         
         # Получаем созданного пользователя (без пароля)
@@ -309,6 +351,8 @@ async def register(user_data: UserCreate):
     except ValueError as e:
         # Если пользователь уже существует
         raise HTTPException(status_code=400, detail=str(e))
+    except AuthBusy as e:
+        raise HTTPException(status_code=503, detail=str(e), headers={"Retry-After": "1"})
 
 @app.post("/auth/login", response_model=TokenResponse)
 async def login(user_data: UserLogin):
@@ -327,16 +371,19 @@ async def login(user_data: UserLogin):
         2. Если всё ок - создаем сессию (токен)
         3. Возвращаем токен и данные пользователя
     """
-    # Проверяем пароль
-    user = db.authenticate_user(user_data.username, user_data.password)
+    # Проверяем пароль (хэширование - в пуле потоков, чат в это время не ждет)
+    try:
+        user = await auth_executor.run(db.authenticate_user, user_data.username, user_data.password)
+    except AuthBusy as e:
+        raise HTTPException(status_code=503, detail=str(e), headers={"Retry-After": "1"})
     if not user:
         raise HTTPException(
             status_code=401,
             detail="Неверное имя пользователя или пароль"
         )
     
-    # Создаем сессию (токен)
-    token = db.create_session(user['id'])
+    # Создаем сессию (токен) - запись в БД тоже не в цикле событий
+    token = await asyncio.to_thread(db.create_session, user['id'])
     
     # Возвращаем токен и данные
     return {
@@ -0,0 +1,71 @@
+# Поиск сразу многих подстрок за один проход по тексту
+import re
+from functools import lru_cache
+from typing import Dict, Iterable, Iterator, List, Tuple
+
+
+class MultiPatternMatcher:
+    """
+    Находит вхождения всех шаблонов (ключевые слова, биграммы, имена)
+    за один проход по тексту - время зависит от длины текста, а не от
+    длины текста, умноженной на число шаблонов.
+
+    Шаблоны собираются в префиксное дерево (бор), как в алгоритме
+    Ахо-Корасик, и бор компилируется в одно регулярное выражение: в каждой
+    позиции текста движок re (на C) идет по бору и отмечает все шаблоны,
+    которые там начинаются, включая вложенные ("дракон" и "дракон смауг").
+    """
+
+    def __init__(self, patterns: Iterable[str]):
+        self.patterns: List[str] = list(dict.fromkeys(p for p in patterns if p))
+        trie: Dict = {}
+        for number, pattern in enumerate(self.patterns):
+            node = trie
+            for char in pattern:
+                node = node.setdefault(char, {})
+            node[None] = number
+        self._regex = re.compile(self._compile(trie)) if self.patterns else None
+
+    def _compile(self, node: Dict) -> str:
+        """Узел бора -> регулярное выражение; конец шаблона - пустая группа p<номер>"""
+        parts = []
+        for char, child in node.items():
+            if char is not None:
+                parts.append(re.escape(char) + self._compile(child))
+        body = "|".join(parts)
+        if len(parts) > 1:
+            body = f"(?:{body})"
+        if None not in node:
+            return body
+        end = f"(?P<p{node[None]}>)"
+        # Шаблон кончается здесь, но может продолжаться более длинным - жадно берем продолжение
+        return f"{end}(?:{body})?" if body else end
+
+    def finditer(self, text: str) -> Iterator[Tuple[int, str]]:
+        """Все вхождения: пары (позиция начала, шаблон), по возрастанию позиции"""
+        if self._regex is None:
+            return
+        # Не finditer: вхождения могут перекрываться, поэтому следующий поиск
+        # начинается со следующего символа после начала предыдущего вхождения
+        match = self._regex.search(text)
+        while match is not None:
+            for name, value in match.groupdict().items():
+                if value is not None:
+                    yield match.start(), self.patterns[int(name[1:])]
+            match = self._regex.search(text, match.start() + 1)
+
+    def first_positions(self, text: str) -> Dict[str, int]:
+        """Позиция первого вхождения каждого найденного шаблона"""
+        positions: Dict[str, int] = {}
+        for start, pattern in self.finditer(text):
+            if pattern not in positions:
+                positions[pattern] = start
+                if len(positions) == len(self.patterns):
+                    break
+        return positions
+
+
+@lru_cache(maxsize=256)
+def compile_matcher(patterns: Tuple[str, ...]) -> MultiPatternMatcher:
+    """Матчер для набора шаблонов строится один раз на запрос и переиспользуется"""
+    return MultiPatternMatcher(patterns)
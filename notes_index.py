@@ -0,0 +1,400 @@
+# Индекс заметок (режим по умолчанию / гостевой): файлы разбираются один раз
+import ctypes
+import ctypes.util
+import hashlib
+import os
+import select
+import sqlite3
+import threading
+import time
+from typing import List, Dict, Optional
+
+from config import (
+    SUPPORTED_EXTENSIONS, NOTES_DIR, NOTES_INDEX_PATH,
+    NOTES_WATCH_DEBOUNCE_SEC, NOTES_POLL_INTERVAL_SEC, FUZZY_MATCH, FUZZY_MAX_EXPANSIONS,
+)
+from utils import should_skip_file
+from query import CompiledQuery
+from document_reader import search_chunks, top_k_hits
+from sandbox import extractor_pool, ExtractionError, parse_file
+from bm25 import BM25Index
+
+
+def file_sha256(path: str) -> str:
+    """Хеш содержимого файла (читается блоками, без загрузки целиком)"""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class NotesFile:
+    """Разобранный файл заметок: чанки и BM25-индекс по ним"""
+
+    def __init__(self, filename: str, chunks: List[str]):
+        self.filename = filename
+        self.chunks = chunks
+        self.bm25 = BM25Index(chunks)
+        if FUZZY_MATCH:
+            # Файл разбирается при обновлении индекса - там же и триграммы, не при вопросе
+            self.bm25.build_trigrams()
+
+
+class NotesIndex:
+    """
+    Индекс файлов в папке заметок.
+
+    Манифест (путь, размер, mtime, sha256) и чанки хранятся в SQLite
+    (NOTES_INDEX_PATH) и переживают перезапуск. При обновлении заново
+    разбираются только новые и измененные файлы: если размер и mtime
+    совпали - файл не читается вовсе, если изменился только mtime, а хеш
+    тот же - файл не разбирается.
+    """
+
+    def __init__(self, directory: str, index_path: str):
+        self.directory = directory
+        self.index_path = index_path
+        self.files: Dict[str, NotesFile] = {}
+        self.manifest: Dict[str, tuple] = {}
+        self._loaded = False
+        # _refresh_lock - одно обновление за раз (держится и на время разбора файлов),
+        # _lock - короткий доступ к self.files, self.manifest и версии
+        self._refresh_lock = threading.Lock()
+        self._lock = threading.Lock()
+        self._watcher: "NotesWatcher | None" = None
+        self._version: Optional[str] = None
+        # Установлен, когда в индексе есть что искать: прошлый индекс поднят
+        # с диска или закончилось первое обновление
+        self._ready = threading.Event()
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.index_path)
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS notes_files (
+                path TEXT PRIMARY KEY,
+                size INTEGER NOT NULL,
+                mtime REAL NOT NULL,
+                sha256 TEXT NOT NULL
+            )
+        """)
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS notes_chunks (
+                path TEXT NOT NULL,
+                chunk_index INTEGER NOT NULL,
+                text TEXT NOT NULL,
+                PRIMARY KEY (path, chunk_index)
+            )
+        """)
+        return conn
+
+    def _load(self) -> None:
+        """Поднимает манифест и чанки, сохраненные при прошлом запуске"""
+        conn = self._connect()
+        try:
+            manifest = {
+                path: (size, mtime, sha)
+                for path, size, mtime, sha in conn.execute("SELECT path, size, mtime, sha256 FROM notes_files")
+            }
+
+            chunks_by_path: Dict[str, List[str]] = {}
+            rows = conn.execute("SELECT path, text FROM notes_chunks ORDER BY path, chunk_index")
+            for path, text in rows:
+                chunks_by_path.setdefault(path, []).append(text)
+        finally:
+            conn.close()
+
+        files = {path: NotesFile(os.path.basename(path), chunks) for path, chunks in chunks_by_path.items()}
+        with self._lock:
+            self.manifest.update(manifest)
+            self.files.update(files)
+            self._version = None
+        self._loaded = True
+        if manifest:
+            self._ready.set()
+
+    def _scan(self) -> Dict[str, os.stat_result]:
+        """Поддерживаемые файлы в папке заметок: путь -> stat"""
+        found = {}
+        for entry in os.scandir(self.directory):
+            if not entry.is_file() or should_skip_file(entry.name):
+                continue
+            ext = os.path.splitext(entry.name)[1].lower()
+            if ext not in SUPPORTED_EXTENSIONS:
+                continue
+            found[entry.path] = entry.stat()
+        return found
+
+    def refresh(self) -> int:
+        """
+        Сверяет индекс с папкой: индексирует новые и измененные файлы,
+        убирает удаленные. Возвращает число переиндексированных файлов.
+        """
+        # Файлы разбираются без self._lock, чтобы поиск в это время не ждал
+        with self._refresh_lock:
+            try:
+                if not self._loaded:
+                    self._load()
+
+                on_disk = self._scan()
+                changed = 0
+                conn = self._connect()
+                try:
+                    for path in set(self.manifest) - set(on_disk):
+                        self._remove(conn, path)
+                        changed += 1
+
+                    for path, stat in on_disk.items():
+                        if self._update(conn, path, stat):
+                            changed += 1
+                    conn.commit()
+                finally:
+                    conn.close()
+                return changed
+            finally:
+                # Даже неудачное обновление не должно оставить вопросы ждать вечно
+                self._ready.set()
+
+    def ensure_ready(self) -> None:
+        """
+        Готовит индекс к поиску. Без наблюдателя - обновляет его (разбираются
+        только новые и измененные файлы). С наблюдателем индекс обновляется
+        в фоне, но до первого обновления (или подъема прошлого индекса
+        с диска) искать не по чему - тогда ждем его.
+        """
+        if self.watching:
+            self._ready.wait()
+        else:
+            self.refresh()
+
+    @property
+    def version(self) -> str:
+        """
+        Версия содержимого папки: хеш от путей и sha256 файлов.
+        Одинакова для одинакового содержимого, в том числе после перезапуска.
+        Не ждет идущего обновления: считается по манифесту на текущий момент.
+        """
+        with self._lock:
+            if self._version is None:
+                digest = hashlib.sha256()
+                for path in sorted(self.manifest):
+                    digest.update(f"{path}\0{self.manifest[path][2]}\n".encode())
+                self._version = digest.hexdigest()[:16]
+            return self._version
+
+    def _update(self, conn: sqlite3.Connection, path: str, stat: os.stat_result) -> bool:
+        """Индексирует файл, если он новый или изменился. True - если переиндексирован."""
+        known = self.manifest.get(path)
+        if known and known[0] == stat.st_size and known[1] == stat.st_mtime:
+            return False
+
+        sha = file_sha256(path)
+        if known and known[2] == sha:
+            # Файл "потрогали", но содержимое то же - разбирать не нужно (версия та же)
+            with self._lock:
+                self.manifest[path] = (stat.st_size, stat.st_mtime, sha)
+            conn.execute(
+                "UPDATE notes_files SET size = ?, mtime = ? WHERE path = ?",
+                (stat.st_size, stat.st_mtime, path),
+            )
+            return False
+
+        # Разбор - в изолированном процессе: сломанный файл не повесит сервер.
+        # Неразобранный файл остается в манифесте без чанков до следующего изменения.
+        try:
+            chunks = extractor_pool.run(os.path.splitext(path)[1].lower(), parse_file, path)
+        except ExtractionError as e:
+            print(f"Не удалось разобрать {path}: {e.reason}: {e.message}")
+            chunks = []
+
+        conn.execute("DELETE FROM notes_chunks WHERE path = ?", (path,))
+        conn.executemany(
+            "INSERT INTO notes_chunks (path, chunk_index, text) VALUES (?, ?, ?)",
+            [(path, idx, text) for idx, text in enumerate(chunks)],
+        )
+        conn.execute(
+            "INSERT OR REPLACE INTO notes_files (path, size, mtime, sha256) VALUES (?, ?, ?, ?)",
+            (path, stat.st_size, stat.st_mtime, sha),
+        )
+
+        notes_file = NotesFile(os.path.basename(path), chunks) if chunks else None
+        with self._lock:
+            self.manifest[path] = (stat.st_size, stat.st_mtime, sha)
+            self._version = None
+            if notes_file:
+                self.files[path] = notes_file
+            else:
+                self.files.pop(path, None)
+        return True
+
+    def _remove(self, conn: sqlite3.Connection, path: str) -> None:
+        """Убирает файл из индекса"""
+        conn.execute("DELETE FROM notes_chunks WHERE path = ?", (path,))
+        conn.execute("DELETE FROM notes_files WHERE path = ?", (path,))
+        with self._lock:
+            self.manifest.pop(path, None)
+            self.files.pop(path, None)
+            self._version = None
+
+    @property
+    def watching(self) -> bool:
+        """Следит ли за папкой фоновый наблюдатель"""
+        return self._watcher is not None and self._watcher.is_alive()
+
+    def start_watcher(self) -> None:
+        """Запускает фоновое слежение за папкой (повторный вызов ничего не делает)"""
+        if not self.watching:
+            self._watcher = NotesWatcher(self)
+            self._watcher.start()
+
+    def search(self, query: CompiledQuery, k: int) -> List[Dict]:
+        """
+        Ищет по всем проиндексированным файлам (без чтения файлов с диска).
+        Возвращает k лучших находок (без текста - его дает window()). Файлы,
+        которые по верхней границе BM25 не могут попасть в k лучших, не оцениваются.
+        """
+        with self._lock:
+            files = list(self.files.items())
+        if FUZZY_MATCH:
+            query = self._correct_typos(query, [notes_file for _, notes_file in files])
+
+        groups = []
+        for path, notes_file in files:
+            bound = notes_file.bm25.max_score(query)
+            if bound > 0:
+                groups.append((bound, lambda path=path, notes_file=notes_file: search_chunks(
+                    query, notes_file.chunks, notes_file.filename, notes_file.bm25, document_id=path,
+                )))
+        return top_k_hits(groups, k)
+
+    @staticmethod
+    def _correct_typos(query: CompiledQuery, notes_files: List[NotesFile]) -> CompiledQuery:
+        """
+        Исправляет слова, которых нет ни в одном файле, по словарям всех файлов
+        (слово, которого нет только в части файлов, опечаткой не считается).
+        """
+        corrections = {}
+        for term in dict.fromkeys(query.terms + query.proper_nouns):
+            if any(notes_file.bm25.has_term(term) for notes_file in notes_files):
+                continue
+            found: Dict[str, int] = {}
+            for notes_file in notes_files:
+                for distance, prefix in notes_file.bm25.similar_terms(term):
+                    found[prefix] = min(distance, found.get(prefix, distance))
+            if found:
+                best = sorted((distance, prefix) for prefix, distance in found.items())
+                corrections[term] = [prefix for _, prefix in best[:FUZZY_MAX_EXPANSIONS]]
+        return query.with_corrections(corrections)
+
+    def window(self, path: str, chunk_index: int, radius: int = 1) -> List[tuple]:
+        """Чанк файла с соседями: пары (chunk_index, text), как db.get_chunk_window"""
+        with self._lock:
+            notes_file = self.files.get(path)
+        if notes_file is None:
+            return []
+        start = max(0, chunk_index - radius)
+        return list(enumerate(notes_file.chunks[start:chunk_index + radius + 1], start))
+
+
+notes_index = NotesIndex(NOTES_DIR, NOTES_INDEX_PATH)
+
+
+# Константы inotify (linux/inotify.h)
+_IN_MODIFY = 0x002
+_IN_ATTRIB = 0x004
+_IN_CLOSE_WRITE = 0x008
+_IN_MOVED_FROM = 0x040
+_IN_MOVED_TO = 0x080
+_IN_CREATE = 0x100
+_IN_DELETE = 0x200
+_WATCH_MASK = (
+    _IN_MODIFY | _IN_ATTRIB | _IN_CLOSE_WRITE | _IN_MOVED_FROM
+    | _IN_MOVED_TO | _IN_CREATE | _IN_DELETE
+)
+
+
+def _open_inotify(directory: str) -> Optional[int]:
+    """
+    Подписывается на изменения папки через inotify (только Linux, через ctypes).
+    Возвращает файловый дескриптор или None, если inotify недоступен.
+    """
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        fd = libc.inotify_init()
+        if fd < 0:
+            return None
+        if libc.inotify_add_watch(fd, os.fsencode(directory), _WATCH_MASK) < 0:
+            os.close(fd)
+            return None
+        return fd
+    except (OSError, AttributeError):
+        return None
+
+
+class NotesWatcher(threading.Thread):
+    """
+    Фоновый поток, который держит индекс заметок актуальным.
+
+    Изменения в папке ловятся через inotify, а если он недоступен - опросом
+    (сравнение размеров и mtime раз в NOTES_POLL_INTERVAL_SEC). Пачка
+    изменений обрабатывается одним обновлением, когда в папке
+    NOTES_WATCH_DEBOUNCE_SEC ничего не происходило.
+    """
+
+    def __init__(self, index: NotesIndex):
+        super().__init__(name="notes-watcher", daemon=True)
+        self.index = index
+
+    def run(self) -> None:
+        self._safe_refresh()
+
+        fd = _open_inotify(self.index.directory)
+        if fd is None:
+            print("inotify недоступен, папка заметок проверяется опросом")
+            self._poll_loop()
+        else:
+            self._inotify_loop(fd)
+
+    def _safe_refresh(self) -> None:
+        try:
+            changed = self.index.refresh()
+            if changed:
+                print(f"Индекс заметок обновлен, файлов: {changed}")
+        except Exception as e:
+            print(f"Ошибка обновления индекса заметок: {e}")
+
+    def _inotify_loop(self, fd: int) -> None:
+        dirty = False
+        while True:
+            # Пока идут изменения - ждем тишины; без изменений - спим до события
+            timeout = NOTES_WATCH_DEBOUNCE_SEC if dirty else None
+            readable, _, _ = select.select([fd], [], [], timeout)
+            if readable:
+                # Сами события не разбираем: обновление все равно сверяет всю папку
+                os.read(fd, 64 * 1024)
+                dirty = True
+            elif dirty:
+                self._safe_refresh()
+                dirty = False
+
+    def _poll_loop(self) -> None:
+        previous = self._snapshot()
+        dirty = False
+        while True:
+            time.sleep(NOTES_WATCH_DEBOUNCE_SEC if dirty else NOTES_POLL_INTERVAL_SEC)
+            current = self._snapshot()
+            if current != previous:
+                previous = current
+                dirty = True
+            elif dirty:
+                self._safe_refresh()
+                dirty = False
+
+    def _snapshot(self) -> Dict[str, tuple]:
+        try:
+            return {
+                path: (stat.st_size, stat.st_mtime)
+                for path, stat in self.index._scan().items()
+            }
+        except OSError:
+            return {}
@@ -0,0 +1,116 @@
+# Разбор поискового запроса: ключевые слова, синонимы, биграммы, имена
+import re
+from dataclasses import dataclass, replace
+from functools import lru_cache
+from typing import Dict, List, Tuple
+
+from config import RELATED_CONCEPTS, QUERY_CACHE_SIZE, SYNONYM_WEIGHT, FUZZY_WEIGHT
+
+TOKEN_RE = re.compile(r"[a-zа-яё0-9]+")
+
+STOP_WORDS = frozenset({
+    "кто", "что", "где", "когда", "почему", "как",
+    "какая", "какой", "какие", "чем", "зачем",
+    "откуда", "куда", "чему", "на", "в", "о", "об", "про",
+    "за", "до", "из", "по", "при", "там", "тут", "этот", "эта", "это",
+})
+
+_QUERY_CLEAN_RE = re.compile(r"[^a-zа-я0-9ё\s]")
+
+
+def tokenize(text: str) -> List[str]:
+    """Разбивает текст на слова в нижнем регистре"""
+    return TOKEN_RE.findall(text.lower())
+
+
+def _build_synonym_index() -> Dict[str, Tuple[str, ...]]:
+    """
+    Обратный индекс RELATED_CONCEPTS: слово -> связанные слова.
+    Слово находит список, если оно само - ключ или входит в список;
+    если таких списков несколько, они идут в порядке RELATED_CONCEPTS.
+    """
+    index: Dict[str, List[str]] = {}
+    for key, related_list in RELATED_CONCEPTS.items():
+        for word in dict.fromkeys([key, *related_list]):
+            index.setdefault(word, []).extend(related_list)
+    return {word: tuple(related) for word, related in index.items()}
+
+
+# Строится один раз при импорте: расширение слова - один поиск в словаре
+SYNONYMS = _build_synonym_index()
+
+
+@dataclass(frozen=True)
+class CompiledQuery:
+    """
+    Разобранный запрос - общий для всех способов поиска (BM25 по корпусу
+    и заметкам, FTS5, верхние границы оценок). Неизменяемый, поэтому один
+    объект безопасно переиспользуется между запросами и потоками.
+
+    terms - ключевые слова вместе с синонимами, без повторов, по порядку;
+    weights - вес каждого слова (синонимы - SYNONYM_WEIGHT);
+    bigrams - соседние пары слов (бонус, если идут в тексте подряд);
+    proper_nouns - слова из слов запроса с заглавной буквы (имена, названия).
+    """
+
+    text: str
+    terms: Tuple[str, ...]
+    weights: Tuple[float, ...]
+    bigrams: Tuple[Tuple[str, str], ...]
+    proper_nouns: Tuple[str, ...]
+
+    def __bool__(self) -> bool:
+        return bool(self.terms)
+
+    def with_corrections(self, corrections: Dict[str, List[str]]) -> "CompiledQuery":
+        """
+        Тот же запрос, где слова с опечатками заменены исправлениями
+        (слово -> варианты из словаря корпуса) с весом FUZZY_WEIGHT.
+        """
+        if not corrections:
+            return self
+        weights: Dict[str, float] = {}
+        for term, weight in zip(self.terms, self.weights):
+            for variant in corrections.get(term, [term]):
+                if variant not in weights:
+                    weights[variant] = weight if variant == term else weight * FUZZY_WEIGHT
+        terms = tuple(weights)
+        proper_nouns = tuple(
+            variant for term in self.proper_nouns for variant in corrections.get(term, [term])
+        )
+        return replace(
+            self,
+            terms=terms,
+            weights=tuple(weights.values()),
+            bigrams=tuple(zip(terms, terms[1:])),
+            proper_nouns=proper_nouns,
+        )
+
+
+@lru_cache(maxsize=QUERY_CACHE_SIZE)
+def compile_query(text: str) -> CompiledQuery:
+    """Разбирает запрос (повторяющиеся запросы берутся из LRU-кэша)"""
+    normalized = _QUERY_CLEAN_RE.sub(" ", text.lower())
+    base_keywords = [word for word in normalized.split() if word not in STOP_WORDS and len(word) > 2]
+
+    expanded: List[str] = []
+    for keyword in base_keywords:
+        expanded.append(keyword)
+        expanded.extend(SYNONYMS.get(keyword, ()))
+    terms = tuple(dict.fromkeys(expanded))
+    base = set(base_keywords)
+
+    proper_nouns = tuple(
+        term
+        for word in text.split()
+        if word[0].isupper() and len(word) > 1
+        for term in tokenize(word)
+    )
+
+    return CompiledQuery(
+        text=text,
+        terms=terms,
+        weights=tuple(1.0 if term in base else SYNONYM_WEIGHT for term in terms),
+        bigrams=tuple(zip(terms, terms[1:])),
+        proper_nouns=proper_nouns,
+    )
@@ -0,0 +1,229 @@
+# Изолированный разбор документов: отдельные процессы с лимитами времени и памяти
+import asyncio
+import io
+import multiprocessing
+import os
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Tuple, Union
+
+from config import CHUNK_SIZE, EXTRACT_LIMITS, EXTRACT_WORKER_MAX_TASKS, EXTRACT_RSS_CHECK_SEC, INGEST_WORKERS
+from document_reader import extract_text, pdf_page_count, extract_pdf_pages
+from utils import extract_semantic_chunks
+
+
+class ExtractionError(Exception):
+    """
+    Документ не удалось разобрать. reason - причина для программы:
+    "unsupported", "timeout", "memory", "crashed", "parse_error", "empty".
+    """
+
+    def __init__(self, reason: str, message: str):
+        super().__init__(message)
+        self.reason = reason
+        self.message = message
+
+
+# ===== ЗАДАЧИ (выполняются в процессе-обработчике) =====
+
+def parse_file(path: str) -> List[str]:
+    """Читает файл с диска и режет на чанки"""
+    text = extract_text(path, os.path.splitext(path)[1].lower())
+    return extract_semantic_chunks(text, CHUNK_SIZE) if text else []
+
+
+def parse_upload(payload: Union[str, bytes], filename: str) -> List[str]:
+    """
+    Режет загруженный файл на чанки.
+    payload - уже декодированный текст (txt/md) или байты файла (docx, json).
+    """
+    if isinstance(payload, str):
+        text = payload
+    else:
+        text = extract_text(io.BytesIO(payload), os.path.splitext(filename)[1].lower())
+    return extract_semantic_chunks(text, CHUNK_SIZE) if text else []
+
+
+def count_pdf_pages(path: str) -> int:
+    """Число страниц PDF"""
+    return pdf_page_count(path)
+
+
+def parse_pdf_pages(path: str, start: int, end: int) -> List[Tuple[int, str]]:
+    """
+    Разбирает страницы PDF [start, end) из файла path и режет каждую на чанки.
+    Обработчик получает только путь и диапазон, а не байты всего файла.
+    Возвращает пары (номер страницы, чанк).
+    Чанки не переходят через границу страницы - у каждого свой номер.
+    """
+    return [
+        (number, chunk)
+        for number, text in extract_pdf_pages(path, start, end)
+        for chunk in extract_semantic_chunks(text, CHUNK_SIZE)
+    ]
+
+
+def _worker_main(conn) -> None:
+    """Цикл процесса-обработчика: получает (функция, аргументы), отправляет результат"""
+    while True:
+        try:
+            task = conn.recv()
+        except EOFError:
+            return
+        if task is None:
+            return
+        func, args = task
+        try:
+            conn.send(("ok", func(*args)))
+        except MemoryError:
+            conn.send(("error", "memory", "Не хватило памяти при разборе"))
+        except Exception as e:
+            conn.send(("error", "parse_error", f"{type(e).__name__}: {e}"))
+
+
+# ===== ПУЛ ИЗОЛИРОВАННЫХ ПРОЦЕССОВ =====
+
+_PAGE_SIZE = os.sysconf("SC_PAGE_SIZE") if hasattr(os, "sysconf") else 4096
+
+
+class _Worker:
+    """Один процесс-обработчик и канал связи с ним"""
+
+    def __init__(self, ctx):
+        self.conn, child_conn = ctx.Pipe()
+        self.process = ctx.Process(target=_worker_main, args=(child_conn,), daemon=True)
+        self.process.start()
+        child_conn.close()
+        self.tasks = 0
+
+    def rss_bytes(self) -> int:
+        """Резидентная память процесса (Linux, /proc); 0 - если узнать нельзя"""
+        try:
+            with open(f"/proc/{self.process.pid}/statm") as f:
+                return int(f.read().split()[1]) * _PAGE_SIZE
+        except (OSError, ValueError, IndexError):
+            return 0
+
+    def stop(self) -> None:
+        """Мягко завершает процесс (после исчерпания лимита задач)"""
+        try:
+            self.conn.send(None)
+        except (OSError, ValueError):
+            pass
+        self.process.join(1)
+        self.kill()
+
+    def kill(self) -> None:
+        if self.process.is_alive():
+            self.process.kill()
+            self.process.join()
+        self.conn.close()
+
+
+class ExtractorPool:
+    """
+    Пул процессов для разбора документов.
+
+    Каждый вызов выполняется в отдельном процессе с ограничением времени
+    и резидентной памяти (EXTRACT_LIMITS по расширению файла). Процесс,
+    превысивший лимит или упавший, убивается, и на его место запускается
+    новый - сломанный файл стоит одного процесса, а не всего сервера.
+    Процессы также перезапускаются после EXTRACT_WORKER_MAX_TASKS задач,
+    чтобы не копить утечки памяти разборщиков.
+    """
+
+    def __init__(self, workers: int, max_tasks: int = EXTRACT_WORKER_MAX_TASKS):
+        self.max_tasks = max_tasks
+        self._ctx = multiprocessing.get_context("spawn")
+        self._slots = threading.Semaphore(workers)
+        self._idle: "queue.SimpleQueue[_Worker]" = queue.SimpleQueue()
+        # Свои потоки для вызовов из asyncio (arun): ждущие разбора задачи
+        # не занимают общий пул asyncio.to_thread, через который идет поиск для чата
+        self._threads = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="extract")
+
+    def run(self, ext: str, func, *args):
+        """
+        Выполняет func(*args) в процессе-обработчике и возвращает результат.
+        Блокирует поток до результата (из asyncio - через arun).
+        При неудаче - ExtractionError с причиной.
+        """
+        limits = EXTRACT_LIMITS.get(ext)
+        if limits is None:
+            raise ExtractionError("unsupported", f"Формат {ext or '(без расширения)'} не поддерживается")
+
+        with self._slots:
+            worker = self._acquire()
+            try:
+                result = self._execute(worker, func, args, limits)
+            except ExtractionError as e:
+                # Обычная ошибка разборщика процесс не портит, остальное - убиваем
+                if e.reason == "parse_error":
+                    self._release(worker)
+                else:
+                    worker.kill()
+                raise
+            except BaseException:
+                worker.kill()
+                raise
+            self._release(worker)
+            return result
+
+    async def arun(self, ext: str, func, *args):
+        """
+        run для asyncio: выполняется в собственных потоках пула (по одному на
+        процесс), лишние вызовы ждут в очереди этих потоков.
+        """
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._threads, self.run, ext, func, *args)
+
+    def _acquire(self) -> _Worker:
+        """Свободный живой процесс или новый"""
+        while True:
+            try:
+                worker = self._idle.get_nowait()
+            except queue.Empty:
+                return _Worker(self._ctx)
+            if worker.process.is_alive():
+                return worker
+            worker.kill()
+
+    def _release(self, worker: _Worker) -> None:
+        """Возвращает процесс в пул или перезапускает, если он отработал свое"""
+        worker.tasks += 1
+        if worker.tasks >= self.max_tasks:
+            worker.stop()
+        else:
+            self._idle.put(worker)
+
+    def _execute(self, worker: _Worker, func, args: tuple, limits: dict):
+        timeout = limits["timeout_sec"]
+        max_rss = limits["max_rss_mb"] * 1024 * 1024
+        deadline = time.monotonic() + timeout
+
+        try:
+            worker.conn.send((func, args))
+        except (OSError, ValueError) as e:
+            raise ExtractionError("crashed", f"Процесс разбора недоступен: {e}")
+
+        while True:
+            if worker.conn.poll(EXTRACT_RSS_CHECK_SEC):
+                try:
+                    reply = worker.conn.recv()
+                except EOFError:
+                    worker.process.join(1)
+                    raise ExtractionError("crashed", f"Процесс разбора завершился (код {worker.process.exitcode})")
+                if reply[0] == "ok":
+                    return reply[1]
+                raise ExtractionError(reply[1], reply[2])
+
+            if not worker.process.is_alive():
+                raise ExtractionError("crashed", f"Процесс разбора завершился (код {worker.process.exitcode})")
+            if time.monotonic() > deadline:
+                raise ExtractionError("timeout", f"Разбор не уложился в {timeout} с")
+            if worker.rss_bytes() > max_rss:
+                raise ExtractionError("memory", f"Разбор занял больше {limits['max_rss_mb']} МБ памяти")
+
+
+extractor_pool = ExtractorPool(INGEST_WORKERS)
@@ -6,6 +6,9 @@ const uploadBtn = document.getElementById("uploadButton");
 
 let socket;
 
+// Ответ, который сейчас приходит по частям: элемент сообщения и накопленный текст
+let streaming = null;
+
 // Функция получения токена
 function getToken() {
     return localStorage.getItem('token');
@@ -54,6 +57,39 @@ function connect() {
                 window.location.href = '/login';
             }
             addMessage("agent", `_Ошибка: ${data.error}_`, true);
+            streaming = null;
+            return;
+        }
+
+        // Вопрос ждет своей очереди к модели: показываем место
+        if (data.type === "queue") {
+            if (!streaming) {
+                streaming = { element: addMessage("agent", "", true), text: "" };
+            }
+            streaming.element.innerHTML = marked.parse(`_Вопрос в очереди, место: ${data.position}_`);
+            return;
+        }
+
+        // Кусок ответа: дописываем в текущее сообщение
+        if (data.type === "token") {
+            if (!streaming) {
+                streaming = { element: addMessage("agent", "", true), text: "" };
+            }
+            streaming.text += data.content;
+            streaming.element.innerHTML = marked.parse("### Ответ\n\n" + streaming.text);
+            messages.scrollTop = messages.scrollHeight;
+            return;
+        }
+
+        // Последний кадр ответа - источники
+        if (data.type === "sources") {
+            if (streaming && data.content) {
+                streaming.element.innerHTML = marked.parse(
+                    "### Ответ\n\n" + streaming.text.trim() + "\n\n" + data.content
+                );
+                messages.scrollTop = messages.scrollHeight;
+            }
+            streaming = null;
             return;
         }
         
@@ -86,6 +122,7 @@ function addMessage(role, text, markdown = false) {
     msg.appendChild(content);
     messages.appendChild(msg);
     messages.scrollTop = messages.scrollHeight;
+    return content;
 }
 
 // Отправка сообщения
@@ -150,10 +187,15 @@ async function uploadFiles() {
                 continue;
             }
 
-            const data = await resp.json();
+            let data = await resp.json();
             console.log('Успех:', data);
+
+            // Файл обрабатывается в фоне - ждем окончания задачи
+            if (data.status === "accepted") {
+                data = await waitForUploadJob(data.job_id, token);
+            }
             
-            if (data.status === "ok") {
+            if (data.status === "done") {
                 addMessage(
                     "agent",
                     `Документ **${data.filename}** загружен. Найдено чанков: ${data.chunks}.`,
@@ -180,6 +222,29 @@ async function uploadFiles() {
 }
 
 
+// Ожидание фоновой обработки загруженного файла
+async function waitForUploadJob(jobId, token) {
+    while (true) {
+        await new Promise(resolve => setTimeout(resolve, 1000));
+
+        const resp = await fetch(`/upload/jobs/${jobId}`, {
+            headers: {
+                'Authorization': `Bearer ${token}`
+            }
+        });
+        if (!resp.ok) {
+            return { status: "error", message: "задача не найдена" };
+        }
+
+        const job = await resp.json();
+        console.log('Задача загрузки:', job.status, job.stage);
+        if (job.status === "done" || job.status === "error") {
+            return job;
+        }
+    }
+}
+
+
 // Назначение обработчиков событий
 sendBtn.onclick = sendMessage;
 
@@ -1,8 +1,8 @@
 # Вспомогательные функции
 
 import re
-from typing import List, Set
-from config import IGNORED_PREFIXES, RELATED_CONCEPTS
+from typing import List
+from config import IGNORED_PREFIXES
 
 
 def extract_semantic_chunks(text: str, chunk_size: int = 500) -> List[str]:
@@ -54,35 +54,3 @@ def should_skip_file(filename: str) -> bool:
         if filename.startswith(prefix):
             return True
     return False
-
-
-def extract_keywords(question: str) -> List[str]:
-    """Извлекает ключевые слова из вопроса"""
-    normalized = question.lower()
-    normalized = re.sub(r"[^a-zа-я0-9ё\s]", " ", normalized)
-
-    stop_words = {
-        "кто", "что", "где", "когда", "почему", "как",
-        "какая", "какой", "какие", "чем", "зачем",
-        "откуда", "куда", "чему", "на", "в", "о", "об", "про",
-        "за", "до", "из", "по", "при", "там", "тут", "этот", "эта", "это",
-    }
-
-    words = normalized.split()
-    base_keywords = [word for word in words if word not in stop_words and len(word) > 2]
-
-    expanded_keywords: List[str] = []
-    for kw in base_keywords:
-        expanded_keywords.append(kw)
-        for key, related_list in RELATED_CONCEPTS.items():
-            if kw == key or kw in related_list:
-                expanded_keywords.extend(related_list)
-
-    seen: Set[str] = set()
-    result: List[str] = []
-    for kw in expanded_keywords:
-        if kw not in seen:
-            seen.add(kw)
-            result.append(kw)
-
-    return result or base_keywords
\ No newline at end of file